@@ -30,7 +30,7 @@ def create_app(test_config=None):
         app.config.from_mapping(test_config)
     
     # 3. Създаване на необходимите директории (ако не съществуват)
-    for folder_key in ['SIGNATURES_FOLDER', 'COVERS_FOLDER']:
+    for folder_key in ['SIGNATURES_FOLDER', 'COVERS_FOLDER', 'JOBS_FOLDER']:
         folder_path = os.path.join(app.instance_path, '..', app.config[folder_key])
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
@@ -42,6 +42,10 @@ def create_app(test_config=None):
     from .extensions import socketio
     socketio.init_app(app)
 
+    # Приоритети и ограничения на заявките (гише, справки, публичен каталог)
+    from . import scheduling
+    scheduling.init_app(app)
+
     # 5. Регистрация на Blueprints (модулите с маршрути)
     from .routes_auth import auth_bp
     app.register_blueprint(auth_bp)
@@ -69,6 +73,9 @@ def create_app(test_config=None):
     from .routes_settings import settings_bp
     app.register_blueprint(settings_bp)
 
+    from .routes_jobs import jobs_bp
+    app.register_blueprint(jobs_bp)
+
     # 6. Добавяне на филтри и контекст процесори към Jinja2
     from .utils import format_date_dmy, calculate_fine
     app.jinja_env.filters['dmy'] = format_date_dmy
@@ -0,0 +1,292 @@
+# application/activity.py
+
+import os
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from .database import get_db, write_transaction, is_busy, PoolTimeoutError
+
+# Дневникът на дейността расте с всеки вход и всяко заемане. Новите записи
+# са в 'activity_log' в основната база, а по-старите от ACTIVITY_ARCHIVE_DAYS
+# дни се преместват в същата таблица в отделна база ('archive'), която се
+# прикачва към всяка връзка. Временният изглед 'activity_log_all' обединява
+# двете, така че справката за дейността не зависи от това къде е записът.
+#
+# Времето се пази като 'YYYY-MM-DD HH:MM:SS' (местно време), така че
+# периодите се търсят по индекса с 'timestamp >= начало AND timestamp < край'.
+#
+# Записите от 'log_activity' не се пишат веднага след бизнес операцията, а
+# се подават на ActivityLogWriter - той ги събира и ги записва наведнъж в
+# една транзакция на всеки няколко милисекунди (или при натрупани N записа).
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+INSERT_SQL = "INSERT INTO activity_log (timestamp, username, action, details) VALUES (?, ?, ?, ?)"
+
+ARCHIVE_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS archive.activity_log (
+        id INTEGER PRIMARY KEY,
+        timestamp DATETIME,
+        username TEXT NOT NULL,
+        action TEXT NOT NULL,
+        details TEXT
+    );
+    CREATE INDEX IF NOT EXISTS archive.idx_activity_log_timestamp ON activity_log(timestamp);
+    CREATE TABLE IF NOT EXISTS archive.row_counts (
+        name TEXT PRIMARY KEY,
+        count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TRIGGER IF NOT EXISTS archive.activity_log_count_after_insert AFTER INSERT ON activity_log BEGIN
+        UPDATE row_counts SET count = count + 1 WHERE name = 'activity_log';
+    END;
+    CREATE TRIGGER IF NOT EXISTS archive.activity_log_count_after_delete AFTER DELETE ON activity_log BEGIN
+        UPDATE row_counts SET count = count - 1 WHERE name = 'activity_log';
+    END;
+"""
+
+# Изгледът е временен (за връзката) - постоянен изглед в 'main' не може да сочи към прикачена база
+ACTIVITY_VIEW_SQL = """
+    CREATE TEMP VIEW IF NOT EXISTS activity_log_all AS
+        SELECT id, timestamp, username, action, details FROM main.activity_log
+        UNION ALL
+        SELECT id, timestamp, username, action, details FROM archive.activity_log
+"""
+
+# Брой записи, преместван в една транзакция
+ARCHIVE_BATCH_ROWS = 5000
+
+
+def archive_path_for(db_path):
+    """Пътят до архивната база по подразбиране - до основната, с наставка '_archive'."""
+    base, ext = os.path.splitext(db_path)
+    return f"{base}_archive{ext or '.db'}"
+
+
+def attach_archive(conn, archive_path):
+    """Прикачва архивната база към връзката и създава изгледа 'activity_log_all'."""
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    conn.execute("PRAGMA archive.journal_mode = WAL")
+    conn.executescript(ARCHIVE_SCHEMA_SQL)
+    # Броячът се попълва веднъж - при нова архивна база или такава отпреди него
+    if conn.execute("SELECT 1 FROM archive.row_counts WHERE name = 'activity_log'").fetchone() is None:
+        conn.execute("INSERT OR IGNORE INTO archive.row_counts (name, count) VALUES ('activity_log', (SELECT COUNT(*) FROM archive.activity_log))")
+        conn.commit()
+    conn.execute(ACTIVITY_VIEW_SQL)
+
+
+def activity_log_count(conn):
+    """Броят записи в дневника - в основната и в архивната база (от броячите, без COUNT(*))."""
+    return conn.execute(
+        "SELECT COALESCE(SUM(count), 0) FROM (SELECT count FROM main.row_counts WHERE name = 'activity_log' "
+        "UNION ALL SELECT count FROM archive.row_counts WHERE name = 'activity_log')"
+    ).fetchone()[0]
+
+
+def day_range(start_date, end_date):
+    """
+    Полуотворен обхват [начало, край) за периода от start_date до end_date
+    включително: краят е началото на следващия ден.
+    """
+    try:
+        end = (date.fromisoformat(str(end_date)[:10]) + timedelta(days=1)).isoformat()
+    except ValueError:
+        # Ръчно въведен текст - '~' е след всички цифри, т.е. целият ден е включен
+        end = f"{end_date}~"
+    return start_date, end
+
+
+def archive_activity(conn, days, progress=None):
+    """
+    Премества записите, по-стари от 'days' дни, в архивната база - на порции,
+    всяка в отделна транзакция. Връща броя преместени записи.
+    """
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+    total = conn.execute("SELECT COUNT(*) FROM main.activity_log WHERE timestamp < ?", (cutoff,)).fetchone()[0]
+    moved = 0
+    while moved < total:
+        with write_transaction(conn):
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM main.activity_log WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                (cutoff, ARCHIVE_BATCH_ROWS)
+            )]
+            if ids:
+                marks = ', '.join('?' * len(ids))
+                # При WAL транзакцията не е атомарна между двете бази: OR IGNORE
+                # позволява повторение, ако записът е копиран, но не и изтрит
+                conn.execute(f"INSERT OR IGNORE INTO archive.activity_log SELECT id, timestamp, username, action, details FROM main.activity_log WHERE id IN ({marks})", ids)
+                conn.execute(f"DELETE FROM main.activity_log WHERE id IN ({marks})", ids)
+        if not ids:
+            break
+        moved += len(ids)
+        if progress:
+            progress(moved, total)
+    return moved
+
+
+def activity_record(username, action, details=""):
+    """Запис за дневника с текущото време във формата на таблицата."""
+    return (datetime.now().strftime(TIMESTAMP_FORMAT), username, action, details)
+
+
+class ActivityLogWriter:
+    """
+    Записва дневника на дейността на порции (в 'app.extensions['activity_writer']').
+    Опашката е ограничена: когато е пълна, 'put' изчаква записващия вместо да
+    изпуска записи. При спиране на процеса остатъкът се записва синхронно.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.batch_size = app.config['ACTIVITY_LOG_BATCH']
+        self.flush_seconds = app.config['ACTIVITY_LOG_FLUSH_MS'] / 1000.0
+        self._queue = queue.Queue(maxsize=app.config['ACTIVITY_LOG_QUEUE_SIZE'])
+        self._lock = threading.Lock()
+        self._stats = {
+            'records': 0,       # записани редове
+            'batches': 0,       # транзакции
+            'batch_max': 0,
+            'full_waits': 0,    # 'put' е изчаквал, защото опашката е пълна
+            'retries': 0,       # временна грешка (заключена база) - записът е опитан наново
+            'dropped': 0,       # записи, отхвърлени от базата (пропуснати, за да не спрат дневника)
+        }
+
+    def start(self):
+        from .extensions import socketio
+        socketio.start_background_task(self._loop)
+        atexit.register(self.flush)
+
+    def put(self, record):
+        """Добавя запис в опашката; при пълна опашка изчаква."""
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._bump('full_waits')
+            self._queue.put(record)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            error = self._write_retrying(batch)
+            if error is None:
+                continue
+            # Постоянна грешка (напр. невалиден запис) не бива да спре дневника -
+            # иначе опашката се пълни и 'put' спира всички заявки. Порцията се
+            # записва запис по запис и се пропускат само отхвърлените.
+            print(f"!!! Грешка при запис в дневника ({len(batch)} записа), запис поотделно: {error}")
+            for record in batch:
+                error = self._write_retrying([record])
+                if error is not None:
+                    self._bump('dropped')
+                    print(f"!!! Пропуснат запис от дневника {record!r}: {error}")
+
+    def _write_retrying(self, records):
+        """Записва записите; при заключена база опитва наново. Връща постоянната грешка или None."""
+        from .extensions import socketio
+        while True:
+            try:
+                # Записът минава през лентата за запис (виж 'db_lanes.py')
+                with self.app.app_context():
+                    self._write(get_db(), records)
+                return None
+            except sqlite3.Error as e:
+                # Заключена база и липса на свободна връзка са временни
+                if not (is_busy(e) or isinstance(e, PoolTimeoutError)):
+                    return e
+                self._bump('retries')
+                print(f"!!! Временна грешка при запис в дневника ({len(records)} записа), нов опит: {e}")
+            socketio.sleep(0.5)
+
+    def _write(self, conn, batch):
+        conn.executemany(INSERT_SQL, batch)
+        conn.commit()
+        with self._lock:
+            self._stats['records'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['batch_max'] = max(self._stats['batch_max'], len(batch))
+
+    def flush(self):
+        """Записва синхронно всичко, останало в опашката (при спиране на процеса)."""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return
+        conn = self.app.extensions['db_pool'].open_connection()
+        try:
+            self._write(conn, batch)
+        finally:
+            conn.close()
+
+    def _bump(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data['queued'] = self._queue.qsize()
+        data['queue_size'] = self._queue.maxsize
+        data['batch_avg'] = round(data['records'] / data['batches'], 2) if data['batches'] else 0.0
+        return data
+
+
+def start_activity_writer(app):
+    """Стартира записващия на дневника в текущия процес."""
+    if 'activity_writer' in app.extensions:
+        return
+    writer = ActivityLogWriter(app)
+    app.extensions['activity_writer'] = writer
+    writer.start()
+
+
+def _archive_loop(app):
+    from .extensions import socketio
+    from .fines import _seconds_until
+    while True:
+        try:
+            with app.app_context():
+                moved = archive_activity(get_db(), app.config['ACTIVITY_ARCHIVE_DAYS'])
+            print(f"--- INFO: Преместени в архива записи от дневника: {moved} ---")
+        except Exception as e:
+            print(f"!!! Грешка при архивиране на дневника: {e}")
+        socketio.sleep(_seconds_until(app.config['ACTIVITY_ARCHIVE_TIME']))
+
+
+def start_activity_archival(app):
+    """Стартира фоновата задача, която всеки ден в 'ACTIVITY_ARCHIVE_TIME' архивира старите записи."""
+    from .extensions import socketio
+    if app.extensions.get('activity_archival'):
+        return
+    app.extensions['activity_archival'] = socketio.start_background_task(_archive_loop, app)
+
+
+@click.command('archive-activity')
+@click.option('--days', type=int, default=None, help='Записи, по-стари от толкова дни (по подразбиране ACTIVITY_ARCHIVE_DAYS).')
+@with_appcontext
+def archive_activity_command(days):
+    """Команда 'flask archive-activity' - премества старите записи от дневника в архивната база."""
+    days = current_app.config['ACTIVITY_ARCHIVE_DAYS'] if days is None else days
+    moved = archive_activity(get_db(), days)
+    click.echo(f"Преместени записи: {moved}")
@@ -0,0 +1,67 @@
+# application/cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Малък LRU кеш в паметта с време на живот на записите.
+    Пази броячи за попадения/пропуски, за да може да се оразмери.
+    """
+
+    def __init__(self, maxsize=256, ttl=15.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < now):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Записва стойност; 'ttl=0' означава без изтичане (само LRU изместване)."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+def get_cache(app, name, maxsize, ttl):
+    """Връща (и при нужда създава) именуван кеш в 'app.extensions'."""
+    caches = app.extensions.setdefault('caches', {})
+    if name not in caches:
+        caches[name] = TTLCache(maxsize=maxsize, ttl=ttl)
+    return caches[name]
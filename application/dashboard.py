@@ -0,0 +1,99 @@
+# application/dashboard.py
+
+import threading
+from datetime import date
+from flask import current_app
+from .database import get_row_count
+from .fines import reader_fine_totals
+
+# Данните на таблото се пазят в паметта на процеса, разделени на секции.
+# Тригерите от миграция 8 увеличават версията на засегнатите секции в
+# 'cache_versions' при всеки запис в книги, читатели, заемания и номенклатури,
+# така че при отваряне на таблото се чете само един ред с версии и се
+# преизчисляват единствено секциите, чиято версия (или дата) е сменена.
+
+SECTIONS = ('dashboard_books', 'dashboard_readers', 'dashboard_loans', 'dashboard_lookups')
+
+_VERSIONS_SQL = "SELECT name, version FROM cache_versions WHERE name IN (?, ?, ?, ?)"
+
+
+def _load_books(conn, today):
+    genre_stats = conn.execute("SELECT genre, COUNT(*) as count FROM books WHERE genre IS NOT NULL GROUP BY genre ORDER BY count DESC").fetchall()
+    return {
+        'book_count': get_row_count(conn, 'books'),
+        'latest_books': [dict(row) for row in conn.execute('SELECT tom_no, title, author, record_date, cover_image FROM books ORDER BY rowid DESC LIMIT 5').fetchall()],
+        'chart_data': {"labels": [g['genre'] for g in genre_stats], "data": [g['count'] for g in genre_stats]},
+    }
+
+
+def _load_readers(conn, today):
+    return {
+        'reader_count': conn.execute('SELECT COUNT(*) FROM readers WHERE last_registration_year = ?', (today.year,)).fetchone()[0],
+        'latest_readers': [dict(row) for row in conn.execute('SELECT * FROM readers ORDER BY rowid DESC LIMIT 5').fetchall()],
+    }
+
+
+def _load_loans(conn, today):
+    overdue_books_sql = "SELECT br.borrow_id, b.title, r.full_name, br.due_date, br.accrued_fine AS fine, b.tom_no, r.reader_no FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no JOIN readers r ON br.reader_no = r.reader_no WHERE br.return_date IS NULL AND br.due_date < ? ORDER BY br.due_date"
+    return {
+        'borrowed_count': conn.execute('SELECT COUNT(*) FROM books WHERE current_borrow_id IS NOT NULL').fetchone()[0],
+        'overdue_books': [dict(row) for row in conn.execute(overdue_books_sql, (today.isoformat(),)).fetchall()],
+        'readers_with_fines': [dict(row) for row in reader_fine_totals(conn)],
+    }
+
+
+def _load_lookups(conn, today):
+    return {
+        'professions_for_modal': [dict(row) for row in conn.execute('SELECT * FROM professions ORDER BY name').fetchall()],
+        'educations_for_modal': [dict(row) for row in conn.execute('SELECT * FROM educations ORDER BY name').fetchall()],
+        'genres_for_modal': [dict(row) for row in conn.execute('SELECT * FROM genres ORDER BY name').fetchall()],
+    }
+
+
+_LOADERS = {
+    'dashboard_books': _load_books,
+    'dashboard_readers': _load_readers,
+    'dashboard_loans': _load_loans,
+    'dashboard_lookups': _load_lookups,
+}
+
+
+class DashboardSnapshot:
+    """
+    Кеш на таблото в паметта на процеса. Всяка секция пази версията и датата,
+    с които е заредена; при разминаване се зарежда наново само тя.
+    """
+
+    def __init__(self):
+        self._sections = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.rebuilds = {name: 0 for name in SECTIONS}
+
+    def get(self, conn):
+        """Връща речник с всички данни за шаблона на таблото."""
+        today = date.today()
+        versions = dict.fromkeys(SECTIONS, 0)
+        versions.update({row['name']: row['version'] for row in conn.execute(_VERSIONS_SQL, SECTIONS)})
+        context = {}
+        for name in SECTIONS:
+            key = (versions[name], today)
+            cached = self._sections.get(name)
+            if cached is None or cached[0] != key:
+                cached = (key, _LOADERS[name](conn, today))
+                with self._lock:
+                    self._sections[name] = cached
+                    self.rebuilds[name] += 1
+            else:
+                self.hits += 1
+            context.update(cached[1])
+        return context
+
+    def stats(self):
+        return {'hits': self.hits, 'rebuilds': dict(self.rebuilds)}
+
+
+def get_dashboard(app=None):
+    """Връща кеша на таблото за приложението (създава го при първо извикване)."""
+    app = app or current_app
+    return app.extensions.setdefault('dashboard', DashboardSnapshot())
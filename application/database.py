@@ -1,60 +1,308 @@
 # application/database.py
 
 import sqlite3
+import threading
+import time
+import queue
+import random
+import atexit
 import click
+from contextlib import contextmanager
+from eventlet import tpool
 from flask import current_app, g
 from flask.cli import with_appcontext
+from . import migrations
+from .db_lanes import DbLanes, LaneConnection, sleep
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """Няма свободна връзка в пула в рамките на зададеното време."""
+
+
+class ConnectionPool:
+    """
+    Пул от предварително настроени SQLite връзки.
+    Връзките се създават при нужда (до 'size' броя), пазят се между заявките
+    и се връщат в пула при 'teardown_appcontext'.
+    """
+
+    def __init__(self, db_path, size=8, timeout=10.0, busy_timeout_ms=5000,
+                 cache_size_kb=20000, mmap_size=268435456, cached_statements=256, archive_path=None):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+
+        # LIFO - последно върнатата (най-"топла") връзка се дава първа
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self._stats = {
+            'hits': 0,        # взета е готова връзка от пула
+            'misses': 0,      # отворена е нова връзка
+            'waits': 0,       # пулът е бил изчерпан и се е чакало
+            'timeouts': 0,    # изчакването е изтекло без свободна връзка
+            'discarded': 0,   # повредени връзки, които са затворени
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _connect(self):
+        """Отваря нова връзка и прилага PRAGMA настройките."""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000.0,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        # Отрицателна стойност = размер в KiB, а не в страници
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # Архивът на дневника на дейността (виж 'activity.py')
+        if self.archive_path:
+            from .activity import attach_archive
+            attach_archive(conn, self.archive_path)
+        return conn
+
+    def open_connection(self):
+        """
+        Отваря отделна връзка със същите настройки, но извън пула. За фонови
+        задачи в отделни нишки - пулът е за заявките в основния цикъл.
+        """
+        return self._connect()
+
+    def acquire(self):
+        """Връща връзка от пула, като при нужда създава нова или изчаква."""
+        try:
+            conn = self._idle.get_nowait()
+            self._bump('hits')
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+                self._stats['misses'] += 1
+
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Пулът е изчерпан - изчакваме някоя връзка да бъде върната
+        started = time.monotonic()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            self._bump('timeouts')
+            raise PoolTimeoutError(
+                f"Няма свободна връзка към базата данни след {self.timeout} сек. (размер на пула: {self.size})"
+            )
+        waited = time.monotonic() - started
+        with self._lock:
+            self._stats['waits'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return conn
+
+    def release(self, conn):
+        """Връща връзката в пула. Незавършени транзакции се отменят."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+
+        if self._closed:
+            self._discard(conn, count=False)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn, count=True):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+            if count:
+                self._stats['discarded'] += 1
+
+    def _bump(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        """Връща броячите на пула - за оразмеряване и наблюдение."""
+        with self._lock:
+            data = dict(self._stats)
+            data['size'] = self.size
+            data['open'] = self._created
+        data['idle'] = self._idle.qsize()
+        data['in_use'] = data['open'] - data['idle']
+        acquired = data['hits'] + data['misses'] + data['waits']
+        data['hit_ratio'] = round(data['hits'] / acquired, 4) if acquired else 0.0
+        data['wait_time_avg'] = round(data['wait_time_total'] / data['waits'], 6) if data['waits'] else 0.0
+        return data
+
+    def close_all(self):
+        """Затваря всички свободни връзки (при спиране на процеса)."""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn, count=False)
+
+
+class ContentionStats:
+    """Броячи за изчакването на заключената база при 'write_transaction'."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            'transactions': 0,   # започнати транзакции
+            'contended': 0,      # от тях - след поне един отказ 'database is locked'
+            'retries': 0,        # общо повторни опити
+            'failures': 0,       # отказани след изчерпване на опитите
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def record(self, retries, waited, failed=False):
+        with self._lock:
+            stats = self._stats
+            stats['failures' if failed else 'transactions'] += 1
+            stats['retries'] += retries
+            if retries:
+                stats['contended'] += not failed
+                stats['wait_time_total'] += waited
+                stats['wait_time_max'] = max(stats['wait_time_max'], waited)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+        data['contention_ratio'] = round(data['contended'] / data['transactions'], 4) if data['transactions'] else 0.0
+        return data
+
+
+def is_busy(error):
+    """Дали грешката е временна - базата е заключена от друг запис (SQLITE_BUSY/SQLITE_LOCKED)."""
+    # 'database is locked', 'database table is locked'
+    return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+@contextmanager
+def write_transaction(conn=None):
+    """
+    Транзакция за запис, която взима заключването още при 'BEGIN IMMEDIATE'
+    (а не при първия запис, когато вече е прочетено нещо), така че по-късно
+    в нея не може да се получи 'database is locked'. Ако базата е заета, BEGIN
+    се опитва отново до DB_BUSY_RETRIES пъти с нарастваща пауза със случайно
+    отклонение. Потвърждава се при успех и се отменя при изключение.
+    """
+    conn = conn if conn is not None else get_db()
+    config, stats = current_app.config, current_app.extensions['db_contention']
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt >= config['DB_BUSY_RETRIES']:
+                stats.record(attempt, time.monotonic() - started, failed=is_busy(e))
+                raise
+            sleep(config['DB_BUSY_BACKOFF_MS'] / 1000.0 * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+    stats.record(attempt, time.monotonic() - started)
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def get_pool():
+    """Връща пула на текущото приложение."""
+    return current_app.extensions['db_pool']
+
+
+def get_lanes():
+    """Връща лентите за четене/запис на текущото приложение (виж 'db_lanes.py')."""
+    return current_app.extensions['db_lanes']
 
-def execute_sql_from_file(db, filename):
-    """Изпълнява SQL команди от файл."""
-    with current_app.open_resource(filename) as f:
-        db.executescript(f.read().decode('utf8'))
 
 def get_db():
     """
     Получава връзка към базата данни. Ако връзката не съществува в
-    контекста на заявката ('g'), тя се създава и съхранява там.
+    контекста на заявката ('g'), тя се взима от пула и се съхранява там.
+    Заявките през нея се изпълняват в истински нишки (виж 'db_lanes.py').
     """
     if 'db' not in g:
-        db_path = current_app.config['DATABASE']
-        g.db = sqlite3.connect(db_path)
-        g.db.row_factory = sqlite3.Row
-
-        # КОРЕКЦИЯ: Проверяваме и създаваме таблицата 'settings' ако липсва
-        cursor = g.db.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='settings'")
-        if cursor.fetchone() is None:
-            # Изпълняваме само частта от схемата, която създава новата таблица
-            cursor.executescript("""
-                CREATE TABLE settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
-                    description TEXT
-                );
-                INSERT OR IGNORE INTO settings (key, value, description) VALUES
-                    ('borrow_period', '20', 'Срок за заемане на книга (в дни)'),
-                    ('fine_per_day', '0.10', 'Глоба за просрочие на ден (в лв.)'),
-                    ('books_per_page', '10', 'Брой книги, показвани на страница');
-            """)
-            g.db.commit()
-            print("--- INFO: 'settings' table created and populated successfully. ---")
-
+        # Заявките на гишето ползват и запазените места за четене (виж 'scheduling.py')
+        priority = g.get('request_class') == 'circulation'
+        g.db = LaneConnection(get_pool().acquire(), get_lanes(), priority)
     return g.db
 
+def get_version(conn, name):
+    """Връща текущата версия на даден кеш от таблицата 'cache_versions'."""
+    row = conn.execute("SELECT version FROM cache_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def bump_version(conn, name):
+    """
+    Увеличава версията на даден кеш. Извиква се в същата транзакция като
+    записа, за да видят промяната и другите процеси.
+    """
+    conn.execute(
+        "INSERT INTO cache_versions (name, version) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+        (name,)
+    )
+
+def get_row_count(conn, name):
+    """Връща броя редове в таблица от броячите, поддържани от тригери."""
+    row = conn.execute("SELECT count FROM row_counts WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
 def close_db(e=None):
     """
-    Затваря връзката към базата данни, ако съществува.
+    Връща връзката към базата данни в пула, ако съществува.
     """
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_pool().release(db.detach())
 
 def init_db():
     """
-    Изчиства съществуващите данни и създава новите таблици.
+    Създава таблиците в нова база, като прилага всички миграции.
     """
     db = get_db()
-    execute_sql_from_file(db, 'database_schema.sql')
+    migrations.upgrade(db)
+
+def upgrade_db(target=None):
+    """Прилага неприложените миграции и връща списък с тях."""
+    return migrations.upgrade(get_db(), target)
 
 @click.command('init-db')
 @with_appcontext
@@ -66,11 +314,77 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+@click.command('db-upgrade')
+@click.option('--target', type=int, default=None, help='Номер на миграция, до която да се обнови схемата.')
+@click.option('--status', is_flag=True, help='Само показва текущата версия и чакащите миграции.')
+@with_appcontext
+def db_upgrade_command(target, status):
+    """
+    Команда 'flask db-upgrade' - прилага чакащите миграции на схемата.
+    """
+    db = get_db()
+    if status:
+        click.echo(f'Текуща версия на схемата: {migrations.current_version(db)}')
+        for m in migrations.pending(db):
+            click.echo(f'  чакаща {m.version}: {m.description}')
+        return
+    try:
+        applied = upgrade_db(target)
+    except migrations.MigrationBlocked as e:
+        click.echo(f'Миграциите са спрени: {e}')
+        raise SystemExit(1)
+    click.echo(f'Приложени миграции: {len(applied)}. Версия на схемата: {migrations.current_version(db)}')
+
 def init_app(app):
     """
     Регистрира функциите за управление на базата данни в Flask приложението.
     """
-    # Казва на Flask да извика 'close_db' след връщане на отговор
+    from .activity import archive_path_for
+    pool = ConnectionPool(
+        app.config['DATABASE'],
+        size=app.config['DB_POOL_SIZE'],
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+        cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+        mmap_size=app.config['DB_MMAP_SIZE'],
+        cached_statements=app.config['DB_CACHED_STATEMENTS'],
+        archive_path=app.config['ACTIVITY_ARCHIVE_DATABASE'] or archive_path_for(app.config['DATABASE']),
+    )
+    app.extensions['db_pool'] = pool
+    app.extensions['db_contention'] = ContentionStats()
+    atexit.register(pool.close_all)
+
+    # Нишки за SQLite: лентите за четене и запис плюс фоновите задачи (те също са в 'tpool')
+    read_workers, write_workers = app.config['DB_READ_WORKERS'], app.config['DB_WRITE_WORKERS']
+    app.extensions['db_lanes'] = DbLanes(read_workers, write_workers, app.config['DB_READ_RESERVED'])
+    tpool.set_num_threads(read_workers + write_workers + app.config['JOB_WORKERS'])
+
+    # Миграциите на схемата се прилагат веднъж при старт на процеса,
+    # така че заявките никога не проверяват 'sqlite_master'.
+    if app.config['DB_AUTO_MIGRATE']:
+        conn = pool.acquire()
+        try:
+            migrations.upgrade(conn)
+        except migrations.MigrationBlocked as e:
+            # Приложението работи с досегашната схема, докато данните не се поправят
+            print(f"!!! Миграциите са спрени: {e}")
+        finally:
+            pool.release(conn)
+
+    # Казва на Flask да върне връзката в пула след връщане на отговор
     app.teardown_appcontext(close_db)
     # Добавя новата команда, която може да бъде извикана с 'flask init-db'
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(db_upgrade_command)
+
+    from .query_plans import check_query_plans_command
+    app.cli.add_command(check_query_plans_command)
+    from .loans import check_loan_state_command
+    app.cli.add_command(check_loan_state_command)
+    from .fines import accrue_fines_command
+    app.cli.add_command(accrue_fines_command)
+    from .rollups import rebuild_rollups_command, check_rollups_command
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(check_rollups_command)
+    from .activity import archive_activity_command
+    app.cli.add_command(archive_activity_command)
@@ -0,0 +1,260 @@
+# application/db_lanes.py
+
+import re
+import time
+import eventlet
+from eventlet import patcher, tpool
+from eventlet.semaphore import Semaphore
+
+# Извикванията към SQLite са блокиращи C функции - изпълнени в зелена нишка
+# те спират целия eventlet цикъл (всички заявки и Socket.IO). Затова връзката
+# от 'get_db()' е обвита в LaneConnection: всяко 'execute'/'fetch*'/'commit'
+# се изпълнява в истинска нишка през 'eventlet.tpool', а зелената нишка само
+# чака резултата. Броят едновременни извиквания е ограничен по "ленти":
+#   - 'read'  - заявки за четене (SELECT/WITH/EXPLAIN), DB_READ_WORKERS наведнъж;
+#   - 'write' - всичко останало, DB_WRITE_WORKERS наведнъж. Мястото в лентата
+#     се държи до края на транзакцията (commit/rollback), така че записите
+#     чакат на опашка в процеса, вместо да се блъскат в заключената база.
+# DB_READ_RESERVED от местата за четене са запазени за връзките с приоритет
+# (заявките на гишето, виж 'scheduling.py') - справки и публичен каталог не
+# могат да заемат всички места пред заемането на книга.
+
+_READ_SQL = re.compile(r'^\s*(SELECT|WITH|EXPLAIN)\b', re.IGNORECASE)
+
+# Брой редове, взимани наведнъж при обхождане на курсор с 'for'
+ITER_ROWS = 500
+
+# Истинските (некръпнати) 'threading' и 'time' - за разпознаване на нишката на eventlet цикъла
+_threading = patcher.original('threading')
+_time = patcher.original('time')
+
+
+def is_write(sql):
+    return not _READ_SQL.match(sql)
+
+
+def sleep(seconds):
+    """Пауза, която в нишката на eventlet цикъла отстъпва на другите зелени нишки, а в истинска нишка просто спи."""
+    if _threading.get_ident() == _threading.main_thread().ident:
+        eventlet.sleep(seconds)
+    else:
+        _time.sleep(seconds)
+
+
+class Lane:
+    """
+    Ограничен брой едновременни извиквания в истински нишки. Броячите се
+    променят само от нишката на eventlet цикъла, затова не са нужни ключалки.
+    'reserved' от местата са само за извикванията с приоритет.
+    """
+
+    def __init__(self, name, workers, reserved=0):
+        self.name = name
+        self.workers = workers
+        self.reserved = max(0, min(reserved, workers - 1))
+        self._slots = Semaphore(workers)
+        # Извикванията без приоритет първо взимат място от незапазените
+        self._shared = Semaphore(workers - self.reserved) if self.reserved else None
+        self._stats = {
+            'calls': 0,            # извиквания в нишка
+            'acquired': 0,         # заети места в лентата
+            'waits': 0,            # мястото е взето след изчакване
+            'waiting': 0,          # в момента чакат на опашката
+            'waiting_max': 0,
+            'priority': 0,         # места, взети с приоритет
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'run_time_total': 0.0,
+            'run_time_max': 0.0,
+        }
+
+    def _gates(self, priority):
+        return (self._slots,) if priority or self._shared is None else (self._shared, self._slots)
+
+    def acquire(self, priority=False):
+        stats = self._stats
+        stats['acquired'] += 1
+        if priority:
+            stats['priority'] += 1
+        gates = self._gates(priority)
+        taken = []
+        for sem in gates:
+            if not sem.acquire(blocking=False):
+                break
+            taken.append(sem)
+        else:
+            return
+        for sem in taken:
+            sem.release()
+        stats['waits'] += 1
+        stats['waiting'] += 1
+        stats['waiting_max'] = max(stats['waiting_max'], stats['waiting'])
+        started = time.monotonic()
+        taken = []
+        try:
+            for sem in gates:
+                sem.acquire()
+                taken.append(sem)
+        except BaseException:
+            for sem in taken:
+                sem.release()
+            raise
+        finally:
+            stats['waiting'] -= 1
+        waited = time.monotonic() - started
+        stats['wait_time_total'] += waited
+        stats['wait_time_max'] = max(stats['wait_time_max'], waited)
+
+    def release(self, priority=False):
+        for sem in self._gates(priority):
+            sem.release()
+
+    def call(self, fn, *args):
+        """Изпълнява 'fn' в истинска нишка (мястото в лентата трябва да е взето)."""
+        started = time.monotonic()
+        try:
+            return tpool.execute(fn, *args)
+        finally:
+            elapsed = time.monotonic() - started
+            self._stats['calls'] += 1
+            self._stats['run_time_total'] += elapsed
+            self._stats['run_time_max'] = max(self._stats['run_time_max'], elapsed)
+
+    def run(self, fn, *args, priority=False):
+        self.acquire(priority)
+        try:
+            return self.call(fn, *args)
+        finally:
+            self.release(priority)
+
+    def stats(self):
+        data = dict(self._stats)
+        data['workers'] = self.workers
+        data['reserved'] = self.reserved
+        data['in_use'] = self.workers - self._slots.counter
+        data['wait_time_avg'] = round(data['wait_time_total'] / data['waits'], 6) if data['waits'] else 0.0
+        data['run_time_avg'] = round(data['run_time_total'] / data['calls'], 6) if data['calls'] else 0.0
+        return data
+
+
+class DbLanes:
+    """Лентите за четене и запис на едно приложение (в 'app.extensions['db_lanes']')."""
+
+    def __init__(self, read_workers, write_workers, read_reserved=0):
+        self.read = Lane('read', read_workers, read_reserved)
+        self.write = Lane('write', write_workers)
+        # Създават се при старта, в нишката на eventlet цикъла
+        self._hub_thread = _threading.get_ident()
+
+    def in_hub(self):
+        """
+        Дали сме в нишката на eventlet цикъла. Фоновите задачи вече са в
+        истински нишки - там извикванията се изпълняват директно.
+        """
+        return _threading.get_ident() == self._hub_thread
+
+    def stats(self):
+        return {'read': self.read.stats(), 'write': self.write.stats()}
+
+
+class LaneCursor:
+    """Курсор, чиито 'execute' и 'fetch*' минават през лентите на връзката си."""
+
+    def __init__(self, cursor, conn):
+        self._cursor = cursor
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, sql, parameters=()):
+        self._conn._run(is_write(sql), self._cursor.execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._conn._run(True, self._cursor.executemany, sql, seq_of_parameters)
+        return self
+
+    def fetchone(self):
+        return self._conn._run(False, self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._conn._run(False, self._cursor.fetchmany, size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._conn._run(False, self._cursor.fetchall)
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(ITER_ROWS)
+            if not rows:
+                break
+            yield from rows
+
+
+class LaneConnection:
+    """
+    Обвивка на SQLite връзка, която изпълнява извикванията в истински нишки
+    през лентите. Останалите атрибути (row_factory, in_transaction, ...) са на самата връзка.
+    Връзка с 'priority' ползва и запазените места в лентата за четене.
+    """
+
+    def __init__(self, conn, lanes, priority=False):
+        self.__dict__.update(_conn=conn, _lanes=lanes, _priority=priority, _write_held=False)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def _run(self, write, fn, *args):
+        lanes = self._lanes
+        if not lanes.in_hub():
+            return fn(*args)
+        if not (write or self._write_held):
+            return lanes.read.run(fn, *args, priority=self._priority)
+        # Мястото в лентата за запис се държи до края на транзакцията;
+        # четенията в нея минават през същото място
+        if not self._write_held:
+            lanes.write.acquire()
+            self.__dict__['_write_held'] = True
+        try:
+            return lanes.write.call(fn, *args)
+        finally:
+            if not self._conn.in_transaction:
+                self._release_write()
+
+    def _release_write(self):
+        if self._write_held:
+            self.__dict__['_write_held'] = False
+            self._lanes.write.release()
+
+    def cursor(self):
+        return LaneCursor(self._conn.cursor(), self)
+
+    def execute(self, sql, parameters=()):
+        return LaneCursor(self._run(is_write(sql), self._conn.execute, sql, parameters), self)
+
+    def executemany(self, sql, seq_of_parameters):
+        return LaneCursor(self._run(True, self._conn.executemany, sql, seq_of_parameters), self)
+
+    def executescript(self, script):
+        return LaneCursor(self._run(True, self._conn.executescript, script), self)
+
+    def commit(self):
+        # 'commit()' без отворена транзакция не прави нищо - не заема място за запис
+        if self._write_held or self._conn.in_transaction:
+            self._run(True, self._conn.commit)
+
+    def rollback(self):
+        if self._write_held or self._conn.in_transaction:
+            self._run(True, self._conn.rollback)
+
+    def detach(self):
+        """Отменя незавършена транзакция, освобождава лентата и връща самата връзка (за пула)."""
+        try:
+            self.rollback()
+        finally:
+            self._release_write()
+        return self._conn
@@ -0,0 +1,241 @@
+# application/exports.py
+
+import csv
+import importlib.util
+import io
+import os
+import tempfile
+from collections import namedtuple
+from flask import Response, current_app, stream_with_context
+
+# Общ механизъм за експорт на справките в CSV, XLSX и PDF.
+# Справката се описва като списък от секции (заглавие, колони, курсор);
+# редовете се четат от курсора на порции и се подават директно към
+# съответния формат. CSV се изпраща като поток, а XLSX и PDF се пишат във
+# временен файл (в паметта само докато е малък) и след това се изпращат на части,
+# или (от страницата за справки) се пишат от фонова задача - виж 'jobs.py'.
+
+ExportSection = namedtuple('ExportSection', ['title', 'headers', 'cursor'])
+
+FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf',
+}
+
+# Брой редове, които се четат от курсора наведнъж
+CHUNK_ROWS = 500
+# Размер на частите при изпращане на готовия файл
+SEND_CHUNK_BYTES = 64 * 1024
+
+# Шрифтове с кирилица за PDF (първият намерен се използва)
+PDF_FONT_CANDIDATES = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    'C:/Windows/Fonts/arial.ttf',
+]
+
+
+class ExportDependencyError(Exception):
+    """Липсва незадължителна библиотека, нужна за избрания формат."""
+
+
+class ListCursor:
+    """Готов списък от редове (напр. от кеша на справките) с интерфейса 'fetchmany' на курсор."""
+
+    def __init__(self, rows):
+        self._rows = rows
+        self._pos = 0
+
+    def fetchmany(self, size):
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+
+class MappedCursor:
+    """Курсор, чиито редове се преобразуват с 'fn' при четене на порция."""
+
+    def __init__(self, cursor, fn):
+        self._cursor = cursor
+        self._fn = fn
+
+    def fetchmany(self, size):
+        return [self._fn(row) for row in self._cursor.fetchmany(size)]
+
+
+def iter_rows(cursor):
+    """Обхожда курсора на порции от CHUNK_ROWS реда."""
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            break
+        yield from rows
+
+
+def _cell(value):
+    return '' if value is None else value
+
+
+# --- CSV ---
+
+def _csv_stream(sections):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    # BOM (utf-8-sig) за правилна работа с кирилица в Excel - само в началото на файла
+    yield '\ufeff'.encode('utf-8')
+    for index, section in enumerate(sections):
+        if len(sections) > 1:
+            if index:
+                writer.writerow([])
+            writer.writerow([section.title])
+        writer.writerow(section.headers)
+        while True:
+            rows = section.cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            writer.writerows(rows)
+            yield flush()
+    yield flush()
+
+
+# --- XLSX (openpyxl, write-only) ---
+
+def _write_xlsx(sections, title, period_text, out):
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ExportDependencyError("Липсва библиотеката openpyxl (pip install openpyxl).")
+
+    # В режим write-only редовете не се пазят в паметта след записа им
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=title[:31])
+    ws.append([title])
+    ws.append(['Период', period_text])
+    for section in sections:
+        ws.append([])
+        if section.title:
+            ws.append([section.title])
+        ws.append(section.headers)
+        for row in iter_rows(section.cursor):
+            ws.append([_cell(value) for value in row])
+    wb.save(out)
+
+
+# --- PDF (reportlab, ред по ред върху страницата) ---
+
+def _pdf_font():
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    path = current_app.config.get('EXPORT_PDF_FONT')
+    for candidate in ([path] if path else []) + PDF_FONT_CANDIDATES:
+        if candidate and os.path.exists(candidate):
+            if 'ExportFont' not in pdfmetrics.getRegisteredFontNames():
+                pdfmetrics.registerFont(TTFont('ExportFont', candidate))
+            return 'ExportFont'
+    return 'Helvetica'
+
+
+def _write_pdf(sections, title, period_text, out):
+    try:
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        from reportlab.pdfgen import canvas
+    except ImportError:
+        raise ExportDependencyError("Липсва библиотеката reportlab (pip install reportlab).")
+
+    # Страниците се рисуват директно с canvas - без списък от flowables в паметта
+    font = _pdf_font()
+    width, height = landscape(A4)
+    margin, line_height, font_size = 36, 14, 9
+    pdf = canvas.Canvas(out, pagesize=(width, height))
+    pdf.setTitle(title)
+    state = {'y': height - margin}
+
+    def new_page():
+        pdf.showPage()
+        state['y'] = height - margin
+
+    def line(values, widths, bold=False):
+        if state['y'] < margin:
+            new_page()
+        pdf.setFont(font, font_size + (1 if bold else 0))
+        x = margin
+        for value, col_width in zip(values, widths):
+            text = str(_cell(value))
+            # Съкращаваме текста, който не се събира в колоната
+            while text and stringWidth(text, font, font_size) > col_width - 4:
+                text = text[:-1]
+            pdf.drawString(x, state['y'], text)
+            x += col_width
+        state['y'] -= line_height
+
+    usable = width - 2 * margin
+    line([title], [usable], bold=True)
+    line([f"Период: {period_text}"], [usable])
+    for section in sections:
+        state['y'] -= line_height / 2
+        if section.title:
+            line([section.title], [usable], bold=True)
+        widths = [usable / len(section.headers)] * len(section.headers)
+        line(section.headers, widths, bold=True)
+        for row in iter_rows(section.cursor):
+            line(row, widths)
+    pdf.save()
+
+
+_FILE_WRITERS = {'xlsx': _write_xlsx, 'pdf': _write_pdf}
+
+# Библиотека, нужна за всеки файлов формат
+_DEPENDENCIES = {'xlsx': 'openpyxl', 'pdf': 'reportlab'}
+
+
+def check_export_dependency(fmt):
+    """Проверява предварително (преди да се пусне задача) дали библиотеката за формата е налична."""
+    module = _DEPENDENCIES.get(fmt)
+    if module and importlib.util.find_spec(module) is None:
+        raise ExportDependencyError(f"Липсва библиотеката {module} (pip install {module}).")
+
+
+def write_export(sections, fmt, title, period_text, out):
+    """Записва справката във файлов формат ('xlsx' или 'pdf') в отворения файл 'out'."""
+    _FILE_WRITERS[fmt](sections, title, period_text, out)
+
+
+def _send_file_chunks(spool):
+    try:
+        spool.seek(0)
+        while True:
+            chunk = spool.read(SEND_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        spool.close()
+
+
+def export_response(sections, fmt, title, period_text, filename):
+    """
+    Връща HTTP Response със справката във формат 'csv', 'xlsx' или 'pdf'.
+    При липсваща библиотека за формата хвърля ExportDependencyError.
+    """
+    headers = {"Content-Disposition": f"attachment;filename={filename}.{fmt}"}
+    if fmt == 'csv':
+        # stream_with_context задържа контекста (и връзката от пула) до края на потока
+        return Response(stream_with_context(_csv_stream(sections)), mimetype=FORMATS[fmt], headers=headers)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=current_app.config['EXPORT_SPOOL_MAX_BYTES'])
+    try:
+        write_export(sections, fmt, title, period_text, spool)
+    except Exception:
+        spool.close()
+        raise
+    headers['Content-Length'] = str(spool.tell())
+    return Response(_send_file_chunks(spool), mimetype=FORMATS[fmt], headers=headers)
@@ -0,0 +1,95 @@
+# application/fines.py
+
+from datetime import datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from .database import get_db
+from .utils import fine_sql, get_fine_rate
+
+# Глобите по отворените заемания се начисляват наведнъж за всички редове
+# (колони 'accrued_fine'/'accrued_on' в 'borrows') - веднъж на ден от фонова
+# задача и при смяна на глобата на ден. Таблото, профилът на читателя и
+# страницата за връщане четат готовите суми вместо да ги смятат ред по ред.
+# Окончателната глоба при връщане остава в 'fine_amount'.
+
+_ACCRUE_SQL = f"""
+    UPDATE borrows SET accrued_fine = {fine_sql('due_date')}, accrued_on = date('now', 'localtime')
+    WHERE return_date IS NULL
+"""
+
+# Дължимо по читател: неплатени глоби за върнати книги + начислени по отворени заемания
+_READER_TOTALS_SQL = """
+    SELECT r.reader_no, r.full_name, SUM(t.unpaid_fine) AS unpaid_fine, SUM(t.accrued_fine) AS accrued_fine,
+           SUM(t.unpaid_fine + t.accrued_fine) AS total_fine
+    FROM (
+        SELECT reader_no, fine_amount AS unpaid_fine, 0 AS accrued_fine FROM borrows
+        WHERE fine_amount > 0 AND fine_paid_date IS NULL {reader_filter}
+        UNION ALL
+        SELECT reader_no, 0, accrued_fine FROM borrows
+        WHERE accrued_fine > 0 AND return_date IS NULL {reader_filter}
+    ) t
+    JOIN readers r ON r.reader_no = t.reader_no
+    GROUP BY r.reader_no
+"""
+
+
+def accrue_fines(conn, force=False):
+    """
+    Преизчислява начислената глоба за всички отворени заемания с една заявка.
+    Без 'force' се пропускат заеманията, обновени вече днес. Връща броя обновени редове.
+    """
+    sql = _ACCRUE_SQL if force else _ACCRUE_SQL + " AND accrued_on IS NOT date('now', 'localtime')"
+    return conn.execute(sql, (get_fine_rate(),)).rowcount
+
+
+def reader_fine_totals(conn, reader_no=None):
+    """Връща дължимите суми по читател (или само за един читател), подредени по общата сума."""
+    if reader_no is not None:
+        return conn.execute(_READER_TOTALS_SQL.format(reader_filter="AND reader_no = ?"), (reader_no, reader_no)).fetchone()
+    return conn.execute(_READER_TOTALS_SQL.format(reader_filter="") + " ORDER BY total_fine DESC").fetchall()
+
+
+def _seconds_until(at_time):
+    """Секунди до следващото настъпване на час 'HH:MM' (местно време)."""
+    hour, minute = (int(part) for part in at_time.split(':'))
+    now = datetime.now()
+    next_run = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if next_run <= now:
+        next_run += timedelta(days=1)
+    return (next_run - now).total_seconds()
+
+
+def _accrual_loop(app):
+    from .extensions import socketio
+    while True:
+        try:
+            with app.app_context():
+                conn = get_db()
+                updated = accrue_fines(conn)
+                conn.commit()
+            print(f"--- INFO: Начислени глоби за {updated} отворени заемания ---")
+        except Exception as e:
+            print(f"!!! Грешка при начисляване на глобите: {e}")
+        socketio.sleep(_seconds_until(app.config['FINE_ACCRUAL_TIME']))
+
+
+def start_fine_accrual(app):
+    """
+    Стартира фоновата задача за начисляване: веднага (ако днес още не е минала)
+    и след това всеки ден в 'FINE_ACCRUAL_TIME'.
+    """
+    from .extensions import socketio
+    if app.extensions.get('fine_accrual'):
+        return
+    app.extensions['fine_accrual'] = socketio.start_background_task(_accrual_loop, app)
+
+
+@click.command('accrue-fines')
+@click.option('--force', is_flag=True, help='Преизчислява и вече обновените днес заемания.')
+@with_appcontext
+def accrue_fines_command(force):
+    """Команда 'flask accrue-fines' - начислява глобите по отворените заемания."""
+    conn = get_db()
+    updated = accrue_fines(conn, force=force)
+    conn.commit()
+    click.echo(f"Обновени заемания: {updated}")
@@ -0,0 +1,315 @@
+# application/imports.py
+
+import codecs
+import csv
+import itertools
+import os
+from contextlib import contextmanager
+from datetime import date
+from .database import write_transaction
+from .utils import clean_int, clean_date, clean_price
+
+# Масов импорт от CSV. Файлът се чете като поток (без да се зарежда целия
+# в паметта), редовете се проверяват в Python и се записват на порции с
+# 'executemany' във временна таблица, след което се прехвърлят в основната
+# таблица с една заявка. Всяка порция е отделна транзакция, в която се записва
+# и точката на възобновяване (брой обработени редове), така че прекъснат
+# импорт продължава от последната записана порция. Тригерите, които
+# поддържат пълнотекстовия индекс ред по ред, се спират по време на записа и
+# индексът се допълва само с новите редове.
+
+# Брой редове в една порция 'executemany'
+BATCH_ROWS = 5000
+# Размер на блоковете при проверката на кодировката
+_SNIFF_CHUNK_BYTES = 1024 * 1024
+
+
+def _sniff_upload(path):
+    """Определя кодировката (UTF-8 или Windows-1251) и броя редове, без да пази файла в паметта."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    encoding, lines, last = 'utf-8-sig', 0, b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_SNIFF_CHUNK_BYTES)
+            if not chunk:
+                break
+            lines += chunk.count(b'\n')
+            last = chunk[-1:]
+            if encoding == 'utf-8-sig':
+                try:
+                    decoder.decode(chunk)
+                except UnicodeDecodeError:
+                    encoding = 'windows-1251'
+    # Последният ред може да е без знак за нов ред
+    return encoding, lines + (last != b'\n')
+
+
+def iter_csv_upload(path):
+    """
+    Връща (брой редове, итератор по редовете без заглавния). Разделителят се
+    определя от първия ред, както при досегашния импорт.
+    """
+    encoding, lines = _sniff_upload(path)
+
+    def rows():
+        with open(path, encoding=encoding, newline='') as f:
+            header = f.readline()
+            if not header:
+                return
+            reader = csv.reader(f, csv.Sniffer().sniff(header))
+            yield from reader
+
+    return max(lines - 1, 0), rows()
+
+
+def batched(iterable, size=BATCH_ROWS):
+    """Групира елементите на порции от 'size'."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@contextmanager
+def suspended_triggers(conn, *names):
+    """
+    Спира временно тригерите с дадените имена и ги създава наново след блока.
+    Трябва да се ползва в отворена транзакция - ако нещо се провали, 'rollback'
+    връща и тригерите.
+    """
+    saved = conn.execute(
+        f"SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN ({', '.join('?' * len(names))})",
+        names
+    ).fetchall()
+    for row in saved:
+        conn.execute(f"DROP TRIGGER {row['name']}")
+    yield
+    for row in saved:
+        conn.execute(row['sql'])
+
+
+def import_in_batches(conn, rows, load_batch, state=None, save_checkpoint=None):
+    """
+    Импортира редовете на порции - всяка в отделна транзакция. 'load_batch(conn,
+    порция, номер на първия ред)' записва порцията и връща (добавени, грешки).
+    'state' е точката на възобновяване ({'rows', 'added', 'errors'}) - вече
+    обработените редове се пропускат. 'save_checkpoint(state)' се вика преди
+    'commit' на всяка порция. След всяка порция връща (state, грешките в нея).
+    """
+    state = {'rows': 0, 'added': 0, 'errors': 0, **(state or {})}
+    for batch in batched(itertools.islice(rows, state['rows'], None)):
+        with write_transaction(conn):
+            added, errors = load_batch(conn, batch, state['rows'] + 2)
+            state = {'rows': state['rows'] + len(batch), 'added': state['added'] + added,
+                     'errors': state['errors'] + len(errors)}
+            if save_checkpoint:
+                save_checkpoint(state)
+        yield state, errors
+
+
+def append_error_report(errors, path):
+    """Добавя пропуснатите редове към отчета (CSV: ред, причина, данни)."""
+    if not errors:
+        return
+    new_file = not os.path.exists(path)
+    with open(path, 'a', encoding='utf-8-sig' if new_file else 'utf-8', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(['Ред', 'Причина', 'Данни'])
+        for line, reason, row in errors:
+            writer.writerow([line, reason, '' if row is None else ';'.join(row)])
+
+
+def run_csv_import(ctx, load_batch, report_name):
+    """
+    Изпълнява импорт на качения файл ('ctx.params['path']') като фонова задача:
+    продължава от точката на възобновяване, отчита прогреса и пише отчета с
+    пропуснатите редове. Връща крайното състояние ({'rows', 'added', 'errors'}).
+    """
+    path = ctx.params['path']
+    total, rows = iter_csv_upload(path)
+    report_path = ctx.result_file(report_name)
+    state = {'rows': 0, 'added': 0, 'errors': 0, **ctx.checkpoint}
+    ctx.progress(state['rows'], total, "Запис на порциите" if not state['rows'] else f"Продължава от ред {state['rows'] + 2}")
+    for state, errors in import_in_batches(ctx.conn, rows, load_batch, state, ctx.save_checkpoint):
+        append_error_report(errors, report_path)
+        ctx.progress(state['rows'])
+    if not os.path.exists(report_path):
+        ctx.set_result(None, None)
+    os.remove(path)
+    return state
+
+
+# --- Книги ---
+
+_STAGE_BOOKS_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS import_books (
+        tom_no TEXT PRIMARY KEY, isbn TEXT, author TEXT, title TEXT, genre TEXT,
+        publish_year INT, record_date DATE, price DECIMAL(10, 2), line INT
+    )
+"""
+
+
+def _book_params(row):
+    """
+    Проверява реда от CSV и връща параметрите за запис (или None за празен ред).
+    При невалиден ред хвърля ValueError с причината - тя влиза в отчета за грешките.
+    """
+    if not any(value.strip() for value in row):
+        return None
+    if len(row) < 8:
+        raise ValueError(f"очаквани са поне 8 колони, а са {len(row)}")
+    tom_no, isbn, author, title, genre, publish_year, record_date, price = row[:8]
+    tom_no = tom_no.strip()
+    if not tom_no or not title.strip():
+        raise ValueError("липсва инвентарен номер или заглавие")
+    if not tom_no.isdigit():
+        # Инвентарният номер е rowid в 'books_fts' и трябва да е цяло число
+        raise ValueError(f"невалиден инвентарен номер '{tom_no}'")
+    return (tom_no, isbn, author, title, genre, clean_int(publish_year), clean_date(record_date), clean_price(price))
+
+
+def book_batch_loader():
+    """
+    Връща функция за 'import_in_batches', която записва порция книги.
+    Съществуващите инвентарни номера се пропускат (както 'INSERT OR IGNORE').
+    """
+    genres = set()
+
+    def load_batch(conn, batch, first_line):
+        params, errors = [], []
+        for line, row in enumerate(batch, start=first_line):
+            try:
+                book = _book_params(row)
+            except ValueError as row_error:
+                errors.append((line, str(row_error), row))
+                continue
+            if book:
+                params.append(book + (line,))
+        conn.execute(_STAGE_BOOKS_SQL)
+        conn.execute("DELETE FROM temp.import_books")
+        conn.executemany("INSERT OR IGNORE INTO temp.import_books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", params)
+
+        # Остават само новите книги - те се записват и индексират
+        conn.execute("DELETE FROM temp.import_books WHERE tom_no IN (SELECT tom_no FROM books)")
+        with suspended_triggers(conn, 'books_after_insert'):
+            added = conn.execute(
+                "INSERT INTO books (tom_no, isbn, author, title, genre, publish_year, record_date, price) "
+                "SELECT tom_no, isbn, author, title, genre, publish_year, record_date, price FROM temp.import_books ORDER BY line"
+            ).rowcount
+            conn.execute(
+                "INSERT INTO books_fts(rowid, tom_no, title, author) "
+                "SELECT tom_no, tom_no, title, author FROM temp.import_books"
+            )
+        new_genres = {book[4].strip() for book in params if book[4] and book[4].strip()} - genres
+        conn.executemany("INSERT OR IGNORE INTO genres (name) VALUES (?)", ((genre,) for genre in sorted(new_genres)))
+        genres.update(new_genres)
+        return added, errors
+
+    return load_batch
+
+
+# --- Читатели ---
+
+READER_COLUMNS = ('reader_no', 'full_name', 'city', 'address', 'phone', 'email', 'profession',
+                  'education', 'gender', 'registration_date', 'is_under_14')
+
+_STAGE_READERS_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS import_readers (
+        reader_no TEXT PRIMARY KEY, full_name TEXT, city TEXT, address TEXT, phone TEXT, email TEXT,
+        profession TEXT, education TEXT, gender TEXT, registration_date DATE, is_under_14 BOOLEAN,
+        last_registration_year INT, line INT
+    )
+"""
+
+# Сравнение като 'COLLATE NOCASE' в SQLite - без значение от главни/малки само за латиница
+_NOCASE = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+class LookupValues:
+    """
+    Номенклатура (професии, образования), заредена в паметта за целия импорт.
+    Стойностите се нормализират както в 'add_new_entry'; новите се записват с порцията.
+    """
+
+    def __init__(self, conn, table_name):
+        self.table_name = table_name
+        self.known = {row['name'].translate(_NOCASE) for row in conn.execute(f"SELECT name FROM {table_name}")}
+        self.new = []
+
+    def normalize(self, value):
+        if not value or not value.strip():
+            return None
+        formatted_value = value.strip().capitalize()
+        key = formatted_value.translate(_NOCASE)
+        if key not in self.known:
+            self.known.add(key)
+            self.new.append(formatted_value)
+        return formatted_value
+
+    def save(self, conn):
+        conn.executemany(f"INSERT OR IGNORE INTO {self.table_name} (name) VALUES (?)", ((name,) for name in self.new))
+        self.new = []
+
+
+def reader_batch_loader(conn):
+    """
+    Връща функция за 'import_in_batches', която записва порция читатели.
+    Грешките са (ред във файла, причина, данни) - за невалидни редове и за
+    повтарящи се или вече съществуващи читателски номера.
+    """
+    professions, educations = LookupValues(conn, 'professions'), LookupValues(conn, 'educations')
+    seen = set()
+
+    def load_batch(conn, batch, first_line):
+        params, errors = [], []
+        for line, row in enumerate(batch, start=first_line):
+            if not any(value.strip() for value in row):
+                continue
+            if len(row) != len(READER_COLUMNS):
+                errors.append((line, f"очаквани са {len(READER_COLUMNS)} колони, а са {len(row)}", row)); continue
+            reader_no, full_name, city, address, phone, email, profession, education, gender, registration_date, is_under_14 = row
+            reader_no = reader_no.strip()
+            if not reader_no or not full_name.strip():
+                errors.append((line, "липсва читателски номер или име", row)); continue
+            if reader_no in seen:
+                errors.append((line, f"читателски № {reader_no} се повтаря във файла", row)); continue
+            seen.add(reader_no)
+
+            cleaned_date = clean_date(registration_date)
+            reg_year = clean_int(cleaned_date[:4]) if cleaned_date else date.today().year
+            is_under_14_bool = 1 if is_under_14.strip().lower() in ['да', 'yes', 'true', '1'] else 0
+            params.append((reader_no, full_name, city, address, phone, email, professions.normalize(profession),
+                           educations.normalize(education), gender, cleaned_date, is_under_14_bool, reg_year, line))
+        conn.execute(_STAGE_READERS_SQL)
+        conn.execute("DELETE FROM temp.import_readers")
+        conn.executemany("INSERT INTO temp.import_readers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", params)
+
+        # Съществуващите читатели се пропускат (както досега), но влизат в отчета
+        existing = conn.execute(
+            "SELECT s.line, s.reader_no FROM temp.import_readers s JOIN readers r ON r.reader_no = s.reader_no"
+        ).fetchall()
+        errors += [(row['line'], f"читател № {row['reader_no']} вече съществува", None) for row in existing]
+        conn.execute("DELETE FROM temp.import_readers WHERE reader_no IN (SELECT reader_no FROM readers)")
+
+        professions.save(conn)
+        educations.save(conn)
+        with suspended_triggers(conn, 'readers_after_insert'):
+            added = conn.execute(
+                "INSERT INTO readers (reader_no, full_name, city, address, phone, email, profession, education, gender, "
+                "registration_date, is_under_14, last_registration_year) "
+                "SELECT reader_no, full_name, city, address, phone, email, profession, education, gender, "
+                "registration_date, is_under_14, last_registration_year FROM temp.import_readers ORDER BY line"
+            ).rowcount
+            conn.execute(
+                "INSERT INTO readers_fts(rowid, reader_no, full_name, phone, email, city) "
+                "SELECT r.rowid, r.reader_no, r.full_name, r.phone, r.email, r.city "
+                "FROM temp.import_readers s JOIN readers r ON r.reader_no = s.reader_no"
+            )
+        return added, sorted(errors, key=lambda error: error[0])
+
+    return load_batch
@@ -0,0 +1,352 @@
+# application/jobs.py
+
+import json
+import os
+import time
+import uuid
+from collections import namedtuple
+from flask import current_app, session
+from .database import get_db
+from .extensions import socketio
+from .websockets import STAFF_ROOM
+
+# Тежките операции (импорт, експорт в XLSX/PDF, архив, поддръжка на индексите)
+# се изпълняват като фонови задачи. Задачата се записва в таблицата 'jobs',
+# диспечерът (зелена нишка в основния процес) я взима от опашката и я пуска в
+# истинска нишка през 'eventlet.tpool', така че блокиращите SQLite извиквания
+# не спират останалите заявки и Socket.IO. Прогресът се изпраща до служебните
+# екрани като събитие 'job_progress', а резултатът (ако има) се сваля от '/jobs'.
+
+JobHandler = namedtuple('JobHandler', ['kind', 'title', 'fn', 'resumable'])
+
+JOB_HANDLERS = {}
+
+
+def job(kind, title, resumable=False):
+    """
+    Декоратор, който регистрира функция като изпълнител на задачи от даден вид.
+    'resumable' задачи пазят точка на възобновяване ('ctx.save_checkpoint') и
+    след прекъсване продължават от нея, вместо да се отбележат като неуспешни.
+    """
+    def decorator(fn):
+        if kind in JOB_HANDLERS:
+            raise ValueError(f"Дублиран вид задача: {kind}")
+        JOB_HANDLERS[kind] = JobHandler(kind, title, fn, resumable)
+        return fn
+    return decorator
+
+
+class JobContext:
+    """
+    Подава се на изпълнителя на задачата. Има собствена връзка към базата
+    ('conn'), параметрите на задачата и методи за прогрес и файл с резултат.
+    """
+
+    def __init__(self, app, job_row, conn, progress):
+        self.app = app
+        self.job_id = job_row['id']
+        self.params = json.loads(job_row['params'] or '{}')
+        self.checkpoint = json.loads(job_row['checkpoint'] or '{}')
+        self.username = job_row['created_by'] or 'System'
+        self.conn = conn
+        self.result_path = None
+        self.result_name = None
+        self.message = None
+        self._progress = progress
+        self._done = 0
+        self._total = None
+
+    def progress(self, done, total=None, message=None):
+        """Отбелязва напредъка; изпраща се към екраните от диспечера."""
+        self._done = done
+        if total is not None:
+            self._total = total
+        if message is not None:
+            self.message = message
+        self._progress[self.job_id] = (self._done, self._total, self.message)
+
+    def save_checkpoint(self, state):
+        """
+        Записва състоянието след обработена порция. Вика се в транзакцията на
+        порцията, за да се запише заедно с данните (или изобщо да не се запише).
+        """
+        self.checkpoint = state
+        self.conn.execute("UPDATE jobs SET checkpoint = ? WHERE id = ?", (json.dumps(state), self.job_id))
+
+    def result_file(self, filename):
+        """Връща път за файла с резултата, който потребителят ще може да свали."""
+        folder = jobs_folder(self.app)
+        self.result_name = filename
+        self.result_path = os.path.join(folder, f"{self.job_id}_{filename}")
+        return self.result_path
+
+    def set_result(self, path, filename):
+        """Записва вече създаден файл като резултат на задачата."""
+        self.result_path, self.result_name = path, filename
+
+    def log(self, action, details=""):
+        """Записва в системния лог от името на потребителя, пуснал задачата."""
+        self.conn.execute(
+            "INSERT INTO activity_log (timestamp, username, action, details) VALUES (datetime('now', 'localtime'), ?, ?, ?)",
+            (self.username, action, details)
+        )
+
+    def track(self, cursor, message=None):
+        """Обвива курсор, така че всеки прочетен блок редове се отчита като прогрес."""
+        return _TrackedCursor(cursor, self, message)
+
+
+class _TrackedCursor:
+    def __init__(self, cursor, ctx, message):
+        self.cursor, self.ctx, self.message = cursor, ctx, message
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        self.ctx.progress(self.ctx._done + len(rows), message=self.message)
+        return rows
+
+
+def jobs_folder(app=None):
+    app = app or current_app
+    return os.path.abspath(os.path.join(app.root_path, '..', app.config['JOBS_FOLDER']))
+
+
+def save_upload(file_storage):
+    """Запазва качен файл в папката на задачите и връща пътя до него."""
+    folder = os.path.join(jobs_folder(), 'uploads')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{uuid.uuid4().hex}.upload")
+    file_storage.save(path)
+    return path
+
+
+# --- Изпълнение ---
+
+class JobRunner:
+    """Диспечер на опашката за едно приложение (в 'app.extensions['jobs']')."""
+
+    def __init__(self, app):
+        self.app = app
+        self.running = set()
+        self.progress = {}
+        self._sent = {}
+
+    def start(self):
+        socketio.start_background_task(self._loop)
+
+    def _loop(self):
+        with self.app.app_context():
+            conn = get_db()
+            # Прекъснатите задачи продължават от точката си на възобновяване, ако имат такава
+            resumable = [kind for kind, handler in JOB_HANDLERS.items() if handler.resumable]
+            conn.execute(
+                f"UPDATE jobs SET status = 'queued' WHERE status = 'running' AND kind IN ({', '.join('?' * len(resumable))})",
+                resumable
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Прекъсната при рестарт на приложението', "
+                "finished_at = CURRENT_TIMESTAMP WHERE status = 'running'"
+            )
+            conn.commit()
+        while True:
+            try:
+                with self.app.app_context():
+                    conn = get_db()
+                    while len(self.running) < self.app.config['JOB_WORKERS']:
+                        job_row = _claim_next(conn)
+                        if job_row is None:
+                            break
+                        self.running.add(job_row['id'])
+                        emit_job(conn, job_row['id'])
+                        socketio.start_background_task(self._run, job_row['id'])
+                    self._push_progress(conn)
+            except Exception as e:
+                print(f"!!! Грешка в диспечера на фоновите задачи: {e}")
+            socketio.sleep(self.app.config['JOB_POLL_SECONDS'])
+
+    def _run(self, job_id):
+        from eventlet import tpool
+        try:
+            # Самата задача е в истинска нишка - зелената само чака резултата
+            tpool.execute(execute_job, self.app, job_id, self.progress)
+        finally:
+            self.running.discard(job_id)
+            self.progress.pop(job_id, None)
+            self._sent.pop(job_id, None)
+            with self.app.app_context():
+                emit_job(get_db(), job_id)
+
+    def _push_progress(self, conn):
+        for job_id, state in list(self.progress.items()):
+            if self._sent.get(job_id) == state:
+                continue
+            self._sent[job_id] = state
+            done, total, message = state
+            conn.execute("UPDATE jobs SET progress = ?, total = ?, message = ? WHERE id = ?", (done, total, message, job_id))
+            conn.commit()
+            emit_job(conn, job_id)
+
+
+def _claim_next(conn):
+    row = conn.execute(
+        "UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP "
+        "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1) "
+        "RETURNING id"
+    ).fetchone()
+    conn.commit()
+    return row
+
+
+def execute_job(app, job_id, progress):
+    """Изпълнява задачата със собствена връзка (вика се в отделна нишка)."""
+    conn = app.extensions['db_pool'].open_connection()
+    try:
+        with app.app_context():
+            job_row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            handler = JOB_HANDLERS.get(job_row['kind'])
+            ctx = JobContext(app, job_row, conn, progress)
+            started = time.monotonic()
+            try:
+                if handler is None:
+                    raise ValueError(f"Непознат вид задача: {job_row['kind']}")
+                handler.fn(ctx)
+                conn.commit()
+                conn.execute(
+                    "UPDATE jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, progress = ?, total = ?, "
+                    "message = ?, result_path = ?, result_name = ? WHERE id = ?",
+                    (ctx._done, ctx._total, ctx.message, ctx.result_path, ctx.result_name, job_id)
+                )
+                print(f"--- INFO: Задача {job_id} ({job_row['kind']}) завърши за {time.monotonic() - started:.1f} сек. ---")
+            except Exception as e:
+                conn.rollback()
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP, error = ? WHERE id = ?",
+                    (str(e), job_id)
+                )
+                print(f"!!! Задача {job_id} ({job_row['kind']}) се провали: {e}")
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def job_dict(row):
+    data = dict(row)
+    data.pop('result_path', None)
+    data.pop('params', None)
+    data.pop('checkpoint', None)
+    handler = JOB_HANDLERS.get(row['kind'])
+    data['resumable'] = bool(handler and handler.resumable and row['status'] == 'failed')
+    return data
+
+
+def resume_job(conn, job_id):
+    """Връща неуспешна възобновяема задача в опашката; тя продължава от последната си точка."""
+    row = conn.execute("SELECT kind, status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    handler = JOB_HANDLERS.get(row['kind']) if row else None
+    if not handler or not handler.resumable or row['status'] != 'failed':
+        return False
+    conn.execute("UPDATE jobs SET status = 'queued', error = NULL, finished_at = NULL WHERE id = ?", (job_id,))
+    conn.commit()
+    if 'jobs' not in current_app.extensions:
+        _run_inline(conn, job_id)
+    return True
+
+
+def emit_job(conn, job_id):
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row:
+        socketio.emit('job_progress', job_dict(row), to=STAFF_ROOM)
+
+
+def start_job_runner(app):
+    """Стартира диспечера на фоновите задачи в текущия процес."""
+    if 'jobs' in app.extensions:
+        return
+    runner = JobRunner(app)
+    app.extensions['jobs'] = runner
+    runner.start()
+
+
+def submit_job(kind, params=None, title=None):
+    """
+    Добавя задача в опашката и връща номера ѝ. Ако в процеса няма стартиран
+    диспечер (напр. при 'flask run' или тестове), задачата се изпълнява веднага.
+    """
+    handler = JOB_HANDLERS[kind]
+    conn = get_db()
+    job_id = conn.execute(
+        "INSERT INTO jobs (kind, title, params, created_by) VALUES (?, ?, ?, ?)",
+        (kind, title or handler.title, json.dumps(params or {}, ensure_ascii=False), session.get('username', 'System'))
+    ).lastrowid
+    conn.commit()
+    if 'jobs' not in current_app.extensions:
+        _run_inline(conn, job_id)
+    return job_id
+
+
+def _run_inline(conn, job_id):
+    conn.execute("UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+    conn.commit()
+    execute_job(current_app._get_current_object(), job_id, {})
+
+
+# --- Задачи за поддръжка ---
+
+@job('backup', 'Архивно копие на базата')
+def _backup_job(ctx):
+    from backup_db import create_backup
+    from .activity import archive_path_for
+    db_path = ctx.app.config['DATABASE']
+    # Старите записи от дневника са само в архивната база - копира се и тя
+    archive_path = ctx.app.config['ACTIVITY_ARCHIVE_DATABASE'] or archive_path_for(db_path)
+    backups_dir = os.path.join(os.path.dirname(os.path.abspath(db_path)), 'backups')
+
+    def on_progress(remaining, total):
+        ctx.progress(total - remaining, total, "Копиране на страниците")
+
+    path = create_backup(db_path, backups_dir, progress=on_progress, archive_path=archive_path)
+    ctx.set_result(path, os.path.basename(path))
+    ctx.log("Архивно копие", os.path.basename(path))
+
+
+@job('rebuild_fts', 'Преизграждане на индексите за търсене')
+def _rebuild_fts_job(ctx):
+    for step, table in enumerate(('books_fts', 'readers_fts'), start=1):
+        ctx.progress(step - 1, 2, f"Преизграждане на {table}")
+        ctx.conn.execute(f"INSERT INTO {table}({table}) VALUES('rebuild')")
+        ctx.conn.execute(f"INSERT INTO {table}({table}) VALUES('optimize')")
+        ctx.conn.commit()
+    ctx.progress(2, 2, "Готово")
+    ctx.log("Поддръжка", "Преизградени индекси за търсене")
+
+
+@job('optimize', 'Оптимизация на базата и почистване')
+def _optimize_job(ctx):
+    ctx.progress(0, 3, "PRAGMA optimize")
+    ctx.conn.execute("PRAGMA optimize")
+    ctx.progress(1, 3, "Checkpoint на WAL журнала")
+    ctx.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    ctx.progress(2, 3, "Изтриване на стари резултати")
+    # Файловете с резултати и качените файлове се пазят JOB_RESULT_DAYS дни
+    cutoff = time.time() - ctx.app.config['JOB_RESULT_DAYS'] * 86400
+    removed = 0
+    for root, _, files in os.walk(jobs_folder(ctx.app)):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+    days = f"-{int(ctx.app.config['JOB_RESULT_DAYS'])} days"
+    ctx.conn.execute("UPDATE jobs SET result_path = NULL WHERE result_path IS NOT NULL AND finished_at < datetime('now', ?)", (days,))
+    ctx.conn.execute("DELETE FROM uploads WHERE created_at < datetime('now', ?)", (days,))
+    ctx.progress(3, 3, f"Изтрити файлове: {removed}")
+    ctx.log("Поддръжка", f"Оптимизация на базата, изтрити стари файлове: {removed}")
+
+
+@job('archive_activity', 'Архивиране на стария дневник на дейността')
+def _archive_activity_job(ctx):
+    from .activity import archive_activity
+    days = ctx.app.config['ACTIVITY_ARCHIVE_DAYS']
+    ctx.progress(0, None, f"Записи, по-стари от {days} дни")
+    moved = archive_activity(ctx.conn, days, progress=lambda done, total: ctx.progress(done, total, "Преместване в архивната база"))
+    ctx.log("Поддръжка", f"Преместени в архива записи от дневника: {moved}")
@@ -0,0 +1,120 @@
+# application/loans.py
+
+import click
+from flask.cli import with_appcontext
+from .database import get_db
+
+# Текущото заемане на всяка книга (borrow_id, читател, срок) се пази в
+# колоните 'current_*' на 'books', така че наличността е четене по първичен ключ.
+# Поддържа се от тригери върху 'borrows'; при съмнение се проверява и
+# възстановява с 'flask check-loan-state'.
+
+# Преизчислява състоянието на книгите, чиито инв. № са в WHERE условието
+_RECOMPUTE = """
+    UPDATE books SET (current_borrow_id, current_reader_no, current_due_date) = (
+        SELECT br.borrow_id, br.reader_no, br.due_date FROM borrows br
+        WHERE br.book_tom_no = books.tom_no AND br.return_date IS NULL
+        ORDER BY br.borrow_id DESC LIMIT 1
+    )
+"""
+
+LOAN_STATE_TRIGGERS = f"""
+    CREATE TRIGGER IF NOT EXISTS borrows_loan_after_insert AFTER INSERT ON borrows WHEN new.return_date IS NULL BEGIN
+        {_RECOMPUTE} WHERE tom_no = new.book_tom_no;
+    END;
+    CREATE TRIGGER IF NOT EXISTS borrows_loan_after_update AFTER UPDATE OF book_tom_no, reader_no, due_date, return_date ON borrows BEGIN
+        {_RECOMPUTE} WHERE tom_no IN (old.book_tom_no, new.book_tom_no);
+    END;
+    CREATE TRIGGER IF NOT EXISTS borrows_loan_after_delete AFTER DELETE ON borrows WHEN old.return_date IS NULL BEGIN
+        {_RECOMPUTE} WHERE tom_no = old.book_tom_no;
+    END;
+"""
+
+_MISMATCHES_SQL = """
+    SELECT b.tom_no, b.current_borrow_id, b.current_reader_no, b.current_due_date,
+           o.borrow_id, o.reader_no, o.due_date
+    FROM books b
+    LEFT JOIN (
+        SELECT book_tom_no, borrow_id, reader_no, due_date FROM borrows br
+        WHERE return_date IS NULL AND borrow_id = (
+            SELECT MAX(borrow_id) FROM borrows WHERE book_tom_no = br.book_tom_no AND return_date IS NULL
+        )
+    ) o ON o.book_tom_no = b.tom_no
+    WHERE b.current_borrow_id IS NOT o.borrow_id
+       OR b.current_reader_no IS NOT o.reader_no
+       OR b.current_due_date IS NOT o.due_date
+"""
+
+
+# Отворени заемания на книга, която има и по-ново отворено заемане
+_DUPLICATE_OPEN_LOANS_SQL = """
+    SELECT br.borrow_id, br.book_tom_no, br.reader_no, br.borrow_date, (
+        SELECT MIN(later.borrow_date) FROM borrows later
+        WHERE later.book_tom_no = br.book_tom_no AND later.return_date IS NULL AND later.borrow_id > br.borrow_id
+    ) AS next_borrow_date
+    FROM borrows br
+    WHERE br.return_date IS NULL AND EXISTS (
+        SELECT 1 FROM borrows later
+        WHERE later.book_tom_no = br.book_tom_no AND later.return_date IS NULL AND later.borrow_id > br.borrow_id
+    )
+    ORDER BY br.book_tom_no, br.borrow_id
+"""
+
+
+def find_duplicate_open_loans(conn):
+    """
+    Връща по-старите отворени заемания на книгите, заети повече от веднъж
+    (borrow_id, инв. №, читател, дата на заемане, дата на следващото заемане).
+    """
+    return conn.execute(_DUPLICATE_OPEN_LOANS_SQL).fetchall()
+
+
+def rebuild_loan_state(conn):
+    """Изчиства и попълва наново текущото заемане за всички книги."""
+    conn.execute(
+        "UPDATE books SET current_borrow_id = NULL, current_reader_no = NULL, current_due_date = NULL "
+        "WHERE current_borrow_id IS NOT NULL"
+    )
+    conn.execute(_RECOMPUTE + " WHERE tom_no IN (SELECT book_tom_no FROM borrows WHERE return_date IS NULL)")
+
+
+def find_loan_state_mismatches(conn):
+    """Връща книгите, при които 'current_*' не отговаря на отворените заемания."""
+    return conn.execute(_MISMATCHES_SQL).fetchall()
+
+
+@click.command('check-loan-state')
+@click.option('--repair', is_flag=True, help='Възстановява състоянието при открити разлики.')
+@click.option('--close-duplicates', is_flag=True,
+              help='Приключва по-старите отворени заемания на книга, заета повече от веднъж (с датата на следващото заемане).')
+@with_appcontext
+def check_loan_state_command(repair, close_duplicates):
+    """
+    Команда 'flask check-loan-state' - сравнява текущото заемане върху
+    книгите с таблицата 'borrows' и при '--repair' го възстановява.
+    Показва и книгите с повече от едно отворено заемане.
+    """
+    conn = get_db()
+    duplicates = find_duplicate_open_loans(conn)
+    for row in duplicates:
+        click.echo(f"Инв.№ {row['book_tom_no']}: заемане {row['borrow_id']} (читател {row['reader_no']}, {row['borrow_date']}) "
+                   f"е отворено, а книгата е заета отново на {row['next_borrow_date']}")
+    click.echo(f"Двойни отворени заемания: {len(duplicates)}")
+    if duplicates and close_duplicates:
+        conn.executemany(
+            "UPDATE borrows SET return_date = ? WHERE borrow_id = ? AND return_date IS NULL",
+            [(row['next_borrow_date'], row['borrow_id']) for row in duplicates]
+        )
+        conn.commit()
+        click.echo(f"Приключени заемания: {len(duplicates)}. Изпълнете 'flask db-upgrade' за оставащите миграции.")
+        duplicates = []
+    mismatches = find_loan_state_mismatches(conn)
+    for row in mismatches[:50]:
+        click.echo(f"Инв.№ {row['tom_no']}: записано заемане {row['current_borrow_id']}, очаквано {row['borrow_id']}")
+    click.echo(f"Разлики: {len(mismatches)}")
+    if mismatches and repair:
+        rebuild_loan_state(conn)
+        conn.commit()
+        click.echo(f"Състоянието е възстановено. Оставащи разлики: {len(find_loan_state_mismatches(conn))}")
+    elif mismatches or duplicates:
+        raise SystemExit(1)
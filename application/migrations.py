@@ -0,0 +1,451 @@
+# application/migrations.py
+
+import os
+import sqlite3
+from collections import namedtuple
+
+# Всяка промяна по схемата се добавя тук като нова миграция с пореден номер.
+# Миграциите се изпълняват веднъж при старт на процеса (или с 'flask db-upgrade'),
+# всяка в отделна транзакция, а приложената версия се пази в 'schema_version'.
+
+Migration = namedtuple('Migration', ['version', 'description', 'body'])
+
+
+class MigrationBlocked(Exception):
+    """Миграцията не може да се приложи, докато данните не се поправят ръчно."""
+
+
+MIGRATIONS = []
+
+SCHEMA_FILE = os.path.join(os.path.dirname(__file__), '..', 'database_schema.sql')
+
+
+def migration(version, description):
+    """Декоратор, който регистрира функция като миграция с даден номер."""
+    def decorator(fn):
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError(f"Дублиран номер на миграция: {version}")
+        MIGRATIONS.append(Migration(version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+    return decorator
+
+
+def split_sql(script):
+    """Разделя SQL скрипт на отделни заявки (вкл. тригери с BEGIN ... END)."""
+    statements, buffer = [], ''
+    for line in script.splitlines(keepends=True):
+        if not buffer and (not line.strip() or line.strip().startswith('--')):
+            continue
+        buffer += line
+        if sqlite3.complete_statement(buffer):
+            statements.append(buffer.strip())
+            buffer = ''
+    if buffer.strip():
+        statements.append(buffer.strip())
+    return statements
+
+
+def run_sql(conn, script):
+    """Изпълнява скрипт заявка по заявка, без да прекъсва текущата транзакция."""
+    for statement in split_sql(script):
+        conn.execute(statement)
+
+
+def _ensure_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def current_version(conn):
+    """Връща номера на последната приложена миграция (0 за празна база)."""
+    _ensure_version_table(conn)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def pending(conn):
+    """Връща миграциите, които още не са приложени."""
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def upgrade(conn, target=None):
+    """
+    Прилага всички неприложени миграции до 'target' (по подразбиране - последната).
+    Всяка миграция е в собствена транзакция 'BEGIN IMMEDIATE', така че няколко
+    процеса, стартирани едновременно, не я изпълняват повторно.
+    Връща списък с приложените миграции.
+    """
+    applied = []
+    old_isolation = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        _ensure_version_table(conn)
+        for m in MIGRATIONS:
+            if target is not None and m.version > target:
+                break
+            if m.version <= current_version(conn):
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Проверяваме отново след заключването - друг процес може да я е приложил
+                if m.version <= current_version(conn):
+                    conn.execute("COMMIT")
+                    continue
+                m.body(conn)
+                conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (m.version, m.description)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(m)
+            print(f"--- INFO: Приложена миграция {m.version}: {m.description} ---")
+    finally:
+        conn.isolation_level = old_isolation
+    return applied
+
+
+# --- Миграции ---
+
+@migration(1, 'Базова схема (database_schema.sql)')
+def _m0001_base_schema(conn):
+    # Схемата е с 'IF NOT EXISTS', така че е безопасна и за съществуващи бази,
+    # създадени преди въвеждането на миграциите (вкл. липсващата 'settings').
+    with open(SCHEMA_FILE, encoding='utf8') as f:
+        run_sql(conn, f.read())
+
+
+@migration(2, 'Индекси за честите заявки (заемания, читатели, книги)')
+def _m0002_hot_query_indexes(conn):
+    run_sql(conn, """
+        -- Отворени заемания: табло, връщане, статус на книга, 'NOT IN' за наличност
+        CREATE INDEX IF NOT EXISTS idx_borrows_open_due ON borrows(due_date) WHERE return_date IS NULL;
+        CREATE INDEX IF NOT EXISTS idx_borrows_open_book ON borrows(book_tom_no, due_date) WHERE return_date IS NULL;
+        -- История по читател и по книга
+        CREATE INDEX IF NOT EXISTS idx_borrows_reader ON borrows(reader_no, borrow_date);
+        CREATE INDEX IF NOT EXISTS idx_borrows_book ON borrows(book_tom_no, borrow_date);
+        -- Справки по период с GROUP BY по книга/читател (покриващ индекс)
+        CREATE INDEX IF NOT EXISTS idx_borrows_date ON borrows(borrow_date, book_tom_no, reader_no);
+        -- Неплатени глоби (табло и профил на читател)
+        CREATE INDEX IF NOT EXISTS idx_borrows_unpaid ON borrows(reader_no, fine_amount) WHERE fine_amount > 0 AND fine_paid_date IS NULL;
+
+        CREATE INDEX IF NOT EXISTS idx_readers_reg_year ON readers(last_registration_year, full_name);
+        CREATE INDEX IF NOT EXISTS idx_readers_registration ON readers(registration_date, gender, profession, education);
+        CREATE INDEX IF NOT EXISTS idx_readers_name ON readers(full_name);
+
+        CREATE INDEX IF NOT EXISTS idx_books_record_date ON books(record_date);
+        CREATE INDEX IF NOT EXISTS idx_books_covers ON books(record_date) WHERE cover_image IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS idx_books_genre ON books(genre);
+        CREATE INDEX IF NOT EXISTS idx_books_title ON books(title);
+
+        -- Статистика за планировчика (ограничена, за да е бърза и при големи бази)
+        PRAGMA analysis_limit = 1000;
+        ANALYZE;
+    """)
+
+
+@migration(3, 'Таблица с версии за кешовете в паметта')
+def _m0003_cache_versions(conn):
+    # Всеки кеш в паметта (настройки и др.) пази версията, с която е зареден.
+    # При запис версията се увеличава и останалите процеси презареждат кеша.
+    run_sql(conn, """
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('settings', 0);
+    """)
+
+
+@migration(4, 'Текущо заемане върху книгата (поддържано от тригери)')
+def _m0004_book_loan_state(conn):
+    run_sql(conn, """
+        ALTER TABLE books ADD COLUMN current_borrow_id INTEGER;
+        ALTER TABLE books ADD COLUMN current_reader_no VARCHAR(255);
+        ALTER TABLE books ADD COLUMN current_due_date DATE;
+
+        CREATE INDEX IF NOT EXISTS idx_books_on_loan ON books(current_due_date) WHERE current_borrow_id IS NOT NULL;
+
+        -- Промяна по текущото заемане не трябва да преиндексира FTS
+        DROP TRIGGER IF EXISTS books_after_update;
+        CREATE TRIGGER books_after_update AFTER UPDATE OF tom_no, title, author ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, tom_no, title, author) VALUES('delete', old.tom_no, old.tom_no, old.title, old.author);
+            INSERT INTO books_fts(rowid, tom_no, title, author) VALUES (new.tom_no, new.tom_no, new.title, new.author);
+        END;
+    """)
+    # Тригерите и командата 'flask check-loan-state' ползват една и съща заявка
+    from .loans import LOAN_STATE_TRIGGERS, rebuild_loan_state
+    run_sql(conn, LOAN_STATE_TRIGGERS)
+    rebuild_loan_state(conn)
+
+
+@migration(5, 'Броячи на редовете за страниране без COUNT(*)')
+def _m0005_row_counts(conn):
+    run_sql(conn, """
+        CREATE TABLE IF NOT EXISTS row_counts (
+            name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR REPLACE INTO row_counts (name, count) VALUES ('books', (SELECT COUNT(*) FROM books));
+        INSERT OR REPLACE INTO row_counts (name, count) VALUES ('activity_log', (SELECT COUNT(*) FROM activity_log));
+
+        CREATE TRIGGER IF NOT EXISTS books_count_after_insert AFTER INSERT ON books BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE name = 'books';
+        END;
+        CREATE TRIGGER IF NOT EXISTS books_count_after_delete AFTER DELETE ON books BEGIN
+            UPDATE row_counts SET count = count - 1 WHERE name = 'books';
+        END;
+        CREATE TRIGGER IF NOT EXISTS activity_log_count_after_insert AFTER INSERT ON activity_log BEGIN
+            UPDATE row_counts SET count = count + 1 WHERE name = 'activity_log';
+        END;
+        CREATE TRIGGER IF NOT EXISTS activity_log_count_after_delete AFTER DELETE ON activity_log BEGIN
+            UPDATE row_counts SET count = count - 1 WHERE name = 'activity_log';
+        END;
+    """)
+
+
+@migration(6, 'Пълнотекстов индекс за читателите (readers_fts)')
+def _m0006_readers_fts(conn):
+    run_sql(conn, """
+        CREATE VIRTUAL TABLE IF NOT EXISTS readers_fts USING fts5( reader_no, full_name, phone, email, city, content='readers', content_rowid='rowid', tokenize = "unicode61 remove_diacritics 2" );
+        CREATE TRIGGER IF NOT EXISTS readers_after_insert AFTER INSERT ON readers BEGIN INSERT INTO readers_fts(rowid, reader_no, full_name, phone, email, city) VALUES (new.rowid, new.reader_no, new.full_name, new.phone, new.email, new.city); END;
+        CREATE TRIGGER IF NOT EXISTS readers_after_delete AFTER DELETE ON readers BEGIN INSERT INTO readers_fts(readers_fts, rowid, reader_no, full_name, phone, email, city) VALUES('delete', old.rowid, old.reader_no, old.full_name, old.phone, old.email, old.city); END;
+        CREATE TRIGGER IF NOT EXISTS readers_after_update AFTER UPDATE OF reader_no, full_name, phone, email, city ON readers BEGIN INSERT INTO readers_fts(readers_fts, rowid, reader_no, full_name, phone, email, city) VALUES('delete', old.rowid, old.reader_no, old.full_name, old.phone, old.email, old.city); INSERT INTO readers_fts(rowid, reader_no, full_name, phone, email, city) VALUES (new.rowid, new.reader_no, new.full_name, new.phone, new.email, new.city); END;
+        INSERT INTO readers_fts(readers_fts) VALUES('rebuild');
+    """)
+
+
+@migration(7, 'Начислени глоби по отворените заемания')
+def _m0007_accrued_fines(conn):
+    run_sql(conn, """
+        ALTER TABLE borrows ADD COLUMN accrued_fine REAL NOT NULL DEFAULT 0;
+        ALTER TABLE borrows ADD COLUMN accrued_on DATE;
+        -- Дължимо по читател за отворените заемания (табло и профил на читател)
+        CREATE INDEX IF NOT EXISTS idx_borrows_accrued ON borrows(reader_no, accrued_fine) WHERE accrued_fine > 0 AND return_date IS NULL;
+    """)
+    # Първоначално начисляване; по-нататък го прави фоновата задача в 'fines.py'
+    from .utils import fine_sql
+    row = conn.execute("SELECT value FROM settings WHERE key = 'fine_per_day'").fetchone()
+    rate = float(row[0]) if row else 0.10
+    conn.execute(
+        f"UPDATE borrows SET accrued_fine = {fine_sql('due_date')}, accrued_on = date('now', 'localtime') WHERE return_date IS NULL",
+        (rate,)
+    )
+
+
+@migration(8, 'Версии на секциите от таблото (поддържани от тригери)')
+def _m0008_dashboard_versions(conn):
+    # Всеки запис увеличава версията на секциите от таблото, които засяга;
+    # кешът в 'dashboard.py' зарежда наново само тях.
+    def bump(*names):
+        listed = ', '.join(f"'{name}'" for name in names)
+        return f"UPDATE cache_versions SET version = version + 1 WHERE name IN ({listed});"
+
+    books, readers, loans, lookups = 'dashboard_books', 'dashboard_readers', 'dashboard_loans', 'dashboard_lookups'
+    triggers = [
+        ('books', 'INSERT', '', bump(books)),
+        ('books', 'DELETE', '', bump(books, loans)),
+        ('books', 'UPDATE', ' OF tom_no, title, author, genre, record_date, cover_image', bump(books, loans)),
+        ('readers', 'INSERT', '', bump(readers)),
+        ('readers', 'DELETE', '', bump(readers, loans)),
+        ('readers', 'UPDATE', '', bump(readers, loans)),
+        ('borrows', 'INSERT', '', bump(loans)),
+        ('borrows', 'DELETE', '', bump(loans)),
+        ('borrows', 'UPDATE', '', bump(loans)),
+    ]
+    for table in ('genres', 'professions', 'educations'):
+        triggers += [(table, event, '', bump(lookups)) for event in ('INSERT', 'DELETE', 'UPDATE')]
+
+    for name in (books, readers, loans, lookups):
+        conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES (?, 0)", (name,))
+    for table, event, columns, body in triggers:
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_dashboard_after_{event.lower()} "
+            f"AFTER {event}{columns} ON {table} BEGIN {body} END"
+        )
+
+
+@migration(9, 'Опашка с фонови задачи (jobs)')
+def _m0009_jobs(conn):
+    run_sql(conn, """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            title TEXT,
+            params TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            message TEXT,
+            error TEXT,
+            result_path TEXT,
+            result_name TEXT,
+            created_by TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME,
+            finished_at DATETIME
+        );
+        -- Взимане на следващата задача от опашката
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(id) WHERE status = 'queued';
+    """)
+
+
+@migration(10, 'Качване на части и точки на възобновяване на задачите')
+def _m0010_resumable_uploads(conn):
+    run_sql(conn, """
+        -- Състояние на задачата след последната записана порция (JSON)
+        ALTER TABLE jobs ADD COLUMN checkpoint TEXT;
+
+        -- Файлове, качвани на части; получените байтове са размерът на файла в папката на задачите
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            job_id INTEGER,
+            created_by TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+@migration(11, 'Сумирани заемания по ден, месец и година (за справките)')
+def _m0011_circulation_rollups(conn):
+    for table in ('circ_daily', 'circ_monthly', 'circ_yearly'):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                dim TEXT NOT NULL,
+                period TEXT NOT NULL,
+                key TEXT NOT NULL,
+                loans INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dim, period, key)
+            ) WITHOUT ROWID
+        """)
+    # Тригерите и попълването са в миграция 16 - те ползват ключовете,
+    # записани в самите заемания
+
+
+@migration(12, 'Версии за кеша на справките (поддържани от тригери)')
+def _m0012_report_versions(conn):
+    # 'reports' се увеличава при всеки запис в книги, читатели и заемания -
+    # кешираните справки за текущия период стават невалидни. 'reports_history'
+    # се увеличава само когато записът засяга минали дати (редакция, изтриване
+    # или вмъкване с минала дата, напр. при импорт), за да се обновят и
+    # справките за вече приключени периоди.
+    def bump(*names):
+        listed = ', '.join(f"'{name}'" for name in names)
+        return f"UPDATE cache_versions SET version = version + 1 WHERE name IN ({listed});"
+
+    current, history = 'reports', 'reports_history'
+    # Само колоните, които справките показват (без напр. текущото заемане и глобите)
+    tables = [
+        ('books', 'record_date', 'tom_no, title, author, is_donation, price, record_date'),
+        ('readers', 'registration_date', 'reader_no, full_name, gender, profession, education, registration_date, is_under_14, last_registration_year'),
+        ('borrows', 'borrow_date', 'borrow_date, book_tom_no, reader_no'),
+    ]
+    triggers = []
+    for table, date_column, columns in tables:
+        triggers += [
+            (f"{table}_reports_after_insert", f"INSERT ON {table}", bump(current)),
+            (f"{table}_reports_after_insert_past", f"INSERT ON {table} WHEN substr(new.{date_column}, 1, 10) < date('now', 'localtime')", bump(history)),
+            (f"{table}_reports_after_delete", f"DELETE ON {table}", bump(current, history)),
+            (f"{table}_reports_after_update", f"UPDATE OF {columns} ON {table}", bump(current, history)),
+        ]
+
+    for name in (current, history):
+        conn.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES (?, 0)", (name,))
+    for name, event, body in triggers:
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} BEGIN {body} END")
+
+
+@migration(13, 'Еднакъв формат на времето в дневника и индекс по него')
+def _m0013_activity_timestamps(conn):
+    run_sql(conn, """
+        -- Записите от 'datetime.now()' са с микросекунди, тези от SQLite - без
+        UPDATE activity_log SET timestamp = substr(replace(timestamp, 'T', ' '), 1, 19)
+        WHERE length(timestamp) > 19 OR instr(timestamp, 'T') > 0;
+        CREATE INDEX IF NOT EXISTS idx_activity_log_timestamp ON activity_log(timestamp);
+    """)
+
+
+@migration(14, 'Най-много едно отворено заемане на книга (уникален частичен индекс)')
+def _m0014_one_open_loan_per_book(conn):
+    from .loans import find_duplicate_open_loans
+    # Заеманията не се променят автоматично: ако някоя книга вече е заета
+    # повече от веднъж, миграцията спира, докато това не се поправи
+    duplicates = find_duplicate_open_loans(conn)
+    if duplicates:
+        ids = ', '.join(str(row[0]) for row in duplicates)
+        raise MigrationBlocked(
+            f"Книги с повече от едно отворено заемане (borrow_id: {ids}). Върнете излишните заемания "
+            f"или изпълнете 'flask check-loan-state --close-duplicates', след което 'flask db-upgrade'."
+        )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_borrows_one_open_per_book ON borrows(book_tom_no) WHERE return_date IS NULL")
+
+
+@migration(15, 'Постоянен целочислен ключ на читателите (readers.id) за readers_fts')
+def _m0015_readers_integer_key(conn):
+    # 'readers' е с текстов първичен ключ, затова неявният му rowid не е
+    # постоянен - VACUUM може да го преномерира, а 'readers_fts' (външно
+    # съдържание) сочи читателите именно по rowid. Таблицата се създава наново
+    # с 'id INTEGER PRIMARY KEY' (постоянен псевдоним на rowid) със същите
+    # стойности, така че индексът и курсорите за страниране остават верни.
+    create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'readers'").fetchone()[0]
+    new_sql = create_sql.replace('reader_no VARCHAR(255) PRIMARY KEY', 'id INTEGER PRIMARY KEY, reader_no VARCHAR(255) UNIQUE', 1)
+    if new_sql == create_sql:
+        raise RuntimeError("Неочаквана схема на таблица 'readers'")
+    dependents = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'readers' AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    )]
+    columns = ', '.join(row[1] for row in conn.execute("PRAGMA table_info(readers)"))
+
+    # Проверката на FOREIGN KEY от 'borrows' се отлага до края на транзакцията -
+    # дотогава читателите са върнати със същите номера
+    conn.execute("PRAGMA defer_foreign_keys = ON")
+    conn.execute(f"CREATE TEMP TABLE readers_copy AS SELECT rowid AS id, {columns} FROM readers")
+    conn.execute("DROP TABLE readers")
+    conn.execute(new_sql)
+    conn.execute(f"INSERT INTO readers (id, {columns}) SELECT id, {columns} FROM temp.readers_copy")
+    conn.execute("DROP TABLE temp.readers_copy")
+    # Индексите и тригерите се създават след копирането - то не е нов запис
+    for sql in dependents:
+        conn.execute(sql)
+    run_sql(conn, """
+        DROP TABLE IF EXISTS readers_fts;
+        CREATE VIRTUAL TABLE readers_fts USING fts5( reader_no, full_name, phone, email, city, content='readers', content_rowid='id', tokenize = "unicode61 remove_diacritics 2" );
+        INSERT INTO readers_fts(readers_fts) VALUES('rebuild');
+    """)
+
+
+@migration(16, 'Ключове за жанр, пол и възраст в заеманията и тригери за сумите по тях')
+def _m0016_rollup_bucket_keys(conn):
+    # Жанрът, полът и възрастовата група се записват в заемането, когато то
+    # се направи, и сумите се водят по тях. Старите тригери от миграция 11
+    # четяха текущите данни на книгата и читателя - след промяна в тях
+    # изтриване или преизчисляване вадеше от друг ключ.
+    from .rollups import BUCKET_KEYS, ROLLUP_TRIGGERS, rebuild_rollups
+    for column in BUCKET_KEYS:
+        conn.execute(f"ALTER TABLE borrows ADD COLUMN {column} TEXT")
+    run_sql(conn, """
+        DROP TRIGGER IF EXISTS borrows_rollup_after_insert;
+        DROP TRIGGER IF EXISTS borrows_rollup_after_delete;
+        DROP TRIGGER IF EXISTS borrows_rollup_after_update;
+    """)
+    run_sql(conn, ROLLUP_TRIGGERS)
+    # Ключовете на досегашните заемания се попълват от текущите данни
+    rebuild_rollups(conn)
+
+
+@migration(17, 'Частичен индекс на наличните книги по заглавие (страницата за заемане)')
+def _m0017_available_books_index(conn):
+    # Страницата за заемане показва наличните книги по заглавие - индексът
+    # съдържа само тях и е вече подреден, без обхождане на всички книги и сортиране
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_books_available_title ON books(title) WHERE current_borrow_id IS NULL")
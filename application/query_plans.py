@@ -0,0 +1,475 @@
+# application/query_plans.py
+
+import ast
+import importlib
+import os
+import re
+import types
+import click
+from flask.cli import with_appcontext
+from .database import get_db
+
+# Регресионна проверка на плановете на заявките: всички SQL заявки, подадени
+# към .execute() и към 'paginate()' в модулите с маршрути (и в CHECKED_MODULES),
+# се пускат през 'EXPLAIN QUERY PLAN' и проверката се проваля, ако някоя от тях
+# обхожда цяла голяма таблица или не може да се провери (извън ALLOWED_SKIPS).
+
+# Таблици, при които пълното обхождане е проблем. Малките справочни таблици
+# (жанрове, професии, настройки, потребители) могат да се обхождат свободно.
+LARGE_TABLES = {'books', 'readers', 'borrows', 'activity_log'}
+
+# Съзнателно допуснати обхождания: (модул.функция, таблица) -> причина.
+ALLOWED_SCANS = {
+    ('dashboard._load_books', 'books'): "последни 5 по rowid (LIMIT) и GROUP BY по жанр; кешира се до следващ запис",
+    ('dashboard._load_readers', 'readers'): "последни 5 по rowid (LIMIT); кешира се до следващ запис",
+    ('routes_books.api_books', 'books'): "първа страница без търсене - по rowid до LIMIT, без сортиране",
+    ('routes_readers.api_readers', 'readers'): "първа страница без търсене - по индекса по име до LIMIT",
+    ('routes_auth.activity_log_page', 'activity_log'): "първа страница - по id до LIMIT в двете бази (текуща и архив)",
+    ('rollups.find_rollup_mismatches', 'borrows'): "'flask check-rollups' брои заеманията направо, за сравнение със сумите",
+    ('rollups.rebuild_rollups', 'borrows'): "'flask rebuild-rollups' и миграциите преизчисляват сумите от всички заемания",
+}
+
+# Заявки, които не могат да се съставят статично: модул.функция -> причина.
+# Всяка друга пропусната заявка (неизвестна част или грешка при EXPLAIN) проваля проверката.
+ALLOWED_SKIPS = {
+    'routes_readers.add_new_entry': "името на справочната таблица (професии, образование и т.н.) идва от извикващия",
+    'routes_public.api_public_search_books': "вариантът без текст и без жанр не стига до заявката (връща се празен списък)",
+}
+
+# Модули извън 'routes_*.py', чиито заявки се изпълняват при обработка на страница
+CHECKED_MODULES = {'dashboard.py', 'rollups.py'}
+
+_SQL_START = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE|INSERT|REPLACE)\b', re.IGNORECASE)
+_TABLE_REF = re.compile(
+    r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)'
+    r'(?:\s+(?:AS\s+)?(?!(?:ON|WHERE|JOIN|LEFT|INNER|CROSS|GROUP|ORDER|LIMIT|USING|SET|VALUES)\b)(\w+))?',
+    re.IGNORECASE
+)
+# Таблицата може да е с префикс на базата ('main.activity_log' през изгледа на дневника)
+_SCAN = re.compile(r'^SCAN (?:\w+\.)?(\w+)(?: USING (?:COVERING )?INDEX (\w+))?')
+
+
+# Колко варианта (пътища през разклоненията и стойности на израз) се следят
+# в една функция; при повече заявките в нея се отчитат като пропуснати.
+MAX_VARIANTS = 64
+
+_UNKNOWN = object()
+
+
+class _RecordingConnection:
+    """Връзка, която само записва подадените заявки (за 'paginate')."""
+
+    def __init__(self):
+        self.queries = []
+
+    def execute(self, sql, params=()):
+        self.queries.append(sql)
+        return self
+
+    def fetchall(self):
+        return []
+
+
+def _product(options, combine):
+    """Всички комбинации от възможните стойности на частите; None, ако някоя е неизвестна."""
+    results = [()]
+    for values in options:
+        if values is None:
+            return None
+        results = [prefix + (value,) for prefix in results for value in values]
+        if len(results) > MAX_VARIANTS:
+            return None
+    try:
+        return [combine(parts) for parts in results]
+    except (TypeError, ValueError, KeyError, IndexError):
+        return None
+
+
+def _unique(values):
+    seen, result = set(), []
+    for value in values:
+        if repr(value) not in seen:
+            seen.add(repr(value))
+            result.append(value)
+    return result
+
+
+class _SqlCollector:
+    """
+    Събира SQL заявките, подадени към .execute() и към 'paginate()'.
+    Всяка функция се обхожда по всички пътища през if/else, цикли и try,
+    като за всеки път се пазят стойностите на локалните променливи, а имената
+    от модула се четат от самия (импортиран) модул. Така съставените заявки
+    се проверяват с всички възможни стойности - напр. всички колони за
+    сортиране от речник или заявката с и без търсене.
+    """
+
+    def __init__(self, module, namespace):
+        self.module = module
+        self.namespace = namespace
+        self.queries = []
+
+    def collect(self, tree):
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                self._function(node)
+
+    def _function(self, node):
+        self.where = f"{self.module}.{node.name}"
+        self.overflow = False
+        args = node.args.posonlyargs + node.args.args + node.args.kwonlyargs
+        if node.args.vararg:
+            args.append(node.args.vararg)
+        if node.args.kwarg:
+            args.append(node.args.kwarg)
+        self._block(node.body, [{arg.arg: _UNKNOWN for arg in args}])
+
+    # --- Пътища през операторите ---
+
+    def _block(self, statements, paths):
+        for statement in statements:
+            if not paths:
+                break
+            paths = self._limit(self._statement(statement, paths), statement)
+        return paths
+
+    def _limit(self, paths, node):
+        paths = _unique(paths)
+        if len(paths) > MAX_VARIANTS:
+            if not self.overflow:
+                self.queries.append((self.where, node.lineno, None))
+            self.overflow = True
+            paths = paths[:MAX_VARIANTS]
+        return paths
+
+    def _statement(self, node, paths):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            return paths
+        if isinstance(node, ast.If):
+            self._calls(node.test, paths)
+            taken = [(path, self._truth(node.test, path)) for path in paths]
+            return (self._block(node.body, [path for path, truth in taken if truth is not False])
+                    + self._block(node.orelse, [path for path, truth in taken if truth is not True]))
+        if isinstance(node, (ast.For, ast.AsyncFor)):
+            self._calls(node.iter, paths)
+            entered = []
+            for path in paths:
+                for item in self._items(node.iter, path):
+                    entered.append(self._bind(node.target, item, path))
+            return self._block(node.orelse, paths + self._block(node.body, entered))
+        if isinstance(node, ast.While):
+            self._calls(node.test, paths)
+            return self._block(node.orelse, paths + self._block(node.body, paths))
+        if isinstance(node, (ast.With, ast.AsyncWith)):
+            for item in node.items:
+                self._calls(item.context_expr, paths)
+                if item.optional_vars is not None:
+                    paths = [self._bind(item.optional_vars, _UNKNOWN, path) for path in paths]
+            return self._block(node.body, paths)
+        if isinstance(node, ast.Try):
+            done = self._block(node.orelse, self._block(node.body, paths))
+            for handler in node.handlers:
+                handled = paths
+                if handler.name:
+                    handled = [{**path, handler.name: _UNKNOWN} for path in paths]
+                done += self._block(handler.body, handled)
+            return self._block(node.finalbody, done) if node.finalbody else done
+        if isinstance(node, (ast.Return, ast.Raise)):
+            self._calls(node, paths)
+            return []
+        if isinstance(node, (ast.Assign, ast.AnnAssign)):
+            if node.value is None:
+                return paths
+            self._calls(node.value, paths)
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if (len(targets) == 1 and isinstance(targets[0], ast.Tuple) and isinstance(node.value, ast.Tuple)
+                    and len(targets[0].elts) == len(node.value.elts)):
+                # 'a, b = x, y' - всяка стойност поотделно, за да не се загуби известната
+                for target, value in zip(targets[0].elts, node.value.elts):
+                    paths = [{**path, **self._bind(target, item, {})} for path in paths
+                             for item in (self._eval(value, path) or [_UNKNOWN])]
+                return paths
+            result = []
+            for path in paths:
+                values = self._eval(node.value, path)
+                for value in (values if values is not None else [_UNKNOWN]):
+                    new_path = path
+                    for target in targets:
+                        new_path = self._bind(target, value, new_path)
+                    result.append(new_path)
+            return result
+        if isinstance(node, ast.AugAssign):
+            self._calls(node.value, paths)
+            if not isinstance(node.target, ast.Name):
+                return paths
+            result = []
+            for path in paths:
+                values = None
+                if isinstance(node.op, ast.Add):
+                    values = _product([self._name(node.target.id, path), self._eval(node.value, path)], lambda parts: parts[0] + parts[1])
+                result.extend({**path, node.target.id: value} for value in (values if values is not None else [_UNKNOWN]))
+            return result
+        if isinstance(node, ast.Expr):
+            self._calls(node.value, paths)
+            return [path for old in paths for path in self._mutate(node.value, old)]
+        self._calls(node, paths)
+        return paths
+
+    def _truth(self, test, path):
+        """Стойността на 'if x' / 'if not x' по пътя, ако 'x' е известна; иначе None (и двата клона)."""
+        negate = isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not)
+        if negate:
+            test = test.operand
+        if not isinstance(test, ast.Name):
+            return None
+        values = self._eval(test, path)
+        if values is None or len(values) != 1:
+            return None
+        return bool(values[0]) != negate
+
+    def _bind(self, target, value, path):
+        if isinstance(target, ast.Name):
+            return {**path, target.id: value}
+        if isinstance(target, (ast.Tuple, ast.List)):
+            parts = list(value) if isinstance(value, (tuple, list)) and len(value) == len(target.elts) else [_UNKNOWN] * len(target.elts)
+            for element, part in zip(target.elts, parts):
+                path = self._bind(element, part, path)
+            return path
+        return path
+
+    def _mutate(self, node, path):
+        """'списък.append(x)' и 'списък.extend(x)' върху локален списък."""
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr in ('append', 'extend') and isinstance(node.func.value, ast.Name)
+                and len(node.args) == 1):
+            return [path]
+        name = node.func.value.id
+        if name not in path:
+            return [path]
+        if node.func.attr == 'append':
+            values = _product([self._name(name, path), self._eval(node.args[0], path)], lambda parts: list(parts[0]) + [parts[1]])
+        else:
+            values = _product([self._name(name, path), self._eval(node.args[0], path)], lambda parts: list(parts[0]) + list(parts[1]))
+        return [{**path, name: value} for value in (values if values is not None else [_UNKNOWN])]
+
+    def _items(self, node, path):
+        values = self._eval(node, path)
+        items = []
+        for value in values or [_UNKNOWN]:
+            if isinstance(value, (dict, list, tuple)):
+                items.extend(value)
+            else:
+                items.append(_UNKNOWN)
+        return _unique(items) or [_UNKNOWN]
+
+    # --- Заявките ---
+
+    def _calls(self, node, paths):
+        for call in ast.walk(node):
+            if not isinstance(call, ast.Call) or not call.args:
+                continue
+            func = call.func
+            if isinstance(func, ast.Attribute) and func.attr in ('execute', 'executemany'):
+                self._record(call, [self._eval(call.args[0], path) for path in paths])
+            elif (func.id if isinstance(func, ast.Name) else getattr(func, 'attr', None)) == 'paginate':
+                self._record(call, [self._paginate(call, path) for path in paths])
+
+    def _record(self, call, variants):
+        if any(values is None for values in variants):
+            self.queries.append((self.where, call.lineno, None))
+            return
+        for sql in _unique(sql for values in variants for sql in values):
+            if isinstance(sql, str) and _SQL_START.match(sql):
+                self.queries.append((self.where, call.lineno, sql))
+
+    def _paginate(self, call, path):
+        """Заявките на 'paginate()' за първа страница и за страница след курсор."""
+        from .utils import paginate, encode_cursor
+        if len(call.args) < 5:
+            return None
+        descending = [False]
+        for keyword in call.keywords:
+            if keyword.arg == 'descending':
+                descending = self._eval(keyword.value, path) or [False, True]
+        options = [self._eval(call.args[index], path) for index in (1, 2, 4)] + [descending]
+
+        def sql_of(parts):
+            select_sql, where, keys, desc = parts
+            conn = _RecordingConnection()
+            for after in (None, encode_cursor(*[0] * len(keys))):
+                paginate(conn, select_sql, list(where), [], list(keys), 1, after=after, descending=desc)
+            return conn.queries
+
+        variants = _product(options, sql_of)
+        return None if variants is None else [sql for queries in variants for sql in queries]
+
+    # --- Стойности на изразите ---
+
+    def _name(self, name, path):
+        if name in path:
+            return None if path[name] is _UNKNOWN else [path[name]]
+        if name in self.namespace:
+            return [self.namespace[name]]
+        return None
+
+    def _eval(self, node, path):
+        """Възможните стойности на израза по пътя 'path' или None, ако не може да се изчисли статично."""
+        if isinstance(node, ast.Constant):
+            return [node.value]
+        if isinstance(node, ast.Name):
+            return self._name(node.id, path)
+        if isinstance(node, ast.JoinedStr):
+            parts = [self._eval(value.value if isinstance(value, ast.FormattedValue) else value, path) for value in node.values]
+            return _product(parts, lambda values: ''.join(str(value) for value in values))
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return _product([self._eval(node.left, path), self._eval(node.right, path)], lambda parts: parts[0] + parts[1])
+        if isinstance(node, (ast.List, ast.Tuple)):
+            combine = list if isinstance(node, ast.List) else tuple
+            return _product([self._eval(element, path) for element in node.elts], combine)
+        if isinstance(node, ast.IfExp):
+            body, orelse = self._eval(node.body, path), self._eval(node.orelse, path)
+            return None if body is None or orelse is None else _unique(body + orelse)
+        if isinstance(node, ast.Attribute):
+            values = self._eval(node.value, path)
+            if values is None or not all(isinstance(value, types.ModuleType) for value in values):
+                return None
+            return _product([values], lambda parts: getattr(parts[0], node.attr))
+        if isinstance(node, (ast.ListComp, ast.GeneratorExp)) and len(node.generators) == 1 and not node.generators[0].ifs:
+            generator = node.generators[0]
+            values = [self._eval(node.elt, self._bind(generator.target, item, path)) for item in self._items(generator.iter, path)]
+            return _product(values, list)
+        if isinstance(node, ast.Subscript):
+            return self._subscript(node, path)
+        if isinstance(node, ast.Call):
+            return self._call(node, path)
+        return None
+
+    def _subscript(self, node, path):
+        containers, keys = self._eval(node.value, path), self._eval(node.slice, path)
+        if containers is None:
+            return None
+        if keys is None:
+            # Неизвестен ключ в речник - всички стойности от него
+            if not all(isinstance(container, dict) for container in containers):
+                return None
+            return _unique(value for container in containers for value in container.values())
+        return _product([containers, keys], lambda parts: parts[0][parts[1]])
+
+    def _call(self, node, path):
+        args = [self._eval(arg, path) for arg in node.args]
+        func = node.func
+        if isinstance(func, ast.Attribute):
+            owners = self._eval(func.value, path)
+            if owners is None:
+                return None
+            if func.attr == 'get' and all(isinstance(owner, dict) for owner in owners) and node.args:
+                default = args[1] if len(args) > 1 else [None]
+                if args[0] is None:
+                    # Неизвестен ключ - всяка стойност от речника или подразбиращата се
+                    return None if default is None else _unique([v for owner in owners for v in owner.values()] + default)
+                return _product([owners, args[0], default], lambda parts: parts[0].get(parts[1], parts[2]))
+            if func.attr in ('items', 'keys', 'values') and not node.args and all(isinstance(owner, dict) for owner in owners):
+                return [list(getattr(owner, func.attr)()) for owner in owners]
+            if func.attr == 'join' and all(isinstance(owner, str) for owner in owners) and len(args) == 1:
+                return _product([owners, args[0]], lambda parts: parts[0].join(parts[1]))
+            if func.attr == 'format' and all(isinstance(owner, str) for owner in owners):
+                names = [keyword.arg for keyword in node.keywords]
+                options = [owners] + args + [self._eval(keyword.value, path) for keyword in node.keywords]
+                return _product(options, lambda parts: parts[0].format(*parts[1:1 + len(args)], **dict(zip(names, parts[1 + len(args):]))))
+        # Помощните функции '*_sql' (напр. 'overdue_days_sql' или 'utils.fine_sql') връщат част от заявка
+        functions = self._eval(func, path)
+        if functions is None or node.keywords or not all(callable(f) and getattr(f, '__name__', '').endswith('_sql') for f in functions):
+            return None
+        return _product([functions] + args, lambda parts: parts[0](*parts[1:]))
+
+
+def collect_queries(package_dir=None):
+    """Връща списък (модул.функция, ред, SQL) за модулите 'routes_*.py' и CHECKED_MODULES."""
+    package_dir = package_dir or os.path.dirname(__file__)
+    queries = []
+    for filename in sorted(os.listdir(package_dir)):
+        if not (filename.startswith('routes_') and filename.endswith('.py')) and filename not in CHECKED_MODULES:
+            continue
+        with open(os.path.join(package_dir, filename), encoding='utf8') as f:
+            tree = ast.parse(f.read(), filename=filename)
+        module = importlib.import_module(f"{__package__}.{filename[:-3]}")
+        collector = _SqlCollector(filename[:-3], vars(module))
+        collector.collect(tree)
+        queries.extend(collector.queries)
+    return queries
+
+
+def _aliases(sql):
+    aliases = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+def _partial_indexes(conn):
+    names = set()
+    for table in LARGE_TABLES:
+        for row in conn.execute(f"PRAGMA index_list({table})").fetchall():
+            if row['partial']:
+                names.add(row['name'])
+    return names
+
+
+def check_plans(conn, queries):
+    """
+    Пуска 'EXPLAIN QUERY PLAN' за всяка заявка и връща (нарушения, пропуснати, планове).
+    Обхождане на частичен индекс е допустимо - то минава само през редовете в него.
+    """
+    partial = _partial_indexes(conn)
+    violations, skipped, plans = [], [], []
+    for where, lineno, sql in queries:
+        if sql is None:
+            skipped.append((where, lineno, 'динамично съставена заявка'))
+            continue
+        try:
+            rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')).fetchall()
+        except Exception as e:
+            skipped.append((where, lineno, str(e)))
+            continue
+        aliases = _aliases(sql)
+        details = [row['detail'] for row in rows]
+        plans.append((where, lineno, sql, details))
+        for detail in details:
+            match = _SCAN.match(detail)
+            if not match:
+                continue
+            table = aliases.get(match.group(1).lower(), match.group(1).lower())
+            if table not in LARGE_TABLES or match.group(2) in partial:
+                continue
+            if (where, table) in ALLOWED_SCANS:
+                continue
+            violations.append((where, lineno, detail, sql))
+    return violations, skipped, plans
+
+
+@click.command('check-query-plans')
+@click.option('--verbose', '-v', is_flag=True, help='Показва плана на всяка заявка.')
+@with_appcontext
+def check_query_plans_command(verbose):
+    """
+    Команда 'flask check-query-plans' - проваля се (код 1), ако заявка
+    от маршрутите обхожда цяла голяма таблица без разрешение в ALLOWED_SCANS
+    или е пропусната без разрешение в ALLOWED_SKIPS.
+    """
+    violations, skipped, plans = check_plans(get_db(), collect_queries())
+    unexpected = [skip for skip in skipped if skip[0] not in ALLOWED_SKIPS]
+    if verbose:
+        for where, lineno, sql, details in plans:
+            click.echo(f"{where}:{lineno}")
+            for detail in details:
+                click.echo(f"    {detail}")
+    for where, lineno, reason in skipped:
+        allowed = ALLOWED_SKIPS.get(where)
+        click.echo(f"ПРОПУСНАТА {where}:{lineno} - {reason}" + (f" (разрешено: {allowed})" if allowed else ""))
+    for where, lineno, detail, sql in violations:
+        click.echo(f"ПЪЛНО ОБХОЖДАНЕ {where}:{lineno} - {detail}\n    {' '.join(sql.split())}")
+    click.echo(f"Проверени заявки: {len(plans)}, пропуснати: {len(skipped)} (неразрешени: {len(unexpected)}), нарушения: {len(violations)}")
+    if violations or unexpected:
+        raise SystemExit(1)
@@ -0,0 +1,72 @@
+# application/report_cache.py
+
+from datetime import date
+from flask import current_app
+from .cache import get_cache
+
+# Резултатите от справките се пазят в паметта на процеса, с ключ
+# (справка, начална дата, крайна дата, тип на филтъра) и версия на данните.
+# Тригерите от миграция 12 поддържат две версии в 'cache_versions':
+# 'reports' - при всеки запис в книги, читатели и заемания, и
+# 'reports_history' - само при запис, който засяга минали дати.
+# Справка за текущ период се пази до следващия запис, а справка за
+# приключил период - докато не се промени нещо назад във времето.
+# Записите не изтичат; старите версии се изместват по LRU. Кешът е ограничен
+# по брой записи, затова резултати с повече от REPORT_CACHE_MAX_ROWS реда не
+# се кешират, а експортът (виж 'peek_report') чете от кеша само готовото.
+
+EPOCHS = ('reports', 'reports_history')
+
+_EPOCHS_SQL = "SELECT name, version FROM cache_versions WHERE name IN (?, ?)"
+
+
+def get_report_cache(app=None):
+    app = app or current_app
+    return get_cache(app, 'reports', app.config['REPORT_CACHE_SIZE'], 0)
+
+
+def is_closed(period_end):
+    """Периодът е приключил, ако крайната му дата е преди днешната."""
+    try:
+        return date.fromisoformat(str(period_end)[:10]) < date.today()
+    except ValueError:
+        return False
+
+
+def row_count(data):
+    """Брой редове в данните на справка (списък или кортеж от списъци и числа)."""
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, tuple):
+        return sum(row_count(part) for part in data)
+    return 1
+
+
+def _report_key(conn, report, start_date, end_date, filter_type, period_end):
+    versions = dict.fromkeys(EPOCHS, 0)
+    versions.update({row['name']: row['version'] for row in conn.execute(_EPOCHS_SQL, EPOCHS)})
+    if is_closed(period_end or end_date):
+        epoch = (versions['reports_history'],)
+    else:
+        epoch = (versions['reports'], versions['reports_history'])
+    return (report, start_date, end_date, filter_type, epoch)
+
+
+def cached_report(conn, report, start_date, end_date, filter_type, load, period_end=None):
+    """
+    Връща данните на справката от кеша или ги зарежда с 'load(conn, start_date, end_date)'.
+    'period_end' е последната дата, от която зависят данните (по подразбиране 'end_date').
+    """
+    key = _report_key(conn, report, start_date, end_date, filter_type, period_end)
+    cache = get_report_cache()
+    data = cache.get(key)
+    if data is None:
+        data = load(conn, start_date, end_date)
+        if row_count(data) <= current_app.config['REPORT_CACHE_MAX_ROWS']:
+            cache.set(key, data)
+    return data
+
+
+def peek_report(conn, report, start_date, end_date, filter_type, period_end=None):
+    """Кешираните данни на справката или None - без да ги зарежда (за експорта)."""
+    return get_report_cache().get(_report_key(conn, report, start_date, end_date, filter_type, period_end))
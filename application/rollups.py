@@ -0,0 +1,279 @@
+# application/rollups.py
+
+import random
+from datetime import date, timedelta
+import click
+from flask.cli import with_appcontext
+from .database import get_db
+
+# Предварително сумирани заемания по ден ('circ_daily'), месец ('circ_monthly')
+# и година ('circ_yearly') за няколко измерения - книга, читател, жанр, пол и
+# възрастова група. Поддържат се от тригери върху 'borrows' при всяко
+# заемане, така че справките за произволен период четат няколко реда на
+# година/месец вместо да групират всички заемания. Периодът се разделя на
+# цели години, цели месеци в краищата и отделни дни в самите краища.
+# При съмнение се проверяват с 'flask check-rollups' и се преизчисляват
+# с 'flask rebuild-rollups'.
+
+# Ключове за жанр, пол и възрастова група, записани в 'borrows' в момента на
+# заемането. Сумите се водят по тях, а не по текущите данни на книгата и
+# читателя - иначе смяна на пола или жанра би изместила броенето между
+# ключовете при изтриване или преизчисляване.
+BUCKET_KEYS = {
+    'rollup_genre': "COALESCE((SELECT genre FROM books WHERE tom_no = {row}.book_tom_no), '')",
+    'rollup_gender': "COALESCE((SELECT gender FROM readers WHERE reader_no = {row}.reader_no), '')",
+    'rollup_age': "COALESCE((SELECT CASE WHEN is_under_14 THEN 'under_14' ELSE 'over_14' END FROM readers WHERE reader_no = {row}.reader_no), '')",
+}
+
+# Измерение -> колона в 'borrows'
+DIMENSIONS = {
+    'book': 'book_tom_no',
+    'reader': 'reader_no',
+    'genre': 'rollup_genre',
+    'gender': 'rollup_gender',
+    'age': 'rollup_age',
+}
+
+# Таблица -> дължина на периода в 'borrow_date' ('YYYY-MM-DD', 'YYYY-MM' или 'YYYY')
+PERIODS = {'circ_daily': 10, 'circ_monthly': 7, 'circ_yearly': 4}
+
+
+def _upserts(row, delta, keys):
+    statements = []
+    for table, length in PERIODS.items():
+        for dim, key in keys.items():
+            statements.append(
+                f"INSERT INTO {table} (dim, period, key, loans) "
+                f"VALUES ('{dim}', substr({row}.borrow_date, 1, {length}), {key}, {delta}) "
+                f"ON CONFLICT (dim, period, key) DO UPDATE SET loans = loans + ({delta});"
+            )
+    return '\n        '.join(statements)
+
+
+def _row_keys(row):
+    return {dim: f"{row}.{column}" for dim, column in DIMENSIONS.items()}
+
+
+# При вмъкване ключовете първо се записват в реда ('new' ги вижда празни),
+# затова сумите четат записаните стойности от самия ред
+_STORE_KEYS = ', '.join(f"{column} = COALESCE(new.{column}, {lookup.format(row='new')})" for column, lookup in BUCKET_KEYS.items())
+_INSERTED_KEYS = {
+    dim: f"(SELECT {column} FROM borrows WHERE borrow_id = new.borrow_id)" if column in BUCKET_KEYS else f"new.{column}"
+    for dim, column in DIMENSIONS.items()
+}
+
+ROLLUP_TRIGGERS = f"""
+    CREATE TRIGGER IF NOT EXISTS borrows_rollup_after_insert AFTER INSERT ON borrows BEGIN
+        UPDATE borrows SET {_STORE_KEYS} WHERE borrow_id = new.borrow_id;
+        {_upserts('new', 1, _INSERTED_KEYS)}
+    END;
+    CREATE TRIGGER IF NOT EXISTS borrows_rollup_after_delete AFTER DELETE ON borrows BEGIN
+        {_upserts('old', -1, _row_keys('old'))}
+    END;
+    CREATE TRIGGER IF NOT EXISTS borrows_rollup_after_update AFTER UPDATE OF borrow_date, book_tom_no, reader_no ON borrows BEGIN
+        {_upserts('old', -1, _row_keys('old'))}
+        {_upserts('new', 1, _row_keys('new'))}
+    END;
+"""
+
+
+def rebuild_rollups(conn):
+    """
+    Попълва липсващите ключове на заеманията (от текущите данни на книгата
+    и читателя), после изчиства и попълва наново сумите от всички заемания.
+    """
+    missing = ' OR '.join(f"{column} IS NULL" for column in BUCKET_KEYS)
+    store = ', '.join(f"{column} = {lookup.format(row='borrows')}" for column, lookup in BUCKET_KEYS.items())
+    conn.execute(f"UPDATE borrows SET {store} WHERE {missing}")
+    for table, length in PERIODS.items():
+        conn.execute(f"DELETE FROM {table}")
+        for dim, column in DIMENSIONS.items():
+            conn.execute(
+                f"INSERT INTO {table} (dim, period, key, loans) "
+                f"SELECT '{dim}', substr(borrow_date, 1, {length}), {column}, COUNT(*) FROM borrows GROUP BY 2, 3"
+            )
+
+
+# --- Четене ---
+
+# Сума по ключ за измерение и период: цели години + месеци и дни в двата края
+# (ключовете, чиито заемания са изтрити, остават с 0 и се пропускат)
+ROLLUP_COUNTS_SQL = """
+    SELECT key, SUM(loans) AS loans FROM (
+        SELECT key, loans FROM circ_yearly WHERE dim = ? AND period BETWEEN ? AND ?
+        UNION ALL
+        SELECT key, loans FROM circ_monthly WHERE dim = ? AND period BETWEEN ? AND ?
+        UNION ALL
+        SELECT key, loans FROM circ_monthly WHERE dim = ? AND period BETWEEN ? AND ?
+        UNION ALL
+        SELECT key, loans FROM circ_daily WHERE dim = ? AND period BETWEEN ? AND ?
+        UNION ALL
+        SELECT key, loans FROM circ_daily WHERE dim = ? AND period BETWEEN ? AND ?
+    ) GROUP BY key HAVING SUM(loans) > 0
+"""
+
+POPULAR_BOOKS_SQL = "SELECT b.title, b.author, t.loans as borrow_count FROM (" + ROLLUP_COUNTS_SQL + ") t JOIN books b ON b.tom_no = t.key ORDER BY borrow_count DESC"
+ACTIVE_READERS_SQL = "SELECT r.full_name, r.reader_no, t.loans as books_count FROM (" + ROLLUP_COUNTS_SQL + ") t JOIN readers r ON r.reader_no = t.key ORDER BY books_count DESC"
+TOTAL_LOANS_SQL = "SELECT COALESCE(SUM(loans), 0) FROM (" + ROLLUP_COUNTS_SQL + ")"
+POPULAR_COVERS_SQL = "SELECT b.*, t.loans as borrow_count FROM (" + ROLLUP_COUNTS_SQL + ") t JOIN books b ON b.tom_no = t.key WHERE b.cover_image IS NOT NULL ORDER BY borrow_count DESC LIMIT ?"
+
+# Ако периодът не е от дати (напр. ръчно въведен текст), се групират самите заемания
+RAW_POPULAR_BOOKS_SQL = "SELECT b.title, b.author, COUNT(br.borrow_id) as borrow_count FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.borrow_date BETWEEN ? AND ? GROUP BY b.tom_no ORDER BY borrow_count DESC"
+RAW_ACTIVE_READERS_SQL = "SELECT r.full_name, r.reader_no, COUNT(br.borrow_id) as books_count FROM borrows br JOIN readers r ON br.reader_no = r.reader_no WHERE br.borrow_date BETWEEN ? AND ? GROUP BY r.reader_no ORDER BY books_count DESC"
+RAW_TOTAL_LOANS_SQL = "SELECT COUNT(borrow_id) FROM borrows WHERE borrow_date BETWEEN ? AND ?"
+RAW_LOANS_BY_SQL = {
+    dim: f"SELECT {column} AS key, COUNT(*) AS loans FROM borrows WHERE borrow_date BETWEEN ? AND ? GROUP BY 1 ORDER BY loans DESC"
+    for dim, column in DIMENSIONS.items()
+}
+
+# Заемания по ключ на измерението за цели дни - за сравнение със сумите в 'flask check-rollups'
+RAW_KEY_LOANS_SQL = {
+    dim: f"SELECT {column} AS key, COUNT(*) AS loans FROM borrows WHERE substr(borrow_date, 1, 10) BETWEEN ? AND ? GROUP BY 1"
+    for dim, column in DIMENSIONS.items()
+}
+
+# Празен период (BETWEEN с обърнати граници)
+_EMPTY = ('1', '0')
+
+
+def _month_end(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+def _split_months(start, end):
+    """Разделя [start, end] на цели месеци и дни в краищата: (месеци, дни в началото, дни в края)."""
+    first_month = start if start.day == 1 else _month_end(start) + timedelta(days=1)
+    last_month_end = end if end == _month_end(end) else end.replace(day=1) - timedelta(days=1)
+    if first_month > last_month_end:
+        return _EMPTY, (start.isoformat(), end.isoformat()), _EMPTY
+    head = (start.isoformat(), (first_month - timedelta(days=1)).isoformat()) if start < first_month else _EMPTY
+    tail = ((last_month_end + timedelta(days=1)).isoformat(), end.isoformat()) if last_month_end < end else _EMPTY
+    return (first_month.strftime('%Y-%m'), last_month_end.strftime('%Y-%m')), head, tail
+
+
+def _split_edge(start, end):
+    """
+    Месеците и дните на непълна година в края на периода: (месеци, дни).
+    Единият край е граница на месец, затова дните са само в един от двата
+    обхвата на _split_months - в началния, ако няма нито един цял месец.
+    """
+    months, head, tail = _split_months(start, end)
+    return months, head if head != _EMPTY else tail
+
+
+def split_period(start_date, end_date):
+    """
+    Разделя периода [start_date, end_date] (включително) на обхвати за
+    ROLLUP_COUNTS_SQL: (години, месеци в началото, месеци в края, дни в началото, дни в края).
+    При невалидна дата хвърля ValueError.
+    """
+    start, end = date.fromisoformat(str(start_date)[:10]), date.fromisoformat(str(end_date)[:10])
+    if start > end:
+        return (_EMPTY,) * 5
+    first_year = start.year + (start != date(start.year, 1, 1))
+    last_year = end.year - (end != date(end.year, 12, 31))
+    if first_year > last_year:
+        months, head, tail = _split_months(start, end)
+        return _EMPTY, months, _EMPTY, head, tail
+    head_months, head = _split_edge(start, date(first_year, 1, 1) - timedelta(days=1)) if start.year < first_year else (_EMPTY,) * 2
+    tail_months, tail = _split_edge(date(last_year + 1, 1, 1), end) if end.year > last_year else (_EMPTY,) * 2
+    return (str(first_year), str(last_year)), head_months, tail_months, head, tail
+
+
+def rollup_params(dim, start_date, end_date):
+    """Параметрите за ROLLUP_COUNTS_SQL (и заявките, които го включват)."""
+    params = ()
+    for bounds in split_period(start_date, end_date):
+        params += (dim, *bounds)
+    return params
+
+
+def popular_books(conn, start_date, end_date):
+    """Най-заеманите книги за периода (заглавие, автор, брой) - курсор."""
+    try:
+        return conn.execute(POPULAR_BOOKS_SQL, rollup_params('book', start_date, end_date))
+    except ValueError:
+        return conn.execute(RAW_POPULAR_BOOKS_SQL, (start_date, end_date))
+
+
+def active_readers(conn, start_date, end_date):
+    """Най-активните читатели за периода (име, читателски №, брой) - курсор."""
+    try:
+        return conn.execute(ACTIVE_READERS_SQL, rollup_params('reader', start_date, end_date))
+    except ValueError:
+        return conn.execute(RAW_ACTIVE_READERS_SQL, (start_date, end_date))
+
+
+def total_loans(conn, start_date, end_date):
+    """Общ брой заемания за периода."""
+    try:
+        return conn.execute(TOTAL_LOANS_SQL, rollup_params('book', start_date, end_date)).fetchone()[0]
+    except ValueError:
+        return conn.execute(RAW_TOTAL_LOANS_SQL, (start_date, end_date)).fetchone()[0] or 0
+
+
+def popular_books_with_covers(conn, start_date, end_date, limit):
+    """Най-заеманите книги с корица за периода (за публичния каталог)."""
+    return conn.execute(POPULAR_COVERS_SQL, rollup_params('book', start_date, end_date) + (limit,)).fetchall()
+
+
+def loans_by(conn, dim, start_date, end_date):
+    """Брой заемания по ключ на измерението ('genre', 'gender', 'age', ...) за периода - курсор (key, loans)."""
+    try:
+        return conn.execute(ROLLUP_COUNTS_SQL + " ORDER BY loans DESC", rollup_params(dim, start_date, end_date))
+    except ValueError:
+        return conn.execute(RAW_LOANS_BY_SQL[dim], (start_date, end_date))
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Команда 'flask rebuild-rollups' - преизчислява сумите на заеманията от 'borrows'."""
+    conn = get_db()
+    rebuild_rollups(conn)
+    conn.commit()
+    rows = conn.execute("SELECT COUNT(*) FROM circ_daily").fetchone()[0]
+    click.echo(f"Сумите са преизчислени. Дневни редове: {rows}")
+
+
+def find_rollup_mismatches(conn, samples, seed=None):
+    """
+    Сравнява сумите по ключ за всяко измерение с групираните заемания за
+    'samples' случайни периода между първото и последното заемане.
+    Връща списък (измерение, начало, край, ключ, от сумите, от заеманията).
+    """
+    first, last = conn.execute("SELECT MIN(substr(borrow_date, 1, 10)), MAX(substr(borrow_date, 1, 10)) FROM borrows").fetchone()
+    if not first:
+        return []
+    # По година от двете страни, за да се проверят и периоди извън данните
+    low = date.fromisoformat(first) - timedelta(days=366)
+    span = (date.fromisoformat(last) - low).days + 366
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(samples):
+        start = low + timedelta(days=rng.randrange(span))
+        end = start + timedelta(days=rng.randrange(span))
+        for dim in DIMENSIONS:
+            actual = {str(row['key']): row['loans'] for row in loans_by(conn, dim, start, end)}
+            expected = {str(row['key']): row['loans'] for row in conn.execute(RAW_KEY_LOANS_SQL[dim], (start.isoformat(), end.isoformat()))}
+            for key in sorted(actual.keys() | expected.keys()):
+                if actual.get(key, 0) != expected.get(key, 0):
+                    mismatches.append((dim, start.isoformat(), end.isoformat(), key, actual.get(key, 0), expected.get(key, 0)))
+    return mismatches
+
+
+@click.command('check-rollups')
+@click.option('--samples', type=int, default=1000, help='Брой случайни периоди за проверка.')
+@click.option('--seed', type=int, default=None, help='Начално число за случайните периоди (за повторяемост).')
+@with_appcontext
+def check_rollups_command(samples, seed):
+    """
+    Команда 'flask check-rollups' - сравнява сумите по ключ с групираните
+    заемания в 'borrows' за случайни периоди.
+    """
+    mismatches = find_rollup_mismatches(get_db(), samples, seed)
+    for dim, start, end, key, actual, expected in mismatches[:50]:
+        click.echo(f"{dim} '{key}' {start} - {end}: от сумите {actual}, от заеманията {expected}")
+    click.echo(f"Проверени периоди: {samples}, разлики: {len(mismatches)}")
+    if mismatches:
+        raise SystemExit(1)
@@ -7,7 +7,8 @@ from flask import (
 )
 from werkzeug.security import generate_password_hash, check_password_hash
 from .database import get_db
-from .utils import log_activity, admin_required, login_required
+from .utils import log_activity, admin_required, login_required, paginate
+from .activity import activity_log_count
 
 # Създаване на Blueprint с име 'auth'
 auth_bp = Blueprint('auth', __name__, template_folder='templates')
@@ -124,11 +125,18 @@ def delete_user(user_id):
 @login_required
 def activity_log_page():
     page = request.args.get('page', 1, type=int)
+    after = request.args.get('after')
+    before = request.args.get('before')
     per_page = 50
-    offset = (page - 1) * per_page
+    offset = (max(page, 1) - 1) * per_page
     conn = get_db()
-    total_logs = conn.execute("SELECT COUNT(*) FROM activity_log").fetchone()[0]
-    log_entries = conn.execute("SELECT * FROM activity_log ORDER BY id DESC LIMIT ? OFFSET ?",
-                               (per_page, offset)).fetchall()
+    # Дневникът включва и архивираните записи (виж 'activity.py')
+    total_logs = activity_log_count(conn)
+    # Следваща/предишна страница се търсят по курсор (id), а не с OFFSET
+    log_entries, next_cursor, prev_cursor = paginate(
+        conn, "SELECT * FROM activity_log_all", [], [], [('id', 'id')], per_page,
+        after=after, before=before, offset=offset, descending=True
+    )
     total_pages = (total_logs + per_page - 1) // per_page
-    return render_template('activity_log.html', log_entries=log_entries, page=page, total_pages=total_pages)
\ No newline at end of file
+    return render_template('activity_log.html', log_entries=log_entries, page=page, total_pages=total_pages,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
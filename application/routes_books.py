@@ -1,8 +1,6 @@
 # application/routes_books.py
 
 import os
-import csv
-import io
 import sqlite3
 from datetime import datetime
 from flask import (
@@ -10,9 +8,13 @@ from flask import (
     current_app, send_from_directory, session, jsonify
 )
 from werkzeug.utils import secure_filename
-from .database import get_db
+from .database import get_db, get_row_count, write_transaction
+from .cache import get_cache
+from .websockets import publish_delta
+from .jobs import job, submit_job, save_upload
+from .imports import run_csv_import, book_batch_loader
 # ПРОМЯНА: Импортираме новата функция
-from .utils import login_required, log_activity, clean_int, clean_price, allowed_file, clean_date, get_setting
+from .utils import login_required, log_activity, clean_int, clean_price, allowed_file, get_setting, paginate
 
 books_bp = Blueprint('books', __name__, template_folder='templates')
 
@@ -28,40 +30,65 @@ def books_list_page():
 @books_bp.route('/api/books')
 @login_required
 def api_books():
-    """API ендпойнт, който връща книгите като JSON."""
+    """
+    API ендпойнт, който връща книгите като JSON.
+    Освен с 'page', страниците могат да се обхождат и с курсорите
+    'after'/'before' от предишния отговор (без OFFSET).
+    """
     page = request.args.get('page', 1, type=int)
     search_query = request.args.get('query', '').strip()
+    after = request.args.get('after')
+    before = request.args.get('before')
     
     # ПРОМЯНА: Използваме стойността от настройките
     per_page = int(get_setting('books_per_page', 10))
     
-    offset = (page - 1) * per_page
+    offset = (max(page, 1) - 1) * per_page
     conn = get_db()
-    
-    books = []
-    total_books = 0
 
     if search_query:
         query_for_fts = ' '.join([term + '*' for term in search_query.split()])
-        sql_books = "SELECT b.* FROM books b JOIN books_fts fts ON b.tom_no = fts.rowid WHERE books_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?"
-        sql_count = "SELECT COUNT(*) FROM books b JOIN books_fts fts ON b.tom_no = fts.rowid WHERE books_fts MATCH ?"
-        total_books = conn.execute(sql_count, (query_for_fts,)).fetchone()[0]
-        books_data = conn.execute(sql_books, (query_for_fts, per_page, offset)).fetchall()
+        select_sql = "SELECT b.*, b.rowid AS row_id, fts.rank AS rank_value FROM books b JOIN books_fts fts ON b.tom_no = fts.tom_no"
+        where, params = ["books_fts MATCH ?"], [query_for_fts]
+        keys, descending = [('fts.rank', 'rank_value'), ('b.rowid', 'row_id')], False
+        # Броят на съвпаденията се кешира за кратко - не се преброява за всяка страница
+        count_cache = get_cache(current_app, 'books_search_count', 256, 30)
+        total_books = count_cache.get(query_for_fts)
+        if total_books is None:
+            total_books = conn.execute("SELECT COUNT(*) FROM books_fts WHERE books_fts MATCH ?", (query_for_fts,)).fetchone()[0]
+            count_cache.set(query_for_fts, total_books)
     else:
-        total_books = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
-        books_data = conn.execute('SELECT * FROM books ORDER BY rowid DESC LIMIT ? OFFSET ?', (per_page, offset)).fetchall()
+        select_sql = "SELECT b.*, b.rowid AS row_id FROM books b"
+        where, params = [], []
+        keys, descending = [('b.rowid', 'row_id')], True
+        total_books = get_row_count(conn, 'books')
+
+    books_data, next_cursor, prev_cursor = paginate(
+        conn, select_sql, where, params, keys, per_page,
+        after=after, before=before, offset=offset, descending=descending
+    )
 
     total_pages = (total_books + per_page - 1) // per_page
     
     genres_data = conn.execute('SELECT * FROM genres ORDER BY name').fetchall()
     
+    books = []
+    for row in books_data:
+        book = dict(row)
+        book.pop('row_id', None)
+        book.pop('rank_value', None)
+        book['is_borrowed'] = book['current_borrow_id'] is not None
+        books.append(book)
+
     return jsonify({
-        'books': [dict(row) for row in books_data],
+        'books': books,
         'genres': [dict(row) for row in genres_data],
         'pagination': {
             'page': page,
             'total_pages': total_pages,
-            'total_books': total_books
+            'total_books': total_books,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor
         }
     })
 
@@ -148,6 +175,10 @@ def edit_book_action(tom_no):
     params = (request.form['title'], request.form['author'], request.form['isbn'], final_genre, clean_int(request.form['publish_year']), clean_price(request.form['price']), 'is_donation' in request.form, cover_filename, tom_no)
     conn.execute(sql, params)
     conn.commit()
+    publish_delta(
+        'book_updated', tom_no=tom_no, title=request.form['title'], author=request.form['author'],
+        genre=final_genre, publish_year=clean_int(request.form['publish_year'])
+    )
     log_activity("Редактирана книга", f"Книга '{request.form['title']}' (Инв.№ {tom_no})")
     flash("Промените по книгата са запазени.", "success")
     
@@ -160,14 +191,23 @@ def delete_book(tom_no):
     conn = get_db()
     book = conn.execute('SELECT title, cover_image FROM books WHERE tom_no = ?', (tom_no,)).fetchone()
     if book:
+        # Заеманията пазят историята на книгата (и FOREIGN KEY не позволява изтриването)
+        if conn.execute('SELECT 1 FROM borrows WHERE book_tom_no = ? LIMIT 1', (tom_no,)).fetchone():
+            flash(f"ГРЕШКА: Книга '{book['title']}' има история на заемане и не може да бъде изтрита.", 'danger')
+            return redirect(request.referrer or url_for('books.books_list_page'))
+        try:
+            with write_transaction(conn):
+                conn.execute('DELETE FROM books WHERE tom_no = ?', (tom_no,))
+        except sqlite3.IntegrityError:
+            flash(f"ГРЕШКА: Книга '{book['title']}' има история на заемане и не може да бъде изтрита.", 'danger')
+            return redirect(request.referrer or url_for('books.books_list_page'))
+        # Корицата се изтрива едва след като записът е изтрит
         if book['cover_image']:
             try:
                 cover_path = os.path.join(current_app.root_path, '..', current_app.config['COVERS_FOLDER'], book['cover_image'])
                 os.remove(cover_path)
             except OSError as e:
                 print(f"Error deleting cover file: {e}")
-        conn.execute('DELETE FROM books WHERE tom_no = ?', (tom_no,))
-        conn.commit()
         log_activity("Изтрита книга", f"Книга '{book['title']}' (Инв.№ {tom_no})")
         flash(f"Книга '{book['title']}' беше изтрита.", 'success')
     return redirect(url_for('books.books_list_page'))
@@ -179,33 +219,19 @@ def import_books_page():
         file = request.files.get('csv_file')
         if not file or file.filename == '':
             flash("Моля, изберете CSV файл за качване.", "warning"); return redirect(request.url)
-        try:
-            file_content = file.stream.read()
-            try: decoded_content = file_content.decode('utf-8')
-            except UnicodeDecodeError: decoded_content = file_content.decode('windows-1251')
-            dialect = csv.Sniffer().sniff(decoded_content.splitlines()[0]); stream = io.StringIO(decoded_content, newline=None); csv_reader = csv.reader(stream, dialect)
-            conn = get_db(); cursor = conn.cursor(); next(csv_reader)
-            books_added, errors_found = 0, 0
-            for i, row in enumerate(csv_reader):
-                try:
-                    if not row or len(row) < 8: continue
-                    tom_no, isbn, author, title, genre, publish_year, record_date, price = row[:8]
-                    if not tom_no or not title: continue
-                    params = (tom_no, isbn, author, title, genre, clean_int(publish_year), clean_date(record_date), clean_price(price))
-                    cursor.execute("INSERT OR IGNORE INTO books (tom_no, isbn, author, title, genre, publish_year, record_date, price) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", params)
-                    if genre: cursor.execute("INSERT OR IGNORE INTO genres (name) VALUES (?)", (genre.strip(),))
-                    books_added += 1
-                except sqlite3.Error as row_error:
-                    errors_found += 1; print(f"!!! Грешка на ред {i+2}: {row_error} --> ДАННИ: {row}");
-            conn.commit()
-            print("Преизграждане на FTS индекса за книги..."); conn.execute("INSERT INTO books_fts(books_fts) VALUES('rebuild');"); conn.commit(); print("Индексът е преизграден.")
-            log_activity("Импорт на книги", f"Импортирани са {books_added} книги.")
-            flash(f"Импортирането завърши. Добавени са {books_added} книги.", "success")
-            return redirect(url_for('books.books_list_page'))
-        except Exception as e:
-            flash(f"Възникна грешка при импортирането: {e}", "danger"); return redirect(url_for('books.import_books_page'))
+        # ПРОМЯНА: Файлът се обработва от фонова задача - прогресът се вижда в '/jobs'
+        path = save_upload(file)
+        submit_job('import_books', {'path': path}, f"Импорт на книги от {file.filename}")
+        flash("Импортирането е пуснато като фонова задача. Прогресът се вижда по-долу.", "info")
+        return redirect(url_for('jobs.jobs_page'))
     return render_template('import.html')
 
+@job('import_books', 'Импорт на книги', resumable=True)
+def import_books_job(ctx):
+    state = run_csv_import(ctx, book_batch_loader(), 'import_books_errors.csv')
+    ctx.log("Импорт на книги", f"Импортирани са {state['added']} книги.")
+    ctx.progress(state['rows'], message=f"Добавени са {state['added']} книги, пропуснати редове: {state['errors']}")
+
 @books_bp.route('/covers/<path:filename>')
 def serve_cover(filename):
     directory = os.path.abspath(os.path.join(current_app.root_path, '..', current_app.config['COVERS_FOLDER']))
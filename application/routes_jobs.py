@@ -0,0 +1,151 @@
+# application/routes_jobs.py
+
+import os
+import uuid
+from flask import Blueprint, render_template, redirect, url_for, flash, jsonify, send_file, abort, request, session, current_app
+from .database import get_db
+from .utils import login_required, admin_required
+from .jobs import JOB_HANDLERS, job_dict, submit_job, resume_job, jobs_folder
+
+jobs_bp = Blueprint('jobs', __name__, template_folder='templates')
+
+# Задачи за поддръжка, които администраторът може да пусне ръчно
+MAINTENANCE_JOBS = ('backup', 'rebuild_fts', 'optimize', 'archive_activity')
+
+JOBS_LIST_SQL = "SELECT * FROM jobs ORDER BY id DESC LIMIT 50"
+
+# Импорти, които могат да се пуснат от файл, качен на части
+UPLOAD_IMPORTS = {
+    'books': ('import_books', "Импорт на книги от {}"),
+    'readers': ('import_readers', "Импорт на читатели от {}"),
+}
+
+
+@jobs_bp.route('/jobs')
+@login_required
+def jobs_page():
+    jobs = [job_dict(row) for row in get_db().execute(JOBS_LIST_SQL).fetchall()]
+    maintenance = [JOB_HANDLERS[kind] for kind in MAINTENANCE_JOBS]
+    return render_template('jobs.html', jobs=jobs, maintenance=maintenance)
+
+
+@jobs_bp.route('/api/jobs')
+@login_required
+def api_jobs():
+    return jsonify([job_dict(row) for row in get_db().execute(JOBS_LIST_SQL).fetchall()])
+
+
+@jobs_bp.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    row = get_db().execute("SELECT status, result_path, result_name FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not row or row['status'] != 'done' or not row['result_path'] or not os.path.exists(row['result_path']):
+        abort(404)
+    return send_file(row['result_path'], as_attachment=True, download_name=row['result_name'])
+
+
+@jobs_bp.route('/jobs/<int:job_id>/resume', methods=['POST'])
+@login_required
+def resume_failed_job(job_id):
+    if resume_job(get_db(), job_id):
+        flash(f"Задача {job_id} продължава от последната записана порция.", "info")
+    else:
+        flash(f"Задача {job_id} не може да бъде продължена.", "warning")
+    return redirect(url_for('jobs.jobs_page'))
+
+
+@jobs_bp.route('/jobs/start/<kind>', methods=['POST'])
+@admin_required
+def start_maintenance_job(kind):
+    if kind not in MAINTENANCE_JOBS:
+        abort(404)
+    submit_job(kind)
+    flash(f"Задачата „{JOB_HANDLERS[kind].title}“ е добавена в опашката.", "info")
+    return redirect(url_for('jobs.jobs_page'))
+
+
+# --- Качване на големи файлове на части (с възобновяване) ---
+# Клиентът създава качване, изпраща частите последователно с отместването им
+# и при прекъсване пита колко байта са получени и продължава оттам.
+# Получените байтове са размерът на файла в папката на задачите.
+
+def _upload_path(upload_id):
+    return os.path.join(jobs_folder(), 'uploads', f"{upload_id}.part")
+
+
+def _upload_or_404(upload_id):
+    upload = get_db().execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+    if upload is None:
+        abort(404)
+    return upload
+
+
+def _upload_state(upload):
+    path = _upload_path(upload['id'])
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+    return {'id': upload['id'], 'filename': upload['filename'], 'size': upload['size'],
+            'received': received, 'job_id': upload['job_id'], 'chunk_size': current_app.config['UPLOAD_CHUNK_BYTES']}
+
+
+@jobs_bp.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename, size = data.get('filename'), data.get('size')
+    if not filename or not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'Липсва име или размер на файла.'}), 400
+    upload_id = uuid.uuid4().hex
+    os.makedirs(os.path.dirname(_upload_path(upload_id)), exist_ok=True)
+    open(_upload_path(upload_id), 'wb').close()
+    conn = get_db()
+    conn.execute("INSERT INTO uploads (id, filename, size, created_by) VALUES (?, ?, ?, ?)",
+                 (upload_id, filename, size, session.get('username')))
+    conn.commit()
+    return jsonify(_upload_state(_upload_or_404(upload_id))), 201
+
+
+@jobs_bp.route('/uploads/<upload_id>')
+@login_required
+def upload_status(upload_id):
+    return jsonify(_upload_state(_upload_or_404(upload_id)))
+
+
+@jobs_bp.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id):
+    """Добавя една част. Параметърът 'offset' трябва да съвпада с вече получените байтове."""
+    state = _upload_state(_upload_or_404(upload_id))
+    offset = request.args.get('offset', type=int)
+    if offset != state['received'] or state['job_id']:
+        # Клиентът продължава от 'received' в отговора
+        return jsonify(state), 409
+    with open(_upload_path(upload_id), 'ab') as f:
+        while True:
+            chunk = request.stream.read(64 * 1024)
+            if not chunk:
+                break
+            f.write(chunk)
+    state = _upload_state(_upload_or_404(upload_id))
+    if state['received'] > state['size']:
+        return jsonify({**state, 'error': 'Получени са повече байтове от обявения размер.'}), 400
+    return jsonify(state)
+
+
+@jobs_bp.route('/uploads/<upload_id>/import/<target>', methods=['POST'])
+@login_required
+def import_upload(upload_id, target):
+    """Пуска импорта на напълно качен файл като фонова задача."""
+    if target not in UPLOAD_IMPORTS:
+        abort(404)
+    upload = _upload_or_404(upload_id)
+    state = _upload_state(upload)
+    if state['job_id']:
+        return jsonify({'job_id': state['job_id'], 'redirect': url_for('jobs.jobs_page')})
+    if state['received'] != state['size']:
+        return jsonify({**state, 'error': 'Файлът не е качен изцяло.'}), 409
+    kind, title = UPLOAD_IMPORTS[target]
+    job_id = submit_job(kind, {'path': _upload_path(upload_id)}, title.format(upload['filename']))
+    conn = get_db()
+    conn.execute("UPDATE uploads SET job_id = ? WHERE id = ?", (job_id, upload_id))
+    conn.commit()
+    return jsonify({'job_id': job_id, 'redirect': url_for('jobs.jobs_page')})
@@ -1,13 +1,16 @@
 # application/routes_readers.py
 
-import csv
-import io
+import sqlite3
 from datetime import date
 from flask import (
     Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
 )
-from .database import get_db
-from .utils import login_required, log_activity, clean_date, clean_int
+from .database import get_db, write_transaction
+from .utils import login_required, log_activity, fts_prefix_query, paginate
+from .fines import reader_fine_totals
+from .websockets import publish_delta
+from .jobs import job, submit_job, save_upload
+from .imports import run_csv_import, reader_batch_loader
 
 readers_bp = Blueprint('readers', __name__, template_folder='templates')
 
@@ -33,22 +36,34 @@ def readers_list_page():
 @readers_bp.route('/api/readers')
 @login_required
 def api_readers():
-    """API ендпойнт, който връща читателите като JSON."""
+    """
+    API ендпойнт, който връща читателите като JSON - по страници, подредени по име.
+    Търсенето е по начало на дума в име, читателски №, телефон, имейл и град (readers_fts).
+    """
     conn = get_db()
-    search_query = request.args.get('query', '').strip().lower()
-    
-    all_readers_sql = "SELECT * FROM readers ORDER BY full_name"
-    all_readers = conn.execute(all_readers_sql).fetchall()
-
-    if search_query:
-        filtered_list = [
-            dict(row) for row in all_readers
-            if search_query in str(row['full_name']).lower() or search_query in str(row['reader_no']).lower()
-        ]
-    else:
-        filtered_list = [dict(row) for row in all_readers]
-        
-    return jsonify(filtered_list)
+    search_query = request.args.get('query', '').strip()
+    per_page = current_app.config['READERS_PER_PAGE']
+
+    select_sql = "SELECT r.*, r.rowid AS row_id FROM readers r"
+    where, params = [], []
+    fts_query = fts_prefix_query(search_query)
+    if fts_query:
+        select_sql += " JOIN readers_fts fts ON fts.rowid = r.rowid"
+        where.append("readers_fts MATCH ?")
+        params.append(fts_query)
+
+    readers, next_cursor, _ = paginate(
+        conn, select_sql, where, params, [('r.full_name', 'full_name'), ('r.rowid', 'row_id')], per_page,
+        after=request.args.get('after')
+    )
+
+    readers_list = []
+    for row in readers:
+        reader = dict(row)
+        reader.pop('row_id', None)
+        readers_list.append(reader)
+
+    return jsonify({'readers': readers_list, 'next_cursor': next_cursor})
 
 
 @readers_bp.route('/reader/<string:reader_no>')
@@ -60,11 +75,13 @@ def reader_details_page(reader_no):
         flash('Читател не е намерен!', 'danger')
         return redirect(url_for('readers.readers_list_page'))
 
-    current_borrows = conn.execute("SELECT b.title, br.borrow_date, br.due_date, b.tom_no FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.reader_no = ? AND br.return_date IS NULL ORDER BY br.due_date", (reader_no,)).fetchall()
+    current_borrows = conn.execute("SELECT b.title, br.borrow_date, br.due_date, br.accrued_fine AS fine, b.tom_no FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.reader_no = ? AND br.return_date IS NULL ORDER BY br.due_date", (reader_no,)).fetchall()
     unpaid_fines = conn.execute("SELECT b.title, br.return_date, br.fine_amount, br.borrow_id, b.tom_no FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.reader_no = ? AND br.fine_amount > 0 AND br.fine_paid_date IS NULL ORDER BY br.return_date", (reader_no,)).fetchall()
     borrow_history = conn.execute("SELECT b.title, br.borrow_date, br.return_date, br.fine_amount, br.fine_paid_date, b.tom_no FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.reader_no = ? ORDER BY br.borrow_date DESC", (reader_no,)).fetchall()
 
-    return render_template('reader_details.html', reader=reader, current_borrows=current_borrows, unpaid_fines=unpaid_fines, borrow_history=borrow_history)
+    fine_totals = reader_fine_totals(conn, reader_no)
+
+    return render_template('reader_details.html', reader=reader, current_borrows=current_borrows, unpaid_fines=unpaid_fines, borrow_history=borrow_history, fine_totals=fine_totals)
 
 @readers_bp.route('/add_reader', methods=['POST'])
 @login_required
@@ -114,6 +131,7 @@ def edit_reader_page(reader_no):
         )
         conn.execute(sql, params)
         conn.commit()
+        publish_delta('reader_updated', reader_no=reader_no, full_name=form_data['full_name'])
         log_activity("Редактиран читател", f"Читател '{form_data['full_name']}' (№ {reader_no})")
         flash("Данните за читателя са обновени.", "success")
         return redirect(url_for('readers.readers_list_page'))
@@ -128,14 +146,23 @@ def edit_reader_page(reader_no):
 def delete_reader(reader_no):
     conn = get_db()
     reader = conn.execute('SELECT full_name FROM readers WHERE reader_no = ?', (reader_no,)).fetchone()
+    if not reader:
+        return redirect(url_for('readers.readers_list_page'))
     borrowed_books = conn.execute('SELECT 1 FROM borrows WHERE reader_no = ? AND return_date IS NULL', (reader_no,)).fetchone()
+    # Заеманията пазят историята на читателя (и FOREIGN KEY не позволява изтриването)
+    has_history = conn.execute('SELECT 1 FROM borrows WHERE reader_no = ? LIMIT 1', (reader_no,)).fetchone()
     
     if borrowed_books:
         flash(f"ГРЕШКА: Читателят '{reader['full_name']}' има незавърнати книги и не може да бъде изтрит.", "danger")
+    elif has_history:
+        flash(f"ГРЕШКА: Читателят '{reader['full_name']}' има история на заемане и не може да бъде изтрит.", "danger")
     else:
-        conn.execute('DELETE FROM readers WHERE reader_no = ?', (reader_no,))
-        conn.commit()
-        if reader:
+        try:
+            with write_transaction(conn):
+                conn.execute('DELETE FROM readers WHERE reader_no = ?', (reader_no,))
+        except sqlite3.IntegrityError:
+            flash(f"ГРЕШКА: Читателят '{reader['full_name']}' има история на заемане и не може да бъде изтрит.", "danger")
+        else:
             log_activity("Изтрит читател", f"Читател '{reader['full_name']}' (№ {reader_no})")
             flash(f"Читател '{reader['full_name']}' е изтрит.", 'success')
             
@@ -162,43 +189,18 @@ def import_readers_page():
         if not file or file.filename == '':
             flash("Моля, изберете CSV файл за качване.", "warning")
             return redirect(request.url)
-        try:
-            file_content = file.stream.read()
-            try:
-                decoded_content = file_content.decode('utf-8')
-            except UnicodeDecodeError:
-                decoded_content = file_content.decode('windows-1251')
-                
-            dialect = csv.Sniffer().sniff(decoded_content.splitlines()[0])
-            stream = io.StringIO(decoded_content, newline=None)
-            csv_reader = csv.reader(stream, dialect)
+        # ПРОМЯНА: Файлът се обработва от фонова задача - прогресът се вижда в '/jobs'
+        path = save_upload(file)
+        submit_job('import_readers', {'path': path}, f"Импорт на читатели от {file.filename}")
+        flash("Импортирането е пуснато като фонова задача. Прогресът се вижда по-долу.", "info")
+        return redirect(url_for('jobs.jobs_page'))
             
-            conn = get_db()
-            cursor = conn.cursor()
-            next(csv_reader) # Skip header
-            
-            readers_added = 0
-            for row in csv_reader:
-                if len(row) == 11:
-                    reader_no, full_name, city, address, phone, email, profession, education, gender, registration_date, is_under_14 = row
-                    
-                    is_under_14_bool = 1 if is_under_14.lower() in ['да', 'yes', 'true', '1'] else 0
-                    cleaned_date = clean_date(registration_date)
-                    reg_year = clean_int(cleaned_date[:4]) if cleaned_date else date.today().year
-                    
-                    final_profession = add_new_entry('professions', profession)
-                    final_education = add_new_entry('educations', education)
-
-                    sql = "INSERT OR IGNORE INTO readers (reader_no, full_name, city, address, phone, email, profession, education, gender, registration_date, is_under_14, last_registration_year) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-                    params = (reader_no, full_name, city, address, phone, email, final_profession, final_education, gender, cleaned_date, is_under_14_bool, reg_year)
-                    cursor.execute(sql, params)
-                    readers_added += 1
-            conn.commit()
-            log_activity("Импорт на читатели", f"Импортирани са {readers_added} читатели.")
-            flash(f"Импортирането завърши. Добавени са {readers_added} читатели.", "success")
-            return redirect(url_for('readers.readers_list_page'))
-        except Exception as e:
-            flash(f"Възникна грешка при импортирането: {e}", "danger")
-            return redirect(url_for('readers.import_readers_page'))
-            
-    return render_template('import_readers.html')
\ No newline at end of file
+    return render_template('import_readers.html')
+
+
+@job('import_readers', 'Импорт на читатели', resumable=True)
+def import_readers_job(ctx):
+    # Отчетът с пропуснатите редове се сваля от страницата със задачите
+    state = run_csv_import(ctx, reader_batch_loader(ctx.conn), 'import_readers_errors.csv')
+    ctx.log("Импорт на читатели", f"Импортирани са {state['added']} читатели.")
+    ctx.progress(state['rows'], message=f"Добавени са {state['added']} читатели, пропуснати редове: {state['errors']}")
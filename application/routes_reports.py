@@ -1,11 +1,14 @@
 # application/routes_reports.py
 
-import io
-import csv
 from datetime import date, datetime
-from flask import Blueprint, render_template, request, Response
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from .database import get_db
 from .utils import login_required
+from .exports import ExportSection, ExportDependencyError, FORMATS, ListCursor, MappedCursor, export_response, write_export, check_export_dependency
+from .jobs import job, submit_job
+from .report_cache import cached_report, peek_report, get_report_cache
+from . import rollups
+from .activity import day_range
 
 reports_bp = Blueprint('reports', __name__, template_folder='templates')
 
@@ -36,33 +39,107 @@ def get_dates_from_request():
         
     return start_date, end_date, period_text
 
-def generate_csv(data, headers):
-    """Генерира CSV файл от данни и го връща като HTTP Response."""
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(headers)
-    for row in data:
-        writer.writerow(row)
-    
-    return Response(
-        output.getvalue().encode('utf-8-sig'), # utf-8-sig за правилна работа с кирилица в Excel
-        mimetype='text/csv',
-        headers={"Content-Disposition": "attachment;filename=report.csv"}
+def get_filter_type():
+    """Типът на филтъра така, както го тълкува get_dates_from_request ('year' или 'period')."""
+    if request.args.get('filter_type') == 'period' and request.args.get('start_date') and request.args.get('end_date'):
+        return 'period'
+    return 'year'
+
+# --- Данни, общи за справките и за експорта ---
+
+# Всяка функция _query_* (conn, start_date, end_date) връща курсор(и) на
+# справката, а _load_* - готовите редове. Те се кешират (виж 'report_cache.py'),
+# така че експортът след HTML изгледа за същия период не пуска заявките
+# втори път; ако ги няма в кеша, експортът чете направо от курсора.
+
+NEW_BOOKS_SQL = "SELECT tom_no, title, author, is_donation, price, record_date FROM books WHERE record_date BETWEEN ? AND ? ORDER BY record_date"
+UNDER_14_SQL = "SELECT reader_no, full_name, registration_date FROM readers WHERE is_under_14 = 1 AND last_registration_year = ? ORDER BY full_name"
+GENDER_STATS_SQL = "SELECT gender, COUNT(*) as count FROM readers WHERE registration_date BETWEEN ? AND ? GROUP BY gender"
+PROFESSION_STATS_SQL = "SELECT profession, COUNT(*) as count FROM readers WHERE registration_date BETWEEN ? AND ? GROUP BY profession ORDER BY count DESC"
+EDUCATION_STATS_SQL = "SELECT education, COUNT(*) as count FROM readers WHERE registration_date BETWEEN ? AND ? GROUP BY education ORDER BY count DESC"
+
+# Възрастовите групи в сумите на заеманията (виж 'rollups.py')
+AGE_GROUPS = {'under_14': 'До 14 г.', 'over_14': 'Над 14 г.'}
+
+def _under_14_year(start_date):
+    return datetime.strptime(start_date, '%Y-%m-%d').year
+
+def _query_new_books(conn, start_date, end_date):
+    return conn.execute(NEW_BOOKS_SQL, (start_date, end_date))
+
+def _query_under_14(conn, start_date, end_date):
+    return conn.execute(UNDER_14_SQL, (_under_14_year(start_date),))
+
+def _query_reader_stats(conn, start_date, end_date):
+    return (
+        conn.execute(GENDER_STATS_SQL, (start_date, end_date)),
+        conn.execute(PROFESSION_STATS_SQL, (start_date, end_date)),
+        conn.execute(EDUCATION_STATS_SQL, (start_date, end_date)),
     )
 
+def _query_loan_stats(conn, start_date, end_date):
+    # Заеманията по жанр, пол и възраст на читателя към момента на заемането
+    return (
+        rollups.loans_by(conn, 'genre', start_date, end_date),
+        rollups.loans_by(conn, 'gender', start_date, end_date),
+        rollups.loans_by(conn, 'age', start_date, end_date),
+    )
+
+def _load_new_books(conn, start_date, end_date):
+    return _query_new_books(conn, start_date, end_date).fetchall()
+
+def _load_under_14(conn, start_date, end_date):
+    return _query_under_14(conn, start_date, end_date).fetchall()
+
+def _load_active_readers(conn, start_date, end_date):
+    return rollups.active_readers(conn, start_date, end_date).fetchall()
+
+def _load_popular_books(conn, start_date, end_date):
+    # Броят заемания се чете от сумите по ден/месец (виж 'rollups.py')
+    return rollups.popular_books(conn, start_date, end_date).fetchall(), rollups.total_loans(conn, start_date, end_date)
+
+def _load_reader_stats(conn, start_date, end_date):
+    return tuple(cursor.fetchall() for cursor in _query_reader_stats(conn, start_date, end_date))
+
+def _load_loan_stats(conn, start_date, end_date):
+    return tuple(cursor.fetchall() for cursor in _query_loan_stats(conn, start_date, end_date))
+
+def _period_end(report, start_date):
+    # Справката за деца зависи от цялата година на началната дата
+    return f"{_under_14_year(start_date)}-12-31" if report == 'under_14' else None
+
+def report_data(conn, report, start_date, end_date, filter_type):
+    """Данните на справката (от кеша, ако са налични за същите параметри и версия на данните)."""
+    load = REPORT_LOADERS[report]
+    return cached_report(conn, report, start_date, end_date, filter_type, load, _period_end(report, start_date))
+
+def cached_data(conn, report, start_date, end_date, filter_type):
+    """Кешираните данни на справката или None - тогава експортът чете от курсор."""
+    return peek_report(conn, report, start_date, end_date, filter_type, _period_end(report, start_date))
+
+REPORT_LOADERS = {
+    'new_books': _load_new_books,
+    'under_14': _load_under_14,
+    'active_readers': _load_active_readers,
+    'popular_books': _load_popular_books,
+    'reader_stats': _load_reader_stats,
+    'loan_stats': _load_loan_stats,
+}
+
 # --- Маршрути за справки (HTML) ---
 
 @reports_bp.route('/reports')
 @login_required
 def reports_page():
-    return render_template('reports.html')
+    # Броячите на кеша на справките се показват на администратора
+    cache_stats = get_report_cache().stats() if session.get('role') == 'admin' else None
+    return render_template('reports.html', cache_stats=cache_stats)
 
 @reports_bp.route('/report/new_books')
 @login_required
 def report_new_books():
     start_date, end_date, period_text = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT tom_no, title, author, is_donation, price, record_date FROM books WHERE record_date BETWEEN ? AND ? ORDER BY record_date", (start_date, end_date)).fetchall()
+    results = report_data(get_db(), 'new_books', start_date, end_date, get_filter_type())
     
     total_count = len(results)
     donated_count = sum(1 for r in results if r['is_donation'])
@@ -79,12 +156,7 @@ def report_new_books():
 @login_required
 def report_under_14():
     start_date, end_date, period_text = get_dates_from_request()
-    year_to_check = datetime.strptime(start_date, '%Y-%m-%d').year
-    conn = get_db()
-    results = conn.execute(
-        "SELECT reader_no, full_name, registration_date FROM readers WHERE is_under_14 = 1 AND last_registration_year = ? ORDER BY full_name",
-        (year_to_check,)
-    ).fetchall()
+    results = report_data(get_db(), 'under_14', start_date, end_date, get_filter_type())
     title = f"Активни читатели до 14 г. {period_text}"
     return render_template('report_results.html', title=title, results=results, total_count=len(results), headers=['Читателски №', 'Име', 'Дата на регистрация'])
 
@@ -92,30 +164,30 @@ def report_under_14():
 @login_required
 def report_active_readers():
     start_date, end_date, period_text = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT r.full_name, r.reader_no, COUNT(br.borrow_id) as books_count FROM borrows br JOIN readers r ON br.reader_no = r.reader_no WHERE br.borrow_date BETWEEN ? AND ? GROUP BY r.reader_no ORDER BY books_count DESC", (start_date, end_date)).fetchall()
+    results = report_data(get_db(), 'active_readers', start_date, end_date, get_filter_type())
     return render_template('report_results.html', title=f"Най-активни читатели {period_text}", results=results, total_count=len(results), headers=['Име', 'Читателски №', 'Брой заети книги'])
 
 @reports_bp.route('/report/popular_books')
 @login_required
 def report_popular_books():
     start_date, end_date, period_text = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT b.title, b.author, COUNT(br.borrow_id) as borrow_count FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.borrow_date BETWEEN ? AND ? GROUP BY b.tom_no ORDER BY borrow_count DESC", (start_date, end_date)).fetchall()
-    total_borrows_row = conn.execute("SELECT COUNT(borrow_id) FROM borrows WHERE borrow_date BETWEEN ? AND ?", (start_date, end_date)).fetchone()
-    total_borrows = total_borrows_row[0] or 0
+    results, total_borrows = report_data(get_db(), 'popular_books', start_date, end_date, get_filter_type())
     return render_template('report_results.html', title=f"Най-популярни книги {period_text}", results=results, total_count=len(results), total_borrows=total_borrows, headers=['Заглавие', 'Автор', 'Брой заемания'])
 
 @reports_bp.route('/report/reader_stats')
 @login_required
 def report_reader_stats():
     start_date, end_date, period_text = get_dates_from_request()
-    conn = get_db()
-    gender_stats = conn.execute("SELECT gender, COUNT(*) as count FROM readers WHERE registration_date BETWEEN ? AND ? GROUP BY gender", (start_date, end_date)).fetchall()
-    profession_stats = conn.execute("SELECT profession, COUNT(*) as count FROM readers WHERE registration_date BETWEEN ? AND ? GROUP BY profession ORDER BY count DESC", (start_date, end_date)).fetchall()
-    education_stats = conn.execute("SELECT education, COUNT(*) as count FROM readers WHERE registration_date BETWEEN ? AND ? GROUP BY education ORDER BY count DESC", (start_date, end_date)).fetchall()
+    gender_stats, profession_stats, education_stats = report_data(get_db(), 'reader_stats', start_date, end_date, get_filter_type())
     return render_template('report_reader_stats.html', title=f"Демографска справка {period_text}", gender_stats=gender_stats, profession_stats=profession_stats, education_stats=education_stats)
 
+@reports_bp.route('/report/loan_stats')
+@login_required
+def report_loan_stats():
+    start_date, end_date, period_text = get_dates_from_request()
+    genre_stats, gender_stats, age_stats = report_data(get_db(), 'loan_stats', start_date, end_date, get_filter_type())
+    return render_template('report_loan_stats.html', title=f"Заемания по жанр и читатели {period_text}", genre_stats=genre_stats, gender_stats=gender_stats, age_stats=age_stats, age_groups=AGE_GROUPS)
+
 @reports_bp.route('/report/activity')
 @login_required
 def activity_report_page():
@@ -123,8 +195,9 @@ def activity_report_page():
     start_date, end_date, period_text = get_dates_from_request()
     conn = get_db()
     
-    # Дефинираме SQL заявките с филтър по дата
-    base_query = " FROM activity_log WHERE date(timestamp) BETWEEN ? AND ?"
+    # Дефинираме SQL заявките с филтър по дата - полуотворен обхват по индекса,
+    # през изгледа, който включва и архивираните записи (виж 'activity.py')
+    base_query = " FROM activity_log_all WHERE timestamp >= ? AND timestamp < ?"
     
     actions_by_user_sql = "SELECT username, COUNT(*) as action_count" + base_query + " GROUP BY username ORDER BY action_count DESC"
     actions_by_type_sql = "SELECT action, COUNT(*) as action_count" + base_query + " GROUP BY action ORDER BY action_count DESC"
@@ -132,10 +205,11 @@ def activity_report_page():
     logs_sql = "SELECT *" + base_query + " ORDER BY timestamp DESC LIMIT 1000"
 
     # Изпълняваме заявките с параметри за дата
-    actions_by_user = conn.execute(actions_by_user_sql, (start_date, end_date)).fetchall()
-    actions_by_type = conn.execute(actions_by_type_sql, (start_date, end_date)).fetchall()
-    total_actions = conn.execute(total_actions_sql, (start_date, end_date)).fetchone()[0]
-    logs = conn.execute(logs_sql, (start_date, end_date)).fetchall()
+    bounds = day_range(start_date, end_date)
+    actions_by_user = conn.execute(actions_by_user_sql, bounds).fetchall()
+    actions_by_type = conn.execute(actions_by_type_sql, bounds).fetchall()
+    total_actions = conn.execute(total_actions_sql, bounds).fetchone()[0]
+    logs = conn.execute(logs_sql, bounds).fetchall()
 
     return render_template(
         'report_activity.html', 
@@ -146,54 +220,138 @@ def activity_report_page():
         total_actions=total_actions
     )
 
-# --- Маршрути за експорт (CSV) ---
+# --- Експорт (CSV, XLSX, PDF - според параметъра 'format') ---
+
+# Всяка справка за експорт е функция (conn, start_date, end_date, filter_type) -> (заглавие, секции).
+# Едни и същи функции се ползват за CSV потока и за фоновата задача за XLSX/PDF.
+# Ако справката е в кеша, редовете идват от него; иначе се четат от курсора
+# на порции, без да се събират в паметта (и без да се кешират). Дневникът на
+# дейността не се кешира (пише се при почти всяко действие).
+
+def _export_new_books(conn, start_date, end_date, filter_type):
+    cached = cached_data(conn, 'new_books', start_date, end_date, filter_type)
+    rows = ListCursor(cached) if cached is not None else _query_new_books(conn, start_date, end_date)
+    cursor = MappedCursor(rows, lambda r: (r['tom_no'], r['title'], r['author'], 'Дарение' if r['is_donation'] else 'Покупка', r['price'], r['record_date']))
+    headers = ['Инв. №', 'Заглавие', 'Автор', 'Тип', 'Цена', 'Дата на запис']
+    return "Нови книги", [ExportSection(None, headers, cursor)]
+
+def _export_under_14(conn, start_date, end_date, filter_type):
+    cached = cached_data(conn, 'under_14', start_date, end_date, filter_type)
+    cursor = ListCursor(cached) if cached is not None else _query_under_14(conn, start_date, end_date)
+    headers = ['Читателски №', 'Име', 'Дата на регистрация']
+    return "Читатели до 14 г.", [ExportSection(None, headers, cursor)]
+
+def _export_active_readers(conn, start_date, end_date, filter_type):
+    cached = cached_data(conn, 'active_readers', start_date, end_date, filter_type)
+    cursor = ListCursor(cached) if cached is not None else rollups.active_readers(conn, start_date, end_date)
+    headers = ['Име', 'Читателски №', 'Брой заети книги']
+    return "Най-активни читатели", [ExportSection(None, headers, cursor)]
+
+def _export_popular_books(conn, start_date, end_date, filter_type):
+    cached = cached_data(conn, 'popular_books', start_date, end_date, filter_type)
+    cursor = ListCursor(cached[0]) if cached is not None else rollups.popular_books(conn, start_date, end_date)
+    headers = ['Заглавие', 'Автор', 'Брой заемания']
+    return "Най-популярни книги", [ExportSection(None, headers, cursor)]
+
+def _export_reader_stats(conn, start_date, end_date, filter_type):
+    cached = cached_data(conn, 'reader_stats', start_date, end_date, filter_type)
+    cursors = [ListCursor(rows) for rows in cached] if cached is not None else _query_reader_stats(conn, start_date, end_date)
+    gender_stats, profession_stats, education_stats = cursors
+    return "Демографска справка", [
+        ExportSection("По пол", ['Пол', 'Брой'], gender_stats),
+        ExportSection("По професия", ['Професия', 'Брой'], profession_stats),
+        ExportSection("По образование", ['Образование', 'Брой'], education_stats),
+    ]
+
+def _export_loan_stats(conn, start_date, end_date, filter_type):
+    cached = cached_data(conn, 'loan_stats', start_date, end_date, filter_type)
+    cursors = [ListCursor(rows) for rows in cached] if cached is not None else _query_loan_stats(conn, start_date, end_date)
+    genre_stats, gender_stats, age_stats = cursors
+    return "Заемания по жанр и читатели", [
+        ExportSection("По жанр", ['Жанр', 'Брой заемания'], genre_stats),
+        ExportSection("По пол на читателя", ['Пол', 'Брой заемания'], gender_stats),
+        ExportSection("По възраст на читателя", ['Възраст', 'Брой заемания'], MappedCursor(age_stats, lambda r: (AGE_GROUPS.get(r['key'], r['key']), r['loans']))),
+    ]
+
+def _export_activity(conn, start_date, end_date, filter_type):
+    cursor = conn.execute("SELECT timestamp, username, action, details FROM activity_log_all WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp DESC", day_range(start_date, end_date))
+    headers = ['Дата и час', 'Потребител', 'Действие', 'Детайли']
+    return "Дневник на дейността", [ExportSection(None, headers, cursor)]
+
+REPORT_EXPORTS = {
+    'new_books': _export_new_books,
+    'under_14': _export_under_14,
+    'active_readers': _export_active_readers,
+    'popular_books': _export_popular_books,
+    'reader_stats': _export_reader_stats,
+    'loan_stats': _export_loan_stats,
+    'activity': _export_activity,
+}
+
+def send_export(report):
+    """
+    Изпраща справката във формата от параметъра 'format' (csv по подразбиране, xlsx, pdf).
+    CSV се изпраща веднага като поток; XLSX и PDF се подготвят от фонова задача
+    и се свалят от страницата със задачите.
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in FORMATS:
+        flash(f"Неподдържан формат за експорт: {fmt}", 'danger')
+        return redirect(url_for('reports.reports_page'))
+    start_date, end_date, period_text = get_dates_from_request()
+    if fmt == 'csv':
+        title, sections = REPORT_EXPORTS[report](get_db(), start_date, end_date, get_filter_type())
+        return export_response(sections, fmt, title, period_text, report)
+    try:
+        check_export_dependency(fmt)
+    except ExportDependencyError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('reports.reports_page'))
+    params = {'report': report, 'format': fmt, 'start_date': start_date, 'end_date': end_date,
+              'filter_type': get_filter_type(), 'period_text': period_text}
+    submit_job('export_report', params, f"Експорт ({fmt.upper()}): {report} {period_text}")
+    flash("Експортът се подготвя като фонова задача. Файлът ще може да се свали от тази страница.", "info")
+    return redirect(url_for('jobs.jobs_page'))
+
+@job('export_report', 'Експорт на справка')
+def export_report_job(ctx):
+    params = ctx.params
+    title, sections = REPORT_EXPORTS[params['report']](ctx.conn, params['start_date'], params['end_date'], params.get('filter_type', 'year'))
+    sections = [section._replace(cursor=ctx.track(section.cursor, "Запис на редовете")) for section in sections]
+    with open(ctx.result_file(f"{params['report']}.{params['format']}"), 'wb') as out:
+        write_export(sections, params['format'], title, params['period_text'], out)
 
 @reports_bp.route('/export/new_books')
 @login_required
 def export_report_new_books():
-    start_date, end_date, _ = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT tom_no, title, author, CASE WHEN is_donation THEN 'Дарение' ELSE 'Покупка' END, price, record_date FROM books WHERE record_date BETWEEN ? AND ? ORDER BY record_date", (start_date, end_date)).fetchall()
-    headers = ['Инв. №', 'Заглавие', 'Автор', 'Тип', 'Цена', 'Дата на запис']
-    return generate_csv(results, headers)
-    
+    return send_export('new_books')
+
 @reports_bp.route('/export/under_14')
 @login_required
 def export_under_14():
-    start_date, _, _ = get_dates_from_request()
-    year_to_check = datetime.strptime(start_date, '%Y-%m-%d').year
-    conn = get_db()
-    results = conn.execute(
-        "SELECT reader_no, full_name, registration_date FROM readers WHERE is_under_14 = 1 AND last_registration_year = ? ORDER BY full_name",
-        (year_to_check,)
-    ).fetchall()
-    headers = ['Читателски №', 'Име', 'Дата на регистрация']
-    return generate_csv(results, headers)
+    return send_export('under_14')
 
 @reports_bp.route('/export/active_readers')
 @login_required
 def export_active_readers():
-    start_date, end_date, _ = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT r.full_name, r.reader_no, COUNT(br.borrow_id) as books_count FROM borrows br JOIN readers r ON br.reader_no = r.reader_no WHERE br.borrow_date BETWEEN ? AND ? GROUP BY r.reader_no ORDER BY books_count DESC", (start_date, end_date)).fetchall()
-    headers = ['Име', 'Читателски №', 'Брой заети книги']
-    return generate_csv(results, headers)
-    
+    return send_export('active_readers')
+
 @reports_bp.route('/export/popular_books')
 @login_required
 def export_popular_books():
-    start_date, end_date, _ = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT b.title, b.author, COUNT(br.borrow_id) as borrow_count FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no WHERE br.borrow_date BETWEEN ? AND ? GROUP BY b.tom_no ORDER BY borrow_count DESC", (start_date, end_date)).fetchall()
-    headers = ['Заглавие', 'Автор', 'Брой заемания']
-    return generate_csv(results, headers)
+    return send_export('popular_books')
+
+@reports_bp.route('/export/reader_stats')
+@login_required
+def export_reader_stats():
+    return send_export('reader_stats')
+
+@reports_bp.route('/export/loan_stats')
+@login_required
+def export_loan_stats():
+    return send_export('loan_stats')
 
 @reports_bp.route('/export/activity')
 @login_required
 def export_report_activity():
-    # ПРОМЯНА: Добавяме филтриране и при експорт
-    start_date, end_date, _ = get_dates_from_request()
-    conn = get_db()
-    results = conn.execute("SELECT timestamp, username, action, details FROM activity_log WHERE date(timestamp) BETWEEN ? AND ? ORDER BY timestamp DESC", (start_date, end_date)).fetchall()
-    headers = ['Дата и час', 'Потребител', 'Действие', 'Детайли']
-    return generate_csv(results, headers)
\ No newline at end of file
+    return send_export('activity')
@@ -1,10 +1,14 @@
 # application/routes_settings.py
 
 from flask import (
-    Blueprint, render_template, request, redirect, url_for, flash, session
+    Blueprint, render_template, request, redirect, url_for, flash, session, jsonify,
+    current_app
 )
-from .database import get_db
-from .utils import admin_required, log_activity
+from .database import get_db, get_pool, get_lanes, bump_version, write_transaction
+from .utils import admin_required, log_activity, invalidate_settings
+from .fines import accrue_fines
+from .dashboard import get_dashboard
+from .scheduling import get_scheduler
 
 settings_bp = Blueprint('settings', __name__, template_folder='templates')
 
@@ -16,9 +20,15 @@ def settings_page():
     if request.method == 'POST':
         settings_to_update = request.form
         try:
-            for key, value in settings_to_update.items():
-                conn.execute("UPDATE settings SET value = ? WHERE key = ?", (value, key))
-            conn.commit()
+            with write_transaction(conn):
+                for key, value in settings_to_update.items():
+                    conn.execute("UPDATE settings SET value = ? WHERE key = ?", (value, key))
+                bump_version(conn, 'settings')
+            invalidate_settings()
+            if 'fine_per_day' in settings_to_update:
+                # Новата глоба на ден важи веднага и за вече начислените суми
+                with write_transaction(conn):
+                    accrue_fines(conn, force=True)
             log_activity("Промяна на настройки", f"Администратор '{session.get('username')}' обнови системните настройки.")
             flash('Настройките бяха успешно запазени!', 'success')
         except Exception as e:
@@ -31,4 +41,20 @@ def settings_page():
     settings_data = conn.execute("SELECT key, value, description FROM settings").fetchall()
     settings = {row['key']: row for row in settings_data}
     
-    return render_template('settings.html', settings=settings)
\ No newline at end of file
+    return render_template('settings.html', settings=settings)
+
+@settings_bp.route('/api/system_stats')
+@admin_required
+def api_system_stats():
+    """Вътрешни броячи на системата (пул от връзки и др.) за администратора."""
+    caches = current_app.extensions.get('caches', {})
+    writer = current_app.extensions.get('activity_writer')
+    return jsonify({
+        'db_pool': get_pool().stats(),
+        'db_lanes': get_lanes().stats(),
+        'db_contention': current_app.extensions['db_contention'].stats(),
+        'requests': get_scheduler().stats(),
+        'caches': {name: cache.stats() for name, cache in caches.items()},
+        'dashboard': get_dashboard().stats(),
+        'activity_writer': writer.stats() if writer else None,
+    })
@@ -2,13 +2,18 @@
 
 import os
 import base64
+import sqlite3
 from datetime import date, datetime, timedelta
 from flask import (
     Blueprint, render_template, request, redirect, url_for, flash,
     jsonify, current_app, send_from_directory
 )
-from .database import get_db
-from .utils import login_required, log_activity, calculate_fine, format_date_dmy, get_setting
+from .database import get_db, write_transaction
+from .websockets import publish_delta
+from .utils import (
+    login_required, log_activity, calculate_fine, format_date_dmy, get_setting,
+    fts_prefix_query, overdue_days_sql
+)
 
 transactions_bp = Blueprint('transactions', __name__, template_folder='templates')
 
@@ -19,7 +24,7 @@ def borrow_page():
     current_year_val = date.today().year
     conn = get_db()
     
-    available_books_sql = "SELECT * FROM books WHERE tom_no NOT IN (SELECT book_tom_no FROM borrows WHERE return_date IS NULL) ORDER BY title"
+    available_books_sql = "SELECT * FROM books WHERE current_borrow_id IS NULL ORDER BY title"
     available_books = conn.execute(available_books_sql).fetchall()
     
     all_readers_sql = "SELECT * FROM readers WHERE last_registration_year = ? ORDER BY full_name"
@@ -27,6 +32,30 @@ def borrow_page():
     
     return render_template('borrow_book.html', books=available_books, readers=all_readers, selected_reader=selected_reader)
 
+# Данни за едно заемане във вида, в който ги показват страниците (и '/api/borrowed_books')
+OPEN_LOAN_SQL = """
+    SELECT b.tom_no, b.title, b.author, r.full_name, r.reader_no, br.due_date, br.borrow_id, br.signature_path,
+           br.accrued_fine AS fine, strftime('%d.%m.%Y', br.due_date) AS due_date_formatted
+    FROM borrows br
+    JOIN books b ON br.book_tom_no = b.tom_no
+    JOIN readers r ON br.reader_no = r.reader_no
+    WHERE br.borrow_id = ?
+"""
+
+def _borrowed_count(conn):
+    return conn.execute('SELECT COUNT(*) FROM books WHERE current_borrow_id IS NOT NULL').fetchone()[0]
+
+def _signature_path(filename):
+    return os.path.join(current_app.root_path, '..', current_app.config['SIGNATURES_FOLDER'], filename)
+
+def _discard_signature(filename):
+    """Изтрива подписа на заемане, което не е записано."""
+    if filename:
+        try:
+            os.remove(_signature_path(filename))
+        except OSError:
+            pass
+
 @transactions_bp.route('/process_borrow', methods=['POST'])
 @login_required
 def process_borrow():
@@ -55,10 +84,8 @@ def process_borrow():
             safe_tom_no = book_tom_no.replace('/', '-').replace('\\', '-')
             
             signature_filename = f"{borrow_date.strftime('%Y%m%d%H%M%S')}_{safe_reader_no}_{safe_tom_no}.png"
-            signatures_folder_path = os.path.join(current_app.root_path, '..', current_app.config['SIGNATURES_FOLDER'])
-            signature_path = os.path.join(signatures_folder_path, signature_filename)
             
-            with open(signature_path, "wb") as f:
+            with open(_signature_path(signature_filename), "wb") as f:
                 f.write(img_data)
         except Exception as e:
             flash(f'Грешка при запазване на подпис: {e}', 'danger')
@@ -66,13 +93,27 @@ def process_borrow():
 
     conn = get_db()
     try:
-        sql = 'INSERT INTO borrows (book_tom_no, reader_no, borrow_date, due_date, signature_path) VALUES (?, ?, ?, ?, ?)'
-        conn.execute(sql, (book_tom_no, reader_no, borrow_date, due_date, signature_filename))
-        conn.commit()
+        # Заемането е атомарно: уникалният индекс върху отворените заемания
+        # (миграция 14) не допуска второ заемане на същата книга, дори от друго гише
+        with write_transaction(conn):
+            sql = 'INSERT INTO borrows (book_tom_no, reader_no, borrow_date, due_date, signature_path) VALUES (?, ?, ?, ?, ?)'
+            borrow_id = conn.execute(sql, (book_tom_no, reader_no, borrow_date, due_date, signature_filename)).lastrowid
+    except sqlite3.IntegrityError as e:
+        _discard_signature(signature_filename)
+        if 'UNIQUE' in str(e):
+            flash('Книгата вече е заета и не може да бъде заета отново.', 'danger')
+        else:
+            flash(f'Грешка при запис в базата данни: {e}', 'danger')
+        return redirect(url_for('transactions.borrow_page', selected_reader=reader_no))
     except Exception as e:
+       _discard_signature(signature_filename)
        flash(f'Грешка при запис в базата данни: {e}', 'danger')
        return redirect(url_for('transactions.borrow_page'))
 
+    loan = conn.execute(OPEN_LOAN_SQL, (borrow_id,)).fetchone()
+    if loan:
+        publish_delta('loan_opened', borrowed_count=_borrowed_count(conn), **dict(loan))
+
     book = conn.execute('SELECT title FROM books WHERE tom_no = ?', (book_tom_no,)).fetchone()
     reader = conn.execute('SELECT full_name FROM readers WHERE reader_no = ?', (reader_no,)).fetchone()
     if book and reader:
@@ -93,51 +134,90 @@ def return_page():
     """Рендерира само празната страница, данните се зареждат динамично."""
     return render_template('return_book.html')
 
+# Позволени колони за подреждане на заетите книги
+BORROWED_SORT_COLUMNS = {
+    'due_date': 'br.due_date',
+    'borrow_date': 'br.borrow_date',
+    'reader': 'r.full_name',
+    'title': 'b.title',
+    'fine': 'br.accrued_fine',
+}
+
 @transactions_bp.route('/api/borrowed_books')
 @login_required
 def api_borrowed_books():
-    """API ендпойнт, който връща заетите книги като JSON."""
+    """
+    API ендпойнт, който връща заетите книги като JSON.
+    Търсенето и форматирането на датата са в самата заявка, а глобата е начислената в 'borrows'.
+    Параметри: query, page, per_page, sort (due_date|borrow_date|reader|title|fine), order (asc|desc).
+    """
     conn = get_db()
     search_query = request.args.get('query', '').strip()
-    
-    base_sql = """
-        SELECT b.tom_no, b.title, b.author, r.full_name, r.reader_no, br.due_date, br.borrow_id, br.signature_path 
-        FROM borrows br 
-        JOIN books b ON br.book_tom_no = b.tom_no 
-        JOIN readers r ON br.reader_no = r.reader_no 
-        WHERE br.return_date IS NULL 
-        ORDER BY br.due_date
-    """
-    
-    all_borrowed = conn.execute(base_sql).fetchall()
-    
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+    sort_column = BORROWED_SORT_COLUMNS.get(request.args.get('sort'), 'br.due_date')
+    sort_order = 'DESC' if request.args.get('order', '').lower() == 'desc' else 'ASC'
+
+    where_sql = "WHERE br.return_date IS NULL"
+    params = []
     if search_query:
-        search_lower = search_query.lower()
-        filtered_list = [
-            dict(row) for row in all_borrowed 
-            if search_lower in str(row['full_name']).lower() or search_lower in str(row['tom_no']).lower()
-        ]
-    else:
-        filtered_list = [dict(row) for row in all_borrowed]
-    
-    for row in filtered_list:
-        row['fine'] = calculate_fine(row['due_date'])
-        row['due_date_formatted'] = format_date_dmy(row['due_date'])
-        
-    return jsonify(filtered_list)
+        # Име на читател - по начало на дума (readers_fts), инв. № - като подниз
+        fts_query = fts_prefix_query(search_query)
+        escaped = search_query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        where_sql += " AND (r.rowid IN (SELECT rowid FROM readers_fts WHERE readers_fts MATCH ?) OR br.book_tom_no LIKE ? ESCAPE '\\')"
+        params.extend([fts_query, f"%{escaped}%"])
+
+    from_sql = """
+        FROM borrows br
+        JOIN books b ON br.book_tom_no = b.tom_no
+        JOIN readers r ON br.reader_no = r.reader_no
+    """
+    total = conn.execute(f"SELECT COUNT(*) {from_sql} {where_sql}", params).fetchone()[0]
+
+    items_sql = f"""
+        SELECT b.tom_no, b.title, b.author, r.full_name, r.reader_no, br.due_date, br.borrow_id, br.signature_path,
+               br.accrued_fine AS fine,
+               {overdue_days_sql('br.due_date')} AS overdue_days,
+               strftime('%d.%m.%Y', br.due_date) AS due_date_formatted
+        {from_sql} {where_sql}
+        ORDER BY {sort_column} {sort_order}, br.borrow_id
+        LIMIT ? OFFSET ?
+    """
+    rows = conn.execute(items_sql, params + [per_page, (page - 1) * per_page]).fetchall()
+
+    return jsonify({
+        'items': [dict(row) for row in rows],
+        'pagination': {
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'total_pages': (total + per_page - 1) // per_page
+        }
+    })
 
 @transactions_bp.route('/return_book/<int:borrow_id>', methods=['POST'])
 @login_required
 def return_book(borrow_id):
     conn = get_db()
-    borrow_info_sql = "SELECT b.title, r.full_name, br.due_date FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no JOIN readers r ON br.reader_no = r.reader_no WHERE br.borrow_id = ?"
+    borrow_info_sql = "SELECT b.title, b.tom_no, r.full_name, r.reader_no, br.due_date FROM borrows br JOIN books b ON br.book_tom_no = b.tom_no JOIN readers r ON br.reader_no = r.reader_no WHERE br.borrow_id = ?"
     borrow_info = conn.execute(borrow_info_sql, (borrow_id,)).fetchone()
     
     if borrow_info:
         return_datetime = datetime.now()
         final_fine = calculate_fine(borrow_info['due_date'])
-        conn.execute('UPDATE borrows SET return_date = ?, fine_amount = ? WHERE borrow_id = ?', (return_datetime, final_fine, borrow_id))
-        conn.commit()
+        # Връща се само отворено заемане - повторно натискане (или друго гише) не презаписва датата и глобата
+        with write_transaction(conn):
+            returned = conn.execute(
+                'UPDATE borrows SET return_date = ?, fine_amount = ? WHERE borrow_id = ? AND return_date IS NULL',
+                (return_datetime, final_fine, borrow_id)
+            ).rowcount
+        if not returned:
+            flash(f"Книга '{borrow_info['title']}' вече е върната.", "warning")
+            return redirect(url_for('transactions.return_page'))
+        publish_delta(
+            'loan_closed', borrow_id=borrow_id, tom_no=borrow_info['tom_no'], reader_no=borrow_info['reader_no'],
+            fine=final_fine, borrowed_count=_borrowed_count(conn)
+        )
         log_activity("Връщане на книга", f"Книга '{borrow_info['title']}' върната от '{borrow_info['full_name']}'")
         flash(f"Книга '{borrow_info['title']}' е върната.", "success")
         if final_fine > 0:
@@ -151,8 +231,8 @@ def pay_fine(borrow_id):
     conn = get_db()
     borrow_info = conn.execute("SELECT reader_no FROM borrows WHERE borrow_id = ?", (borrow_id,)).fetchone()
     if borrow_info:
-        conn.execute("UPDATE borrows SET fine_paid_date = ? WHERE borrow_id = ?", (date.today(), borrow_id))
-        conn.commit()
+        with write_transaction(conn):
+            conn.execute("UPDATE borrows SET fine_paid_date = ? WHERE borrow_id = ?", (date.today(), borrow_id))
         flash("Глобата е маркирана като платена.", "success")
         return redirect(url_for('readers.reader_details_page', reader_no=borrow_info['reader_no']))
         
@@ -0,0 +1,175 @@
+# application/scheduling.py
+
+import math
+import time
+from collections import OrderedDict
+from flask import current_app, g, request, jsonify
+from eventlet.semaphore import Semaphore
+
+# Всички HTTP заявки се обслужват от един процес. За да не чакат заемането и
+# връщането на книги зад тежки справки или зад публичните киоски, всяка
+# заявка се причислява към клас според маршрута (before_request) и заема място
+# в неговата лента до края си (teardown_request):
+#   - 'circulation' - гишето (заемане, връщане, глоби); без ограничение, а в
+#                     лентата за четене на базата има запазени само за него места
+#                     (DB_READ_RESERVED, виж 'db_lanes.py');
+#   - 'reports'     - справки и експорт; малко места и ограничена опашка;
+#   - 'public'      - публичният каталог; общо ограничени места и опашка, плюс
+#                     ограничение на честотата за всеки клиент;
+#   - 'default'     - всичко останало, без ограничение.
+# При натоварване (заето гише или твърде много активни заявки) новите
+# справки и публични заявки се отказват с 503 и 'Retry-After'.
+
+# Клас по blueprint (или по конкретен маршрут - 'blueprint.функция')
+REQUEST_CLASSES = {
+    'transactions': 'circulation',
+    'reports': 'reports',
+    'public': 'public',
+}
+
+# Класове, които се отказват първи при натоварване
+LOW_PRIORITY = ('reports', 'public')
+
+# Най-много клиенти, за които се пази кофа с жетони
+MAX_CLIENTS = 10000
+
+
+def classify(endpoint):
+    if not endpoint or endpoint == 'static':
+        return None
+    return REQUEST_CLASSES.get(endpoint, REQUEST_CLASSES.get(endpoint.split('.')[0], 'default'))
+
+
+class RequestLane:
+    """Ограничен брой едновременни заявки от един клас и опашка пред тях."""
+
+    def __init__(self, slots, queue_limit=None, wait_seconds=None):
+        self.slots = slots
+        self.queue_limit = queue_limit
+        self.wait_seconds = wait_seconds
+        self._sem = Semaphore(slots) if slots else None
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self):
+        """Заема място; връща False, ако опашката е пълна или изчакването е изтекло."""
+        if self._sem is None:
+            self.active += 1
+            return True
+        if not self._sem.acquire(blocking=False):
+            if self.queue_limit is not None and self.waiting >= self.queue_limit:
+                return False
+            self.waiting += 1
+            try:
+                if not self._sem.acquire(timeout=self.wait_seconds):
+                    return False
+            finally:
+                self.waiting -= 1
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        if self._sem is not None:
+            self._sem.release()
+
+
+class TokenBuckets:
+    """Кофа с жетони за всеки клиент: 'rate' заявки в секунда, до 'burst' наведнъж."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = OrderedDict()
+
+    def take(self, client):
+        """Взима жетон; връща 0 при успех или след колко секунди ще има жетон."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class RequestScheduler:
+    """Класифицира заявките и ги пропуска през лентите (в 'app.extensions['scheduler']')."""
+
+    def __init__(self, app):
+        config = app.config
+        self.lanes = {
+            'circulation': RequestLane(None),
+            'reports': RequestLane(config['REPORT_SLOTS'], config['REPORT_QUEUE_LIMIT'], config['REPORT_QUEUE_SECONDS']),
+            'public': RequestLane(config['PUBLIC_SLOTS'], config['PUBLIC_QUEUE_LIMIT'], config['PUBLIC_QUEUE_SECONDS']),
+            'default': RequestLane(None),
+        }
+        self.buckets = TokenBuckets(config['PUBLIC_RATE_PER_SECOND'], config['PUBLIC_RATE_BURST'])
+        self.circulation_busy = config['CIRCULATION_BUSY']
+        self.shed_active = config['REQUEST_SHED_ACTIVE']
+        self.retry_after = config['REQUEST_RETRY_AFTER']
+        self._stats = {name: {'admitted': 0, 'rejected': 0, 'shed': 0, 'rate_limited': 0} for name in self.lanes}
+
+    def overloaded(self):
+        """Гишето е заето или общо активните заявки са над прага."""
+        active = sum(lane.active for lane in self.lanes.values())
+        return self.lanes['circulation'].active >= self.circulation_busy or active >= self.shed_active
+
+    def admit(self):
+        """before_request: връща отговор 429/503, ако заявката не се допуска."""
+        name = classify(request.endpoint)
+        if name is None:
+            return None
+        stats = self._stats[name]
+        if name in LOW_PRIORITY and self.overloaded():
+            stats['shed'] += 1
+            return _busy("Системата е натоварена. Опитайте отново след малко.", 503, self.retry_after)
+        if name == 'public':
+            wait = self.buckets.take(request.remote_addr or '')
+            if wait:
+                stats['rate_limited'] += 1
+                return _busy("Твърде много заявки. Опитайте отново след малко.", 429, wait)
+        if not self.lanes[name].acquire():
+            stats['rejected'] += 1
+            message = "Има много чакащи справки." if name == 'reports' else "Системата е натоварена."
+            return _busy(f"{message} Опитайте отново след малко.", 503, self.retry_after)
+        stats['admitted'] += 1
+        g.request_class = name
+        return None
+
+    def release(self, exc=None):
+        """teardown_request: освобождава мястото на заявката."""
+        name = g.pop('request_class', None)
+        if name is not None:
+            self.lanes[name].release()
+
+    def stats(self):
+        data = {}
+        for name, lane in self.lanes.items():
+            data[name] = dict(self._stats[name], active=lane.active, waiting=lane.waiting, slots=lane.slots)
+        data['clients'] = len(self.buckets._buckets)
+        return data
+
+
+def _busy(message, status, retry_after):
+    headers = {'Retry-After': str(max(1, math.ceil(retry_after)))}
+    if request.path.startswith('/api/') or request.is_json:
+        return jsonify({'error': message}), status, headers
+    return message, status, headers
+
+
+def get_scheduler():
+    return current_app.extensions['scheduler']
+
+
+def init_app(app):
+    """Регистрира класифицирането и лентите за заявките."""
+    scheduler = RequestScheduler(app)
+    app.extensions['scheduler'] = scheduler
+    app.before_request(scheduler.admit)
+    app.teardown_request(scheduler.release)
@@ -13,7 +13,8 @@ document.addEventListener('DOMContentLoaded', function () {
     let allGenres = []; // Ще пазим жанровете тук, за да не ги зареждаме всеки път
 
     // --- Функции, специфични за СПИСЪКА С КНИГИ ---
-    async function fetchBooks(page = 1, query = '') {
+    // cursor: { after: '...' } или { before: '...' } - страниране по курсор за съседните страници
+    async function fetchBooks(page = 1, query = '', cursor = {}) {
         if (!loadingSpinner || !tableContainer) return; // Спираме, ако не сме на страницата със списъка
         
         loadingSpinner.style.display = 'block';
@@ -22,7 +23,10 @@ document.addEventListener('DOMContentLoaded', function () {
             currentPage = page;
             currentQuery = query;
 
-            const response = await fetch(`/api/books?page=${page}&query=${encodeURIComponent(query)}`);
+            const params = new URLSearchParams({ page: page, query: query });
+            if (cursor.after) params.set('after', cursor.after);
+            if (cursor.before) params.set('before', cursor.before);
+            const response = await fetch(`/api/books?${params.toString()}`);
             if (!response.ok) throw new Error('Network response was not ok');
             
             const data = await response.json();
@@ -52,13 +56,13 @@ document.addEventListener('DOMContentLoaded', function () {
             const availability = book.is_borrowed ? '<span class="badge bg-warning text-dark">Заета</span>' : '<span class="badge bg-success">Налична</span>';
             const detailUrl = `/book/${book.tom_no}?back_url=${backUrl}`;
             tableBodyHtml += `
-                <tr>
+                <tr data-tom-no="${book.tom_no}">
                     <td>${book.tom_no}</td>
-                    <td><a href="${detailUrl}">${book.title}</a></td>
-                    <td>${book.author}</td>
-                    <td>${book.genre || ''}</td>
-                    <td>${book.publish_year || ''}</td>
-                    <td>${availability}</td>
+                    <td><a href="${detailUrl}" class="book-title">${book.title}</a></td>
+                    <td class="book-author">${book.author}</td>
+                    <td class="book-genre">${book.genre || ''}</td>
+                    <td class="book-year">${book.publish_year || ''}</td>
+                    <td class="book-availability">${availability}</td>
                     <td class="d-flex flex-nowrap">
                         <button class="btn btn-sm btn-outline-primary edit-book-btn" 
                                 data-bs-toggle="modal" 
@@ -104,7 +108,8 @@ document.addEventListener('DOMContentLoaded', function () {
         }
 
         let paginationHtml = '<nav><ul class="pagination justify-content-center">';
-        paginationHtml += `<li class="page-item ${currentPage === 1 ? 'disabled' : ''}"><a class="page-link" href="#" data-page="${currentPage - 1}">Предишна</a></li>`;
+        const prevCursor = pagination.prev_cursor ? `data-before="${pagination.prev_cursor}"` : '';
+        paginationHtml += `<li class="page-item ${currentPage === 1 ? 'disabled' : ''}"><a class="page-link" href="#" data-page="${currentPage - 1}" ${prevCursor}>Предишна</a></li>`;
 
         const pagesToShow = new Set([1]);
         const windowSize = 2;
@@ -122,7 +127,8 @@ document.addEventListener('DOMContentLoaded', function () {
             lastPage = page;
         }
 
-        paginationHtml += `<li class="page-item ${currentPage === totalPages ? 'disabled' : ''}"><a class="page-link" href="#" data-page="${currentPage + 1}">Следваща</a></li>`;
+        const nextCursor = pagination.next_cursor ? `data-after="${pagination.next_cursor}"` : '';
+        paginationHtml += `<li class="page-item ${currentPage === totalPages ? 'disabled' : ''}"><a class="page-link" href="#" data-page="${currentPage + 1}" ${nextCursor}>Следваща</a></li>`;
         paginationHtml += '</ul></nav>';
         paginationContainer.innerHTML = paginationHtml;
     }
@@ -167,7 +173,9 @@ document.addEventListener('DOMContentLoaded', function () {
                 e.preventDefault();
                 const page = parseInt(e.target.dataset.page, 10);
                 if (page !== currentPage) {
-                    fetchBooks(page, currentQuery);
+                    // Предишна/Следваща ползват курсора от сървъра; номерата на страници - OFFSET
+                    const cursor = { after: e.target.dataset.after, before: e.target.dataset.before };
+                    fetchBooks(page, currentQuery, cursor);
                 }
             }
         });
@@ -226,6 +234,24 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     });
 
+    // Промени от други бюра (заемане, връщане, редакция) се прилагат върху видимите редове
+    document.addEventListener('circulation:delta', (event) => {
+        if (!tableContainer) return;
+        const delta = event.detail;
+        const row = tableContainer.querySelector(`tr[data-tom-no="${CSS.escape(delta.tom_no || '')}"]`);
+        if (!row) return;
+        if (delta.type === 'loan_opened' || delta.type === 'loan_closed') {
+            row.querySelector('.book-availability').innerHTML = delta.type === 'loan_opened'
+                ? '<span class="badge bg-warning text-dark">Заета</span>'
+                : '<span class="badge bg-success">Налична</span>';
+        } else if (delta.type === 'book_updated') {
+            row.querySelector('.book-title').textContent = delta.title;
+            row.querySelector('.book-author').textContent = delta.author;
+            row.querySelector('.book-genre').textContent = delta.genre || '';
+            row.querySelector('.book-year').textContent = delta.publish_year || '';
+        }
+    });
+
     // Първоначално зареждане - ще се случи само ако сме на страницата със списъка
     if (tableContainer) {
         const urlParams = new URLSearchParams(window.location.search);
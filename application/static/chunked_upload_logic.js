@@ -0,0 +1,90 @@
+// static/chunked_upload_logic.js
+
+// Качване на CSV файла за импорт на части. При прекъсната връзка
+// качването продължава от последния получен байт (и след презареждане на
+// страницата - номерът на качването се пази в localStorage). След като файлът
+// е качен изцяло, импортът се пуска като фонова задача.
+document.addEventListener('DOMContentLoaded', function () {
+    const form = document.querySelector('form[data-chunked-import]');
+    if (!form || !window.fetch || !Blob.prototype.slice) return; // остава обикновеното качване
+
+    const target = form.dataset.chunkedImport;
+    const uploadsUrl = form.dataset.uploadsUrl;
+    const fileInput = form.querySelector('input[type="file"]');
+    const submitButton = form.querySelector('button[type="submit"]');
+    const progressBox = document.getElementById('upload-progress');
+    const progressBar = progressBox.querySelector('.progress-bar');
+    const statusText = document.getElementById('upload-status');
+
+    const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+    function showProgress(received, size, text) {
+        const percent = size ? Math.floor(100 * received / size) : 0;
+        progressBar.style.width = percent + '%';
+        progressBar.textContent = percent + '%';
+        statusText.textContent = text;
+    }
+
+    async function getJson(url, options) {
+        const response = await fetch(url, options);
+        const data = await response.json();
+        return { response, data };
+    }
+
+    async function findOrCreateUpload(file, key) {
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            const { response, data } = await getJson(`${uploadsUrl}/${savedId}`);
+            if (response.ok && !data.job_id) return data;
+        }
+        const { response, data } = await getJson(uploadsUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size })
+        });
+        if (!response.ok) throw new Error(data.error || response.statusText);
+        localStorage.setItem(key, data.id);
+        return data;
+    }
+
+    form.addEventListener('submit', async function (event) {
+        event.preventDefault();
+        const file = fileInput.files[0];
+        if (!file) return;
+
+        const key = `chunked-upload:${target}:${file.name}:${file.size}:${file.lastModified}`;
+        submitButton.disabled = true;
+        progressBox.classList.remove('d-none');
+        try {
+            const upload = await findOrCreateUpload(file, key);
+            let received = upload.received;
+            let failures = 0;
+            while (received < file.size) {
+                showProgress(received, file.size, received ? `Качване... (${Math.round(received / 1048576)} от ${Math.round(file.size / 1048576)} MB)` : 'Качване...');
+                try {
+                    const chunk = file.slice(received, received + upload.chunk_size);
+                    const { response, data } = await getJson(`${uploadsUrl}/${upload.id}?offset=${received}`, { method: 'PUT', body: chunk });
+                    // 409 - сървърът има друг брой байтове; продължаваме от неговия
+                    if (!response.ok && response.status !== 409) throw new Error(data.error || response.statusText);
+                    received = data.received;
+                    failures = 0;
+                } catch (error) {
+                    if (++failures > 5) throw error;
+                    showProgress(received, file.size, `Връзката прекъсна, нов опит след ${2 * failures} сек...`);
+                    await sleep(2000 * failures);
+                    const { data } = await getJson(`${uploadsUrl}/${upload.id}`);
+                    received = data.received;
+                }
+            }
+            showProgress(file.size, file.size, 'Файлът е качен. Стартиране на импорта...');
+            const { response, data } = await getJson(`${uploadsUrl}/${upload.id}/import/${target}`, { method: 'POST' });
+            if (!response.ok) throw new Error(data.error || response.statusText);
+            localStorage.removeItem(key);
+            window.location.href = data.redirect;
+        } catch (error) {
+            statusText.textContent = `Грешка при качването: ${error.message}. Изберете същия файл отново, за да продължите.`;
+            progressBar.classList.add('bg-danger');
+            submitButton.disabled = false;
+        }
+    });
+});
@@ -1,23 +1,57 @@
 # application/utils.py
 
 import re
+import json
+import base64
 from datetime import date, timedelta, datetime
 from functools import wraps
 from flask import current_app, session, redirect, url_for, flash, g
-from .database import get_db
+from .database import get_db, get_version
+from .activity import INSERT_SQL, activity_record
+
+# --- ЧЕТЕНЕ НА НАСТРОЙКИТЕ (кеш за целия процес) ---
+
+class SettingsCache:
+    """
+    Кеш на таблицата 'settings' в паметта на процеса.
+    Зарежда се веднъж и се презарежда само когато версията 'settings' в
+    'cache_versions' се промени (запис от този или от друг процес).
+    """
+
+    def __init__(self):
+        self.version = None
+        self.values = {}
+
+    def refresh(self, conn):
+        version = get_version(conn, 'settings')
+        if version != self.version:
+            rows = conn.execute('SELECT key, value FROM settings').fetchall()
+            # Подменяме речника изцяло, за да не се вижда наполовина зареден
+            self.values = {row['key']: row['value'] for row in rows}
+            self.version = version
+
+    def invalidate(self):
+        self.version = None
+
+
+def _settings_cache():
+    return current_app.extensions.setdefault('settings_cache', SettingsCache())
 
-# --- НОВА ФУНКЦИЯ ЗА ЧЕТЕНЕ НА НАСТРОЙКИТЕ ---
 def get_setting(key, default=None):
     """
-    Извлича стойност на настройка от базата данни.
-    Използва 'g' обекта на Flask за кеширане на настройките в рамките на една заявка.
+    Извлича стойност на настройка от кеша в паметта.
+    Версията се проверява веднъж на заявка (едно четене по първичен ключ).
     """
-    if 'settings' not in g:
-        conn = get_db()
-        settings_data = conn.execute('SELECT key, value FROM settings').fetchall()
-        g.settings = {row['key']: row['value'] for row in settings_data}
-    
-    return g.settings.get(key, default)
+    cache = _settings_cache()
+    if 'settings_checked' not in g:
+        cache.refresh(get_db())
+        g.settings_checked = True
+    return cache.values.get(key, default)
+
+def invalidate_settings():
+    """Изчиства кеша на настройките след запис (write-through)."""
+    _settings_cache().invalidate()
+    g.pop('settings_checked', None)
 
 
 # --- Помощни функции за форматиране и почистване ---
@@ -68,6 +102,79 @@ def format_date_dmy(value):
     else:
         return date_obj.strftime('%d.%m.%Y %H:%M:%S')
 
+def fts_prefix_query(text):
+    """
+    Превръща свободен текст в FTS5 заявка с търсене по начало на дума.
+    Всяка дума се огражда в кавички, за да не се тълкуват символи като '-' или ':'.
+    """
+    terms = [term.replace('"', '""') for term in text.split()]
+    return ' '.join(f'"{term}"*' for term in terms if term)
+
+def encode_cursor(*values):
+    """Кодира стойностите на последния ред в непрозрачен токен за страниране."""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token, size):
+    """Декодира токен от 'encode_cursor'. Връща None при невалиден токен."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != size:
+        return None
+    return values
+
+def paginate(conn, select_sql, where, params, keys, per_page, after=None, before=None, offset=0, descending=False):
+    """
+    Връща една страница от заявка, като поддържа два режима:
+    - keyset (по курсор 'after'/'before') - търси директно от последния ред, без OFFSET;
+    - класически с 'offset' - когато не е подаден курсор.
+    'keys' е списък (израз, псевдоним) на колоните, които еднозначно подреждат
+    резултата; псевдонимите трябва да присъстват в 'select_sql'.
+    Връща (редове, курсор за следваща страница, курсор за предишна страница).
+    """
+    exprs = [expr for expr, _ in keys]
+    backwards = bool(before) and not after
+    values = decode_cursor(before if backwards else after, len(keys))
+    if values is None:
+        backwards = False
+
+    conditions, query_params = list(where), list(params)
+    # При връщане назад обхождаме в обратен ред и после обръщаме страницата
+    scan_desc = descending != backwards
+    if values is not None:
+        placeholders = ', '.join(['?'] * len(keys))
+        conditions.append(f"({', '.join(exprs)}) {'<' if scan_desc else '>'} ({placeholders})")
+        query_params.extend(values)
+
+    sql = select_sql
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ", ".join(f"{expr} {'DESC' if scan_desc else 'ASC'}" for expr in exprs)
+    sql += " LIMIT ?"
+    query_params.append(per_page + 1)
+    if values is None and offset:
+        sql += " OFFSET ?"
+        query_params.append(offset)
+
+    rows = conn.execute(sql, query_params).fetchall()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, values is not None or offset > 0
+
+    aliases = [alias for _, alias in keys]
+    next_cursor = encode_cursor(*[rows[-1][a] for a in aliases]) if rows and has_next else None
+    prev_cursor = encode_cursor(*[rows[0][a] for a in aliases]) if rows and has_prev else None
+    return rows, next_cursor, prev_cursor
+
 def allowed_file(filename):
     """Проверява дали разширението на файла е позволено."""
     return '.' in filename and \
@@ -90,13 +197,28 @@ def calculate_fine(due_date_str):
         if date.today() > due_date:
             overdue_days = (date.today() - due_date).days
             # ПРОМЯНА: Използваме стойността от настройките
-            fine_per_day = float(get_setting('fine_per_day', 0.10))
+            fine_per_day = get_fine_rate()
             return round(overdue_days * fine_per_day, 2)
     except (ValueError, TypeError):
         print(f"ПРЕДУПРЕЖДЕНИЕ: Невалидна дата за изчисляване на глоба: '{due_date_str}'")
         return 0.0
     return 0.0
 
+def overdue_days_sql(due_date_column):
+    """
+    SQL израз за броя дни просрочие към днешна дата (0, ако не е просрочено).
+    Съответства на 'calculate_fine', но се изчислява в самата заявка.
+    """
+    return f"COALESCE(MAX(0, CAST(julianday('now', 'localtime', 'start of day') - julianday(date({due_date_column})) AS INTEGER)), 0)"
+
+def fine_sql(due_date_column):
+    """SQL израз за глобата; очаква един параметър '?' - глоба на ден."""
+    return f"ROUND({overdue_days_sql(due_date_column)} * ?, 2)"
+
+def get_fine_rate():
+    """Глоба на ден от кешираните настройки."""
+    return float(get_setting('fine_per_day', 0.10))
+
 def clean_price(p_str):
     """Почиства и преобразува стойност към float за цена."""
     if isinstance(p_str, (int, float)):
@@ -174,11 +296,16 @@ def admin_required(f):
 # --- Логиране на дейности ---
 
 def log_activity(action, details=""):
-    """Записва дейност в базата данни."""
+    """
+    Записва дейност в базата данни. Ако е стартиран записващият на дневника
+    (виж 'activity.py'), записът се добавя в опашката му и се записва заедно
+    с другите; иначе (напр. при 'flask run' или тестове) - веднага.
+    """
+    record = activity_record(session.get('username', 'System'), action, details)
+    writer = current_app.extensions.get('activity_writer')
+    if writer is not None:
+        writer.put(record)
+        return
     conn = get_db()
-    current_timestamp = datetime.now()
-    conn.execute(
-        "INSERT INTO activity_log (timestamp, username, action, details) VALUES (?, ?, ?, ?)",
-        (current_timestamp, session.get('username', 'System'), action, details)
-    )
+    conn.execute(INSERT_SQL, record)
     conn.commit()
\ No newline at end of file
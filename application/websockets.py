@@ -1,7 +1,7 @@
 # application/websockets.py
 
-from flask import Blueprint, render_template, request
-from flask_socketio import emit
+from flask import Blueprint, render_template, request, session
+from flask_socketio import emit, join_room
 from .extensions import socketio
 
 ws_bp = Blueprint('ws', __name__, template_folder='templates')
@@ -18,6 +18,19 @@ def update_tablet_status():
     emit('tablet_status_update', {'connected': is_connected}, broadcast=True)
     print(f"Status update sent: Tablet connected = {is_connected}")
 
+# --- Промени в заеманията към всички служебни екрани ---
+
+# Стая, в която влизат само клиентите с активна сесия (не и таблетът)
+STAFF_ROOM = 'staff'
+
+def publish_delta(kind, **data):
+    """
+    Изпраща малко съобщение за промяна ('loan_opened', 'loan_closed',
+    'book_updated', 'reader_updated') до всички отворени служебни страници.
+    Извиква се след 'commit', за да не се разпрати промяна, която е отменена.
+    """
+    socketio.emit('circulation_delta', {'type': kind, **data}, to=STAFF_ROOM)
+
 @ws_bp.route('/tablet')
 def tablet_page():
     return render_template('tablet.html')
@@ -27,6 +40,8 @@ def tablet_page():
 @socketio.on('connect')
 def on_connect():
     print(f"Client connected: {request.sid}")
+    if session.get('user_id'):
+        join_room(STAFF_ROOM)
     # Когато нов клиент се свърже, му изпращаме актуалния статус на таблета
     is_connected = clients['tablet_sid'] is not None
     emit('tablet_status_update', {'connected': is_connected})
@@ -7,38 +7,58 @@ def app_dir():
         return os.path.dirname(sys.executable)
     return os.path.abspath(os.path.dirname(__file__))
 
-def main():
-    base = app_dir()
-    db_path = os.path.join(base, "library.db")
-    if not os.path.exists(db_path):
-        raise SystemExit(f"Не намирам {db_path}. Пусни този скрипт там, където е library.db.")
+def archive_path_for(db_path):
+    """Архивната база на дневника по подразбиране - до основната, с наставка '_archive' (както в приложението)."""
+    base, ext = os.path.splitext(db_path)
+    return f"{base}_archive{ext or '.db'}"
 
-    backups_dir = os.path.join(base, "backups")
-    os.makedirs(backups_dir, exist_ok=True)
-
-    ts = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    tmp_copy = os.path.join(tempfile.gettempdir(), f"library_{ts}.sqlite")
-
-    # Атомарен backup (без да спираме приложението)
-    src = sqlite3.connect(db_path)
-    dst = sqlite3.connect(tmp_copy)
+def _copy_database(src_path, dst_path, progress=None):
+    """Атомарно копие на база чрез backup API (без да спираме приложението) и проверка на целостта."""
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(dst_path)
     with dst:
-        src.backup(dst)
+        if progress:
+            src.backup(dst, pages=256, progress=lambda status, remaining, total: progress(remaining, total))
+        else:
+            src.backup(dst)
     src.close(); dst.close()
 
     # Валидиране на целостта
-    conn = sqlite3.connect(tmp_copy)
+    conn = sqlite3.connect(dst_path)
     ok = conn.execute("PRAGMA integrity_check;").fetchone()[0]
     conn.close()
     if ok != "ok":
-        os.remove(tmp_copy)
-        raise SystemExit(f"integrity_check не е OK: {ok}")
+        os.remove(dst_path)
+        raise RuntimeError(f"integrity_check не е OK ({os.path.basename(src_path)}): {ok}")
+
+def create_backup(db_path, backups_dir, progress=None, archive_path=None):
+    """
+    Прави проверено и компресирано копие на базата в 'backups_dir' и връща пътя до него.
+    Ако 'archive_path' (архивът на дневника на дейността) съществува, той е в същия ZIP.
+    'progress(remaining, total)' се извиква по време на копирането на страниците.
+    """
+    os.makedirs(backups_dir, exist_ok=True)
 
-    # Компресиране
-    zip_name = os.path.join(backups_dir, f"library_{ts}.sqlite.zip")
-    with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED) as z:
-        z.write(tmp_copy, arcname=f"library_{ts}.sqlite")
-    os.remove(tmp_copy)
+    ts = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    copies = [(db_path, f"library_{ts}.sqlite")]
+    if archive_path and os.path.exists(archive_path):
+        copies.append((archive_path, f"library_archive_{ts}.sqlite"))
+
+    tmp_copies = []
+    try:
+        for src_path, arcname in copies:
+            tmp_copy = os.path.join(tempfile.gettempdir(), arcname)
+            _copy_database(src_path, tmp_copy, progress)
+            tmp_copies.append((tmp_copy, arcname))
+
+        # Компресиране
+        zip_name = os.path.join(backups_dir, f"library_{ts}.sqlite.zip")
+        with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_DEFLATED) as z:
+            for tmp_copy, arcname in tmp_copies:
+                z.write(tmp_copy, arcname=arcname)
+    finally:
+        for tmp_copy, _ in tmp_copies:
+            os.remove(tmp_copy)
 
     # Ротация
     zips = sorted(glob.glob(os.path.join(backups_dir, "library_*.sqlite.zip")))
@@ -46,6 +66,19 @@ def main():
         try: os.remove(old)
         except: pass
 
+    return zip_name
+
+def main():
+    base = app_dir()
+    db_path = os.path.join(base, "library.db")
+    if not os.path.exists(db_path):
+        raise SystemExit(f"Не намирам {db_path}. Пусни този скрипт там, където е library.db.")
+
+    try:
+        zip_name = create_backup(db_path, os.path.join(base, "backups"), archive_path=archive_path_for(db_path))
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+
     print(f"Backup OK -> {zip_name}")
 
 if __name__ == "__main__":
@@ -13,11 +13,59 @@ class Config:
     DATABASE = 'library.db'
     SIGNATURES_FOLDER = 'signatures'
     COVERS_FOLDER = 'covers'
+    JOBS_FOLDER = 'job_results'     # качени файлове и резултати от фоновите задачи
+
+    # --- Пул от връзки към SQLite ---
+    DB_POOL_SIZE = 8
+    DB_POOL_TIMEOUT = 10.0          # сек. изчакване за свободна връзка
+    DB_BUSY_TIMEOUT_MS = 5000       # PRAGMA busy_timeout
+    DB_CACHE_SIZE_KB = 20000        # PRAGMA cache_size (в KiB)
+    DB_MMAP_SIZE = 256 * 1024 * 1024
+    DB_CACHED_STATEMENTS = 256      # кеш на подготвените заявки за всяка връзка
+    DB_AUTO_MIGRATE = True          # прилагане на миграциите при старт
+    DB_READ_WORKERS = 4             # едновременни заявки за четене (в истински нишки)...
+    DB_READ_RESERVED = 1            # ...от тях запазени само за гишето (заемане, връщане, глоби)
+    DB_WRITE_WORKERS = 1            # едновременни транзакции за запис - SQLite така или иначе има един записващ
+    DB_BUSY_RETRIES = 5             # повторни опити за 'BEGIN IMMEDIATE', ако базата е заключена...
+    DB_BUSY_BACKOFF_MS = 20         # ...с пауза от толкова мс, удвоявана след всеки опит (със случайно отклонение)
+
+    # --- Фонови задачи (импорт, експорт, архив, поддръжка) ---
+    JOB_WORKERS = 2                 # брой задачи, изпълнявани едновременно (в отделни нишки)
+    JOB_POLL_SECONDS = 1.0          # колко често се проверява опашката и се изпраща прогресът
+    JOB_RESULT_DAYS = 7             # след колко дни се изтриват файловете с резултати
+    UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024  # размер на частите при качване на големи файлове за импорт
+
+    # --- Приоритети на заявките (виж 'application/scheduling.py') ---
+    CIRCULATION_BUSY = 4            # при толкова активни заявки на гишето справките и публичните се отказват с 503
+    REPORT_SLOTS = 2                # едновременни справки и експорти
+    REPORT_QUEUE_LIMIT = 6          # чакащи справки, след които се отговаря с 503
+    REPORT_QUEUE_SECONDS = 15.0     # най-дълго чакане на справка за място
+    PUBLIC_SLOTS = 8                # публичен каталог: едновременни заявки от всички клиенти...
+    PUBLIC_QUEUE_LIMIT = 16         # ...чакащи, след които се отговаря с 503...
+    PUBLIC_QUEUE_SECONDS = 5.0      # ...и най-дълго чакане за място
+    PUBLIC_RATE_PER_SECOND = 5.0    # публичен каталог: заявки в секунда за един клиент...
+    PUBLIC_RATE_BURST = 20          # ...и до толкова наведнъж
+    REQUEST_SHED_ACTIVE = 40        # при толкова активни заявки справките и публичните се отказват с 503
+    REQUEST_RETRY_AFTER = 5         # стойност на 'Retry-After' (сек.) при отказ
     
     # --- Настройки на приложението ---
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     BOOKS_PER_PAGE = 25
+    READERS_PER_PAGE = 50
     FINE_PER_DAY = 0.20
+    FINE_ACCRUAL_TIME = '00:05'         # ежедневно начисляване на глобите (местно време)
+    PUBLIC_SEARCH_CACHE_SECONDS = 15    # кеш на търсенето в публичния каталог
+    PUBLIC_SEARCH_CACHE_SIZE = 512
+    REPORT_CACHE_SIZE = 128             # брой кеширани резултати от справки (до следващ запис / завинаги за минали периоди)
+    REPORT_CACHE_MAX_ROWS = 5000        # по-големи резултати не се кешират (експортът ги чете като поток)
+    EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024   # XLSX/PDF до този размер остават в паметта, по-големите - във временен файл
+    EXPORT_PDF_FONT = os.environ.get('EXPORT_PDF_FONT')  # TTF шрифт с кирилица за PDF (по подразбиране DejaVuSans)
+    ACTIVITY_ARCHIVE_DAYS = 365         # записите в дневника, по-стари от толкова дни, се местят в архивната база
+    ACTIVITY_ARCHIVE_TIME = '00:15'     # ежедневно архивиране на дневника (местно време)
+    ACTIVITY_ARCHIVE_DATABASE = None    # архивна база на дневника (по подразбиране 'library_archive.db' до основната)
+    ACTIVITY_LOG_BATCH = 200            # най-много записи от дневника в една транзакция
+    ACTIVITY_LOG_FLUSH_MS = 20          # колко време се събират записи преди запис
+    ACTIVITY_LOG_QUEUE_SIZE = 5000      # при пълна опашка заявките изчакват (записите не се губят)
     
     # --- Настройки за сигурност при вход ---
     LOGIN_ATTEMPTS_LIMIT = 3
@@ -1,3 +1,5 @@
+-- Базова схема (миграция 1). Всички следващи промени се добавят като
+-- номерирани миграции в application/migrations.py.
 CREATE TABLE IF NOT EXISTS genres ( id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255) UNIQUE NOT NULL );
 CREATE TABLE IF NOT EXISTS professions ( id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255) UNIQUE NOT NULL );
 CREATE TABLE IF NOT EXISTS educations ( id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR(255) UNIQUE NOT NULL );
@@ -1,21 +1,39 @@
 # run.py
 
+import os
 from application import create_app
 from application.extensions import socketio
-from application.database import init_db
-import os
+from application.fines import start_fine_accrual
+from application.jobs import start_job_runner
+from application.activity import start_activity_archival, start_activity_writer
 
-# Създаваме приложението, използвайки нашата "фабрика"
+# Създаваме приложението, използвайки нашата "фабрика".
+# Ако базата данни липсва, тя се създава от миграциите при старта на приложението.
 app = create_app()
 
+DEBUG = True
+
+
+def is_serving_process():
+    """
+    С debug reloader-а на werkzeug скриптът се изпълнява в два процеса:
+    наблюдаващ (рестартира при промяна на кода) и дъщерен, който обслужва
+    заявките (с WERKZEUG_RUN_MAIN). Фоновите задачи трябва да са само в
+    дъщерния - иначе два диспечера на задачите делят една таблица 'jobs'.
+    """
+    return not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+
 if __name__ == '__main__':
-    # Проверяваме дали базата данни съществува, преди да я инициализираме
-    db_path = app.config['DATABASE']
-    if not os.path.exists(db_path):
-        with app.app_context():
-            print(f"Базата данни не е намерена на '{db_path}'. Инициализирам нова база...")
-            init_db()
-    
+    if is_serving_process():
+        # Фонова задача, която веднъж на ден начислява глобите по отворените заемания
+        start_fine_accrual(app)
+        # Записите в дневника на дейността се записват на порции
+        start_activity_writer(app)
+        # Ежедневно преместване на старите записи от дневника на дейността в архивната база
+        start_activity_archival(app)
+        # Диспечер на фоновите задачи (импорт, експорт, архив, поддръжка)
+        start_job_runner(app)
     # Стартираме приложението чрез SocketIO, за да работят WebSockets
     # host='0.0.0.0' позволява достъп до сървъра от други устройства в мрежата (за таблета)
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(app, debug=DEBUG, host='0.0.0.0', port=5000)